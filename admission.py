@@ -0,0 +1,112 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from . import config, metrics
+
+# Refusal reasons, also the labels of the admission_refusals metric
+IN_FLIGHT = "in_flight"
+USER = "user"
+CHAT = "chat"
+COMMAND = "command"
+
+
+class TokenBuckets:
+    """
+    Token buckets by key, each refilled at its rate per second up to its burst. The buckets are refilled
+    lazily when taken from, and a bucket that has refilled completely is dropped, as a new one would be
+    the same, so that memory is only taken by the keys active recently.
+    """
+
+    def __init__(self):
+        # Key to [tokens, time of the last refill, rate, burst], least recently used first
+        self._buckets: OrderedDict[any, list[float]] = OrderedDict()
+
+    def refill(self, key: any, rate: float, burst: float, now: float) -> list[float]:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [burst, now, rate, burst]
+            self._buckets[key] = bucket
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            bucket[2] = rate
+            bucket[3] = burst
+            self._buckets.move_to_end(key)
+        self._evict(now)
+        return bucket
+
+    def _evict(self, now: float):
+        # At most a couple at a time, for constant time per call
+        for _ in range(2):
+            if len(self._buckets) <= 1:
+                return
+            tokens, last, rate, burst = next(iter(self._buckets.values()))
+            if tokens + (now - last) * rate < burst:
+                return
+            self._buckets.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class AdmissionControl:
+    """
+    Refuses a request when the bot already has MaxInFlight replies in progress, or when the user, the chat
+    or the command has used up its token bucket, configured as requests per minute and a burst. The
+    checks are made before any work is done for the request; an admitted request must be released once
+    its reply is done.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._users = TokenBuckets()
+        self._chats = TokenBuckets()
+        self._commands = TokenBuckets()
+
+    def admit(self, user_id: int | None, chat_id: int, command: str) -> str | None:
+        """
+        Returns:
+            str | None: The reason for refusing the request, or None if it was admitted.
+        """
+        snapshot = config.current()
+        limits = [(self._users, user_id, snapshot.user_rate_limit, USER),
+                  (self._chats, chat_id, snapshot.chat_rate_limit, CHAT),
+                  (self._commands, command, snapshot.command_rate_limits.get(command), COMMAND)]
+        now = monotonic()
+        with self._lock:
+            if snapshot.max_in_flight is not None and self._in_flight >= snapshot.max_in_flight:
+                reason = IN_FLIGHT
+            else:
+                reason = None
+                buckets = []
+                for store, key, limit, limit_reason in limits:
+                    if limit is None or key is None:
+                        continue
+                    per_minute, burst = limit
+                    bucket = store.refill(key, per_minute / 60, burst, now)
+                    if bucket[0] < 1:
+                        reason = limit_reason
+                        break
+                    buckets.append(bucket)
+                if reason is None:
+                    # Taken only once every bucket has a token, so that a refusal doesn't use any up
+                    for bucket in buckets:
+                        bucket[0] -= 1
+                    self._in_flight += 1
+        if reason is not None:
+            metrics.increment("admission_refusals", reason=reason, command=command)
+        return reason
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def stats(self) -> dict[str, any]:
+        with self._lock:
+            return {"in_flight": self._in_flight,
+                    "max_in_flight": config.current().max_in_flight,
+                    "users": len(self._users),
+                    "chats": len(self._chats),
+                    "commands": len(self._commands)}
@@ -1 +1,4 @@
-__all__ = ["openai", "ollama", "google"]
\ No newline at end of file
+__all__ = ["openai", "ollama", "google"]
+
+# The module implementing each Api of config.ini, so that only the ones in use need to be imported
+MODULES = {"OpenAI": "openai", "Ollama": "ollama", "Google": "google"}
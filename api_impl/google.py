@@ -1,7 +1,7 @@
 from ..query import ApiImplementations, TextGenQuery, ImageGenQuery
 from ..config import Feature
-import base64
-import puremagic
+from .. import images, payload
+from ..payload import Base64
 import json
 
 def bind(api_implementations: ApiImplementations):
@@ -15,8 +15,9 @@ class GoogleChatQuery(TextGenQuery):
     def get_assistant_role(self):
         return "model"
 
-    def get_headers(self):
-        h = {"x-goog-api-key": self.token} if self.token else {}
+    def get_headers(self, token: str | None = None):
+        token = token if token is not None else self.token
+        h = {"x-goog-api-key": token} if token else {}
         return {"Content-Type": self.get_content_type().value} | h
 
     def get_url_suffix(self):
@@ -26,22 +27,22 @@ class GoogleChatQuery(TextGenQuery):
         return [{"role": r, "parts": self.get_content(t, i)} for (r, t, i) in l]
 
     @staticmethod
-    def get_content(text, images_base64):
+    def get_content(text, message_images):
         elements = [{"text": text}]
-        for image_base64 in images_base64:
+        for image in message_images:
             elements.append({
                 "inlineData": {
-                    "mimeType": puremagic.from_string(base64.b64decode(image_base64), mime=True),
-                    "data": image_base64,
+                    "mimeType": images.mime_type(image),
+                    "data": Base64(image),
                 },
             })
         return elements
 
     def is_configured(self):
-        return super().is_configured() and self.token
+        return super().is_configured() and self.has_tokens()
 
-    def get_data(self, chat_id: int, reply_to_id: int) -> str:
-        return json.dumps({"contents": self.get_history(chat_id).get(reply_to_id)} | self.params)
+    def get_data(self, chat_id: int, reply_to_id: int) -> any:
+        return payload.dumps({"contents": self.get_history(chat_id).get(reply_to_id)} | self.params)
 
     def get_response_text(self, s: str) -> str:
         data_prefix = "data: "
@@ -62,8 +63,9 @@ class GoogleImageQuery(ImageGenQuery):
     def get_assistant_role(self):
         return "model"
 
-    def get_headers(self):
-        h = {"x-goog-api-key": self.token} if self.token else {}
+    def get_headers(self, token: str | None = None):
+        token = token if token is not None else self.token
+        h = {"x-goog-api-key": token} if token else {}
         return {"Content-Type": self.get_content_type().value} | h
 
     def get_url_suffix(self):
@@ -73,24 +75,24 @@ class GoogleImageQuery(ImageGenQuery):
         return [{"role": r, "parts": self.get_content(t, i)} for (r, t, i) in l]
 
     @staticmethod
-    def get_content(text, images_base64):
+    def get_content(text, message_images):
         elements = [{"text": text}]
-        for image_base64 in images_base64:
+        for image in message_images:
             elements.append({
                 "inlineData": {
-                    "mimeType": puremagic.from_string(base64.b64decode(image_base64), mime=True),
-                    "data": image_base64,
+                    "mimeType": images.mime_type(image),
+                    "data": Base64(image),
                 },
             })
         return elements
 
     def is_configured(self):
-        return super().is_configured() and self.token
+        return super().is_configured() and self.has_tokens()
 
-    def get_data(self, chat_id: int, reply_to_id: int) -> str:
-        return json.dumps({"contents": self.get_history(chat_id).get(reply_to_id)}
-                          | {"generationConfig": {"responseModalities": ["TEXT", "IMAGE"]}}
-                          | self.params)
+    def get_data(self, chat_id: int, reply_to_id: int) -> any:
+        return payload.dumps({"contents": self.get_history(chat_id).get(reply_to_id)}
+                             | {"generationConfig": {"responseModalities": ["TEXT", "IMAGE"]}}
+                             | self.params)
 
     def get_response_text(self, s: str) -> str | None:
         array = json.loads(s)["candidates"][0]["content"]["parts"]
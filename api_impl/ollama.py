@@ -2,7 +2,8 @@ from telebot.formatting import mcite # type: ignore
 
 from ..query import ApiImplementations, TextGenQuery
 from ..formatters import ChainedPartitionFormatter, ReplyFormatter
-from .. import texts
+from .. import payload, texts
+from ..payload import Base64
 from ..config import Feature
 import json
 import re
@@ -37,13 +38,13 @@ class OllamaQuery(TextGenQuery):
             return value
 
     def __init__(self):
-        super().__init__(OllamaQuery.ThinkFormatter())
+        super().__init__(OllamaQuery.ThinkFormatter)
         self.think_parser = re.compile("^(?:<think>.*?</think>)?(.*)$", flags=re.S)
 
-    def get_data(self, chat_id: int, reply_to_id: int) -> str:
-        return json.dumps({"model": self.model, "messages": self.get_history(chat_id).get(reply_to_id)}
-                          | {"stream": self.stream}
-                          | self.params)
+    def get_data(self, chat_id: int, reply_to_id: int) -> any:
+        return payload.dumps({"model": self.model, "messages": self.get_history(chat_id).get(reply_to_id)}
+                             | {"stream": self.stream}
+                             | self.params)
 
     def get_response_text(self, s: str) -> str:
         return json.loads(s)["message"]["content"]
@@ -58,7 +59,7 @@ class OllamaQuery(TextGenQuery):
         return [self.print_input(r, t, i) for (r, t, i) in l]
 
     @staticmethod
-    def print_input(role, text, images):
-        if images:
-            return {"role": role, "content": text, "images": images}
+    def print_input(role, text, message_images):
+        if message_images:
+            return {"role": role, "content": text, "images": [Base64(image) for image in message_images]}
         return {"role": role, "content": text}
\ No newline at end of file
@@ -1,9 +1,8 @@
 from ..query import ApiImplementations, TextGenQuery, ImageGenQuery, ImageEditQuery, ContentType
 from ..config import Feature
+from .. import images, payload
+from ..payload import Base64
 import json
-import base64
-from io import BytesIO
-import puremagic
 
 def bind(api_implementations: ApiImplementations):
     api_implementations.bind("OpenAI", Feature.TEXT_GENERATION, lambda: OpenAIChatQuery())
@@ -15,26 +14,26 @@ class OpenAIChatQuery(TextGenQuery):
         return [{"role": r, "content": self.get_content(t, i)} for (r, t, i) in l]
 
     @staticmethod
-    def get_content(text, images_base64):
-        if not images_base64:
+    def get_content(text, message_images):
+        if not message_images:
             return text
         elements = [{"type": "text", "text": text}]
-        for image_base64 in images_base64:
+        for image in message_images:
             elements.append({
                 "type": "image_url",
                 "image_url": {
-                    "url": "data:image/jpeg;base64," + image_base64,
+                    "url": Base64(image, f"data:{images.mime_type(image)};base64,"),
                 },
             })
         return elements
 
     def is_configured(self):
-        return super().is_configured() and self.token
+        return super().is_configured() and self.has_tokens()
 
-    def get_data(self, chat_id: int, reply_to_id: int) -> str:
-        return json.dumps({"model": self.model, "messages": self.get_history(chat_id).get(reply_to_id)}
-                          | {"stream": self.stream}
-                          | self.params)
+    def get_data(self, chat_id: int, reply_to_id: int) -> any:
+        return payload.dumps({"model": self.model, "messages": self.get_history(chat_id).get(reply_to_id)}
+                             | {"stream": self.stream}
+                             | self.params)
 
     def get_response_text(self, s: str) -> str:
         data_prefix = "data: "
@@ -64,7 +63,7 @@ class OpenAIImageQuery(ImageGenQuery):
         return [t for (r, t, i) in l]
 
     def is_configured(self):
-        return super().is_configured() and self.token
+        return super().is_configured() and self.has_tokens()
 
     def get_data(self, chat_id: int, reply_to_id: int) -> str:
         return json.dumps({"model": self.model, "prompt": self.get_history(chat_id).get(reply_to_id)[-1]} | self.params)
@@ -81,22 +80,20 @@ class OpenAIImageEditQuery(ImageEditQuery):
         return ContentType.FORM
 
     def history_printer(self, l):
-        return [(t, self.decode_base64(i)) for (r, t, i) in l]
-
-    @staticmethod
-    def decode_base64(images_base64: list[str]):
-        return [base64.b64decode(image) for image in images_base64]
+        return [(t, i) for (r, t, i) in l]
 
     def is_configured(self):
-        return super().is_configured() and self.token
+        return super().is_configured() and self.has_tokens()
 
     def get_data(self, chat_id: int, reply_to_id: int) -> any:
+        prompt, prompt_images = self.get_history(chat_id).get(reply_to_id)[-1]
         files = []
         files.append(("model", (None, self.model)))
-        files.append(("prompt", (None, self.get_history(chat_id).get(reply_to_id)[-1][0])))
+        files.append(("prompt", (None, prompt)))
         i = 1
-        for image in self.get_history(chat_id).get(reply_to_id)[-1][1]:
-            files.append(("image[]", (f"img{i}", BytesIO(image), puremagic.from_string(image, mime=True))))
+        for image in prompt_images:
+            # Sent as is, as requests takes the bytes of a file without copying them into a stream
+            files.append(("image[]", (f"img{i}", image, images.mime_type(image))))
             i += 1
         for k, v in self.params.items():
             files.append((k, (None, v)))
@@ -0,0 +1,163 @@
+"""
+Measures the time taken to format streamed replies, as the chain of partition formatters ReplyFormatter
+used to be (CodeFormatter → MonospaceFormatter → H4 → H3 → H2 → H1 → Bold → Escape) and as the single-pass
+ReplyFormatter. Each reply is formatted at every 200 characters, as its page is reformatted on each edit,
+and the outputs of the two are checked to be identical.
+
+    python benchmarks/formatter_speed.py [replies]
+"""
+import importlib
+import os
+import random
+import re
+import sys
+from time import perf_counter
+
+_package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(_package))
+
+formatters = importlib.import_module(os.path.basename(_package) + ".formatters")
+parsing = importlib.import_module(os.path.basename(_package) + ".parsing")
+formatting = formatters.formatting
+
+WORDS = "the a model reply prompt image telegram bot history message token code python format what how".split()
+
+
+class MatchPartitionFormatter(parsing.Formatter):
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def in_format(self, s: str, match: re.Match) -> str:
+        return s
+
+    def out_format(self, s: str) -> str:
+        return s
+
+    def format(self, s: str, affect_state: bool = False, finalized: bool = False) -> str:
+        return parsing.format_matches(s, self.pattern, self.in_format, self.out_format)
+
+
+class EscapeFormatter(MatchPartitionFormatter):
+    def __init__(self):
+        super().__init__(r"\[([^[]+)\]\((https?://[^)]+)\)")
+
+    def in_format(self, s: str, match: re.Match) -> str:
+        return formatting.mlink(match.group(1), match.group(2))
+
+    def out_format(self, s: str) -> str:
+        return formatting.escape_markdown(s)
+
+
+class BoldFormatter(formatters.ChainedPartitionFormatter):
+    def __init__(self):
+        super().__init__(EscapeFormatter(), "**", "**")
+
+    def in_format(self, s: str) -> str:
+        return formatting.mbold(s, escape=False)
+
+
+class HeaderFormatter(formatters.ChainedPartitionFormatter):
+    INDENTS = {1: "        ", 2: "    ", 3: "  ", 4: ""}
+
+    def __init__(self, level: int):
+        super().__init__(HeaderFormatter(level - 1) if level > 1 else BoldFormatter(), "#" * level + " ", "\n")
+        self.level = level
+
+    def in_format(self, s: str) -> str:
+        if not self.previous_segment or self.previous_segment.endswith("\n"):
+            if self.level <= 2 and "*" not in s:
+                s = "*" + s + "*"
+            return "\n" + HeaderFormatter.INDENTS[self.level] + "__" + s + "__\n\n"
+        return "\\#" * self.level + " " + s + "\n"
+
+
+class MonospaceFormatter(MatchPartitionFormatter):
+    def __init__(self):
+        super().__init__(r"`([^`\n]+)`")
+        self.next = HeaderFormatter(4)
+
+    def reset(self):
+        self.next.reset()
+
+    def in_format(self, s: str, match: re.Match) -> str:
+        return f"`{formatting.escape_markdown(match.group(1))}`"
+
+    def out_format(self, s: str) -> str:
+        return self.next.format(s)
+
+
+class ChainFormatter(formatters.ChainedPartitionFormatter):
+    def __init__(self):
+        super().__init__(MonospaceFormatter(), "```", "```", inside_not_chained=True)
+        self.latex = formatters.LaTeXFormatter()
+
+    @staticmethod
+    def substitute(m: re.Match[str]) -> str:
+        language = m.group(1) or ""
+        contents = m.group(2) or ""
+        return "```" + formatting.escape_markdown(language) + "\n" + formatting.escape_markdown(contents) + "\n```"
+
+    def in_format(self, s: str) -> str:
+        return re.sub(r"^([^\s.]+\n)?(.*)$", self.substitute, s, flags=re.S)
+
+    def out_format(self, s: str) -> str:
+        return self.latex.format(s)
+
+
+def sentence(generator: random.Random) -> str:
+    words = [generator.choice(WORDS) for _ in range(generator.randint(4, 16))]
+    i = generator.randrange(len(words))
+    kind = generator.random()
+    if kind < 0.2:
+        words[i] = f"**{words[i]}**"
+    elif kind < 0.35:
+        words[i] = f"`{words[i]}()`"
+    elif kind < 0.45:
+        words[i] = f"[{words[i]}](https://example.com/{words[i]})"
+    elif kind < 0.5:
+        words[i] = "$\\frac{1}{2}$"
+    return " ".join(words).capitalize() + "."
+
+
+def reply(generator: random.Random) -> str:
+    parts = []
+    while sum(len(part) for part in parts) < 3500:
+        kind = generator.random()
+        if kind < 0.15:
+            parts.append("#" * generator.randint(1, 4) + " " + sentence(generator)[:-1] + "\n")
+        elif kind < 0.3:
+            lines = "\n".join(f"    x_{i} = {generator.choice(WORDS)}({i}) * 2" for i in range(generator.randint(2, 8)))
+            parts.append("```python\n" + lines + "\n```\n")
+        elif kind < 0.45:
+            parts.append("".join(f"- {sentence(generator)}\n" for _ in range(generator.randint(2, 5))))
+        else:
+            parts.append(" ".join(sentence(generator) for _ in range(generator.randint(2, 5))) + "\n\n")
+    return "".join(parts)
+
+
+def stream(formatter_class, text: str) -> list[str]:
+    formatter = formatter_class()
+    return [formatter.format(text[:end]) for end in range(200, len(text) + 200, 200)]
+
+
+def measure(formatter_class, texts: list[str]) -> tuple[float, list[list[str]]]:
+    started = perf_counter()
+    outputs = [stream(formatter_class, text) for text in texts]
+    return perf_counter() - started, outputs
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    generator = random.Random(0)
+    texts = [reply(generator) for _ in range(count)]
+    formats = sum(len(range(200, len(text) + 200, 200)) for text in texts)
+    # Warms up the LaTeX conversion cache, which both share
+    measure(formatters.ReplyFormatter, texts[:1])
+
+    chain_seconds, chain_outputs = measure(ChainFormatter, texts)
+    single_seconds, single_outputs = measure(formatters.ReplyFormatter, texts)
+    assert single_outputs == chain_outputs, "The outputs differ"
+
+    print(f"{count} replies of about {sum(len(text) for text in texts) // count} characters, {formats} formats")
+    print(f"Formatter chain: {chain_seconds / formats * 1000:8.3f} ms per format")
+    print(f"Single pass:     {single_seconds / formats * 1000:8.3f} ms per format ({chain_seconds / single_seconds:.1f}x)")
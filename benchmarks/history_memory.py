@@ -0,0 +1,85 @@
+"""
+Measures the memory held by 10k history entries, as the previous representation (a tuple per message
+and a dict of aliases) and as Record objects with an AliasMap, with the texts uncompressed and compressed. The texts are counted in,
+as a history holds strings of its own.
+
+    python benchmarks/history_memory.py [entries]
+"""
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history_records import AliasMap, Record # noqa: E402
+
+WORDS = "the a model reply prompt image telegram bot history message token code python format what how".split()
+
+
+def entries(count: int) -> list[tuple[str, list[str], int | None, list[int]]]:
+    generator = random.Random(0)
+    result = []
+    message_id = 1
+    for i in range(count):
+        # Prompts are short, replies longer and sometimes split over several messages
+        length = generator.randint(5, 40) if i % 2 == 0 else generator.randint(50, 400)
+        text = " ".join(generator.choice(WORDS) for _ in range(length))
+        ids = list(range(message_id, message_id + (1 if i % 2 == 0 else generator.randint(1, 3))))
+        result.append((text, [], message_id - 1 if i % 2 else None, ids))
+        message_id = ids[-1] + 1
+    return result
+
+
+def _copy(text: str) -> str:
+    return text.encode().decode()
+
+
+def legacy(data):
+    history = {}
+    id_table = {}
+    for text, images, reply_to_id, ids in data:
+        for message_id in ids[1:]:
+            id_table[message_id] = ids[0]
+        history[ids[0]] = (_copy(text), list(images), reply_to_id)
+    return history, id_table
+
+
+def compact(data, compress: bool):
+    history = {}
+    id_table = AliasMap()
+    for text, images, reply_to_id, ids in data:
+        for message_id in ids[1:]:
+            id_table[message_id] = ids[0]
+        record = Record(_copy(text), images, reply_to_id)
+        if compress:
+            record.compress()
+        history[ids[0]] = record
+    return history, id_table
+
+
+def measure(build, data) -> int:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(data)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    data = entries(count)
+    text_bytes = sum(sys.getsizeof(text) for text, _, _, _ in data)
+    baseline = measure(legacy, data)
+    print(f"{count} entries, of which {text_bytes} bytes of texts uncompressed")
+    print(f"{'tuples and dict':<28}{baseline:>12} bytes  {baseline // count:>6} per entry")
+    for name, build in (("records and AliasMap", lambda d: compact(d, False)),
+                        ("records compressed", lambda d: compact(d, True))):
+        size = measure(build, data)
+        print(f"{name:<28}{size:>12} bytes  {size // count:>6} per entry  {100 * (size - baseline) / baseline:+.1f}%")
+
+
+if __name__ == "__main__":
+    main()
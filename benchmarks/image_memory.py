@@ -0,0 +1,78 @@
+"""
+Measures the memory taken by a conversation about a 10 MB image: the image held in the history, and the
+peak while a Gemini request for a reply to it is built and sent. The previous handling of images, held as base64
+and decoded again for the MIME type, is reproduced here for comparison.
+
+    python benchmarks/image_memory.py [megabytes]
+"""
+import base64
+import importlib.util
+import json
+import os
+import sys
+import tracemalloc
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_spec = importlib.util.spec_from_file_location("AIProxyTelegramBot", os.path.join(_root, "__init__.py"),
+                                               submodule_search_locations=[_root])
+sys.modules["AIProxyTelegramBot"] = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(sys.modules["AIProxyTelegramBot"])
+
+from AIProxyTelegramBot.api_impl.google import GoogleChatQuery # noqa: E402
+
+import puremagic # noqa: E402
+
+
+def download(size: int) -> bytes:
+    return b"\xff\xd8\xff\xe0\x00\x10JFIF\x00" + os.urandom(size - 11)
+
+
+def previous(size: int) -> tuple[int, int]:
+    tracemalloc.start()
+    content = download(size)
+    stored = [base64.b64encode(content).decode('utf-8')]
+    del content
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    parts = [{"text": "What is this?"}]
+    for image_base64 in stored:
+        parts.append({"inlineData": {"mimeType": puremagic.from_string(base64.b64decode(image_base64), mime=True),
+                                     "data": image_base64}})
+    data = json.dumps({"contents": [{"role": "user", "parts": parts}]})
+    # As http.client encodes a str body before sending it
+    sent = data.encode("iso-8859-1")
+    del sent
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del data
+    return held, peak
+
+
+def current(size: int) -> tuple[int, int]:
+    query = GoogleChatQuery()
+    query.model = "gemini"
+    query.params = {}
+    tracemalloc.start()
+    query.get_history(0).record("What is this?", [1], None, [download(size)])
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    data = query.get_data(0, 1)
+    # As urllib3 reads a file body
+    while data.read(16384):
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del data
+    return held, peak
+
+
+def main():
+    size = int(float(sys.argv[1] if len(sys.argv) > 1 else 10) * 1024 * 1024)
+    print(f"{size} bytes image")
+    for name, measure in (("base64 held", previous), ("bytes held", current)):
+        held, peak = measure(size)
+        print(f"{name:<14}held {held / size:.2f}x the image, peak sending a request {peak / size:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
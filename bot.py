@@ -3,50 +3,53 @@ from telebot import ContinueHandling
 from telebot.formatting import escape_markdown
 from telebot.types import Message  # type: ignore
 
-from . import api_impl, query_handler
-from .query import Query
-from .texts import service_refused
+from . import admission, cancellation, config, metrics, query_handler, recording, texts
+from .query_implementations import QueryImplementations, get_query_implementations, start_compaction
 from .util import get_service_refuser
-from .query import ApiImplementations
-from .config import read_query_implementations
-
-import importlib
 
 def register(bot: telebot.TeleBot):
     service_refuser = get_service_refuser()
+    admission_control = admission.AdmissionControl()
+    metrics.register_collector("admission", admission_control.stats)
 
-    query_implementations = get_query_implementations()
+    query_implementations = QueryImplementations(get_query_implementations(config.current()))
+    config.on_reload(query_implementations.reload)
+    start_compaction(query_implementations)
 
     @bot.message_handler(func=lambda m: True, content_types=["text", "photo", "sticker"])
     @bot.edited_message_handler(func=lambda m: True, content_types=["text", "photo", "sticker"])
     def handle_message(msg: Message):
         if msg.any_text is None:
             return ContinueHandling()
-        for query in query_implementations:
+        if msg.any_text.strip().split("@")[0].lower() == config.current().stop_command:
+            if service_refuser.refuse(msg):
+                bot.send_message(msg.chat.id, escape_markdown(texts.service_refused), reply_to_message_id=msg.id)
+            elif msg.reply_to_message:
+                cancellation.cancel(msg.chat.id, msg.reply_to_message.id)
+            else:
+                cancellation.cancel(msg.chat.id, user_id=msg.from_user.id if msg.from_user else None)
+            return ContinueHandling()
+        for query in query_implementations.current:
             if query.is_configured():
                 prompt = query.matches(msg.any_text)
                 if prompt is None:
                     continue
+                recording.update(msg, query.command, prompt)
+                # A custom refuser is asked first, so that what it refuses doesn't count against the limits
                 if service_refuser.refuse(msg):
-                    bot.send_message(msg.chat.id, escape_markdown(service_refused),
+                    bot.send_message(msg.chat.id, escape_markdown(texts.service_refused),
                                      reply_to_message_id=msg.id)
                     continue
-                query_handler.handle(bot, prompt, msg, query)
+                refusal = admission_control.admit(msg.from_user.id if msg.from_user else None, msg.chat.id,
+                                                  query.command)
+                if refusal is not None:
+                    bot.send_message(msg.chat.id, escape_markdown(texts.too_busy if refusal == admission.IN_FLIGHT
+                                                                  else texts.rate_limited),
+                                     reply_to_message_id=msg.id)
+                    break
+                try:
+                    query_handler.handle(bot, prompt, msg, query)
+                finally:
+                    admission_control.release()
                 break
         return ContinueHandling()
-
-
-def get_query_implementations() -> list[Query]:
-    query_implementations = []
-    api_implementations = ApiImplementations()
-
-    for module in api_impl.__all__:
-        api = importlib.import_module(f'..api_impl.{module}', package=__name__)
-        api.bind(api_implementations)
-
-    for config in read_query_implementations():
-        impl = api_implementations.get(config.api, config.feature)
-        impl.configure(config)
-        query_implementations.append(impl)
-
-    return query_implementations
\ No newline at end of file
@@ -0,0 +1,87 @@
+import threading
+
+from . import metrics
+
+
+class Generation:
+    """
+    A reply in progress to the prompt with the given message ID. Cancelling it runs the callbacks
+    registered with on_cancel, e.g. closing the upstream response, so that the generation stops promptly
+    whatever it is waiting for.
+    """
+
+    def __init__(self, chat_id: int, message_id: int, command: str | None = None, user_id: int | None = None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.command = command
+        self.user_id = user_id
+        self.reply_ids: set[int] = set()
+        self.reason: str | None = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
+
+    def cancel(self, reason: str) -> bool:
+        with self._lock:
+            if self.reason is not None:
+                return False
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        metrics.increment("cancellations", command=self.command, reason=reason)
+        for callback in callbacks:
+            callback()
+        return True
+
+    def on_cancel(self, callback):
+        """
+        Registers a function to be called on cancellation, or calls it right away if already cancelled.
+        """
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+
+_lock = threading.Lock()
+_generations: dict[tuple[int, int], Generation] = {}
+
+
+def start(chat_id: int, message_id: int, command: str | None = None, user_id: int | None = None) -> Generation:
+    """
+    Registers a new generation for the prompt sent by the given user, cancelling the one in progress for it,
+    if any, as the prompt has been edited.
+    """
+    generation = Generation(chat_id, message_id, command, user_id)
+    with _lock:
+        previous = _generations.get((chat_id, message_id))
+        _generations[(chat_id, message_id)] = generation
+    if previous is not None:
+        previous.cancel("edit")
+    return generation
+
+def finish(generation: Generation):
+    with _lock:
+        if _generations.get((generation.chat_id, generation.message_id)) is generation:
+            del _generations[(generation.chat_id, generation.message_id)]
+
+def cancel(chat_id: int, message_id: int | None = None, user_id: int | None = None, reason: str = "stop") -> int:
+    """
+    Cancels the generation replying to the prompt with the given message ID or sending the bot message
+    with it, or if no ID is given, every generation in the chat replying to the given user.
+
+    Returns:
+        int: The number of generations cancelled.
+    """
+    with _lock:
+        generations = [g for (c, m), g in _generations.items()
+                       if c == chat_id and (m == message_id or message_id in g.reply_ids
+                                            or message_id is None and g.user_id == user_id)]
+    return sum(1 for g in generations if g.cancel(reason))
+
+def in_progress() -> int:
+    with _lock:
+        return len(_generations)
@@ -0,0 +1,132 @@
+import threading
+from collections import deque
+from time import monotonic
+
+
+class _Ticket:
+    def __init__(self):
+        self.granted = False
+
+
+class FairLimiter:
+    """
+    Lets at most max_concurrent requests run at a time. The rest wait in a queue per chat, and whenever a
+    request finishes, the next one is taken from the chats in turn, so that a busy chat can't starve the
+    others.
+    """
+
+    def __init__(self, max_concurrent: int):
+        self.max_concurrent = max_concurrent
+        self._condition = threading.Condition()
+        self._active = 0
+        # Chats in the order they get their turn; a chat goes to the back once served
+        self._queues: dict[int, deque[_Ticket]] = {}
+
+    def acquire(self, chat_id: int, timeout: float | None = None, on_position=None,
+                report_interval: float = 0.0, cancelled=None) -> bool:
+        """
+        Waits for a turn. Meanwhile, on_position is called with the 1-based queue position whenever it
+        changes, but at most once per report_interval seconds; a change within the interval is reported
+        once the interval has passed. The wait is given up once cancelled returns True, which is checked
+        whenever interrupt is called.
+
+        Returns:
+            bool: True if the caller may proceed and must call release afterward, False if it timed out or
+            was cancelled.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._condition:
+            if self._active < self.max_concurrent and not self._queues:
+                self._active += 1
+                return True
+            ticket = _Ticket()
+            self._queues.setdefault(chat_id, deque()).append(ticket)
+            # A new chat may take its turn ahead of the requests already waiting
+            self._condition.notify_all()
+
+        reported = None
+        last_report = None
+        try:
+            while True:
+                with self._condition:
+                    if ticket.granted:
+                        return True
+                    now = monotonic()
+                    remaining = None if deadline is None else deadline - now
+                    if (remaining is not None and remaining <= 0) or (cancelled is not None and cancelled()):
+                        self._remove(chat_id, ticket)
+                        return False
+                    position = self._position(chat_id, ticket)
+                    if position == reported or on_position is None:
+                        self._condition.wait(remaining)
+                        continue
+                    if last_report is not None and now - last_report < report_interval:
+                        until_report = last_report + report_interval - now
+                        self._condition.wait(until_report if remaining is None else min(remaining, until_report))
+                        continue
+                reported = position
+                last_report = monotonic()
+                on_position(position)
+        except BaseException:
+            with self._condition:
+                if not ticket.granted:
+                    self._remove(chat_id, ticket)
+                    raise
+            self.release()
+            raise
+
+    def release(self):
+        with self._condition:
+            if self._queues and self._active <= self.max_concurrent:
+                self._grant_next()
+            else:
+                self._active -= 1
+            self._condition.notify_all()
+
+    def interrupt(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def _grant_next(self):
+        # The slot passes on to the next request directly, so the active count stays the same
+        chat_id = next(iter(self._queues))
+        queue = self._queues.pop(chat_id)
+        queue.popleft().granted = True
+        if queue:
+            self._queues[chat_id] = queue
+
+    def resize(self, max_concurrent: int):
+        with self._condition:
+            self.max_concurrent = max_concurrent
+            while self._queues and self._active < self.max_concurrent:
+                self._active += 1
+                self._grant_next()
+            self._condition.notify_all()
+
+    def stats(self) -> dict[str, int]:
+        with self._condition:
+            return {"max_concurrent": self.max_concurrent,
+                    "active": self._active,
+                    "waiting": sum(len(q) for q in self._queues.values()),
+                    "waiting_chats": len(self._queues)}
+
+    def _remove(self, chat_id: int, ticket: _Ticket):
+        queue = self._queues[chat_id]
+        queue.remove(ticket)
+        if not queue:
+            del self._queues[chat_id]
+        self._condition.notify_all()
+
+    def _position(self, chat_id: int, ticket: _Ticket) -> int:
+        # The turns go round the chats taking one request from each, so a request i-th in its chat's queue
+        # comes after the first i requests of every chat, and the i+1-th of the chats ahead of its own.
+        index = self._queues[chat_id].index(ticket)
+        position = 1
+        ahead = True
+        for other_chat_id, queue in self._queues.items():
+            if other_chat_id == chat_id:
+                ahead = False
+            position += min(len(queue), index)
+            if ahead and len(queue) > index:
+                position += 1
+        return position
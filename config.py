@@ -2,54 +2,19 @@ from enum import Enum
 
 import configparser
 import json.decoder
+import logging
+import os
 import pathlib
+import threading
+from time import sleep
+from types import MappingProxyType
 
 _INTERNAL_SECTIONS = ["TelegramBot", "TextOverrides", "Extension"]
 
 _config_file = pathlib.Path(__file__).parent.absolute().as_posix() + "/config.ini"
 
-_config = configparser.ConfigParser()
-_config.read(_config_file, encoding='utf-8')
-
 _decoder = json.JSONDecoder()
 
-def get(category: str, variable: str) -> str | None:
-    if category not in _config or variable not in _config[category]:
-        return None
-    return _config[category][variable]
-
-def get_boolean_or_false(category: str, variable: str) -> bool | None:
-    if category not in _config or variable not in _config[category]:
-        return False
-    return _config[category][variable].lower() == "true"
-
-def get_int(category: str, variable: str) -> int | None:
-    if category not in _config or variable not in _config[category]:
-        return None
-    return int(_config[category][variable])
-
-def get_int_list(category: str, variable: str) -> list[int] | None:
-    if category not in _config or variable not in _config[category]:
-        return None
-    return [int(i) for i in _config[category][variable][1:-1:].split(",") if i]
-
-def get_or_default(category: str, variable: str, default: str) -> str:
-    value = get(category, variable)
-    if value is None:
-        return default
-    return value
-
-def get_or_throw(category: str, variable: str) -> str:
-    value = get(category, variable)
-    if value is None:
-        raise RuntimeError("No configuration for " + category + "." + variable + " in " + _config_file)
-    return value
-
-def get_key_value_pairs(category: str, variable: str) -> dict[str, any]:
-    key_value_pairs = get_or_default(category, variable, "").strip().split("\n")
-    if key_value_pairs == [""]:
-        return {}
-    return {k: _decoder.decode(v) for k, v in [tuple(p.split(" ")) for p in key_value_pairs]}
 
 class Feature(Enum):
     TEXT_GENERATION = "Text gen"
@@ -57,8 +22,24 @@ class Feature(Enum):
     IMAGE_AND_TEXT_GENERATION = "Image and text gen"
     IMAGE_EDIT = "Image edit"
 
+class EndpointConfiguration:
+    def __init__(self, url: str, token: str | None, weight: float = 1.0):
+        self.url = url
+        self.token = token
+        self.weight = weight
+
 class Configuration:
-    def __init__(self, command: str, api: str, feature: str, model: str, url: str, token: str | None, stream: bool | None, params: dict[str, any]):
+    def __init__(self, command: str, api: str, feature: str, model: str, url: str, token: str | None, stream: bool | None, params: dict[str, any],
+                 endpoints: list[EndpointConfiguration] | None = None, balancing: str = "least-in-flight",
+                 eject_after_errors: int = 3, eject_seconds: float = 30.0, health_check_interval: float | None = None,
+                 max_concurrent: int | None = None, queue_timeout: float | None = None,
+                 context_tokens: int | None = None, context_bytes: int | None = None,
+                 image_max_dimension: int | None = None, image_quality: int | None = None,
+                 image_format: str | None = None, connect_timeout: float | None = 10.0,
+                 first_byte_timeout: float | None = 300.0, idle_timeout: float | None = 120.0,
+                 total_timeout: float | None = None, retries: int = 2,
+                 rate_limit: tuple[float, float] | None = None, overflow_mode: str = "messages",
+                 overflow_after: int = 3, overflow_format: str = "md"):
         self.command = command
         self.api = api
         self.feature = Feature(feature)
@@ -67,18 +48,331 @@ class Configuration:
         self.token = token
         self.stream = stream
         self.params = params
+        self.endpoints = endpoints if endpoints else [EndpointConfiguration(url, token)]
+        self.balancing = balancing
+        self.eject_after_errors = eject_after_errors
+        self.eject_seconds = eject_seconds
+        self.health_check_interval = health_check_interval
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.context_tokens = context_tokens
+        self.context_bytes = context_bytes
+        self.image_max_dimension = image_max_dimension
+        self.image_quality = image_quality
+        self.image_format = image_format
+        self.connect_timeout = connect_timeout
+        self.first_byte_timeout = first_byte_timeout
+        self.idle_timeout = idle_timeout
+        self.total_timeout = total_timeout
+        self.retries = retries
+        self.rate_limit = rate_limit
+        self.overflow_mode = overflow_mode
+        self.overflow_after = overflow_after
+        self.overflow_format = overflow_format
+
+
+class Snapshot:
+    """
+    The configuration as read from config.ini at one point in time, with the values used on every reply
+    parsed up front. Snapshots are never modified; a reload builds a new one and swaps it in whole, so
+    that a reply in progress sees a consistent configuration.
+    """
+
+    def __init__(self, parser: configparser.ConfigParser):
+        # The raw values by section, copied out of the parser so that nothing mutable is shared
+        self._values = MappingProxyType({section: MappingProxyType(dict(parser[section]))
+                                         for section in parser.sections()})
+        self.max_messages_per_reply: int = self._get_count("TelegramBot", "MaxMessagesPerReply", 9999)
+        self.stop_command: str = self.get_or_default("TelegramBot", "StopCommand", "/stop").lower()
+        self.history_compress_after: float | None = self.get_float("TelegramBot", "HistoryCompressAfter")
+        self.history_retention: float | None = self.get_float("TelegramBot", "HistoryRetention")
+        self.history_compact_interval: float = self._get_number("TelegramBot", "HistoryCompactInterval", 3600.0)
+        self.placeholder_delay: float = self._get_number("TelegramBot", "PlaceholderDelay", 0.0)
+        self.formatter_processes: int = self._get_count("TelegramBot", "FormatterProcesses", 0)
+        # Below this many characters sending the job to another process costs more than the formatting itself
+        self.format_inline_below: int = self._get_count("TelegramBot", "FormatInlineBelow", 1000)
+        self.telegram_retries: int = self._get_count("TelegramBot", "TelegramRetries", 5)
+        self.retry_base_delay: float = self._get_number("TelegramBot", "RetryBaseDelay", 0.5)
+        self.retry_max_delay: float = self._get_number("TelegramBot", "RetryMaxDelay", 30.0)
+        self.reply_log_chat_ids: frozenset[int] | None = \
+            self._get_int_set("TelegramBot", "ChatIDFilterForReplyLog")
+        self.persistent_history_chat_ids: frozenset[int] | None = \
+            self._get_int_set("TelegramBot", "ChatIDFilterForPersistentHistory")
+        self.max_in_flight: int | None = self.get_int("TelegramBot", "MaxInFlight")
+        self.user_rate_limit: tuple[float, float] | None = self._get_rate_limit("TelegramBot", "User")
+        self.chat_rate_limit: tuple[float, float] | None = self._get_rate_limit("TelegramBot", "Chat")
+        self.queries: tuple[Configuration, ...] = tuple(self._read_query_implementations())
+        self.command_rate_limits: MappingProxyType[str, tuple[float, float]] = \
+            MappingProxyType({q.command: q.rate_limit for q in self.queries if q.rate_limit is not None})
+        self._frozen = True
+
+    def __setattr__(self, name: str, value: any):
+        if getattr(self, "_frozen", False):
+            raise AttributeError("Configuration snapshots are immutable")
+        super().__setattr__(name, value)
+
+    def get(self, category: str, variable: str) -> str | None:
+        section = self._values.get(category)
+        if section is None:
+            return None
+        return section.get(variable.lower())
+
+    def get_boolean_or_false(self, category: str, variable: str) -> bool | None:
+        value = self.get(category, variable)
+        if value is None:
+            return False
+        return value.lower() == "true"
+
+    def get_int(self, category: str, variable: str) -> int | None:
+        value = self.get(category, variable)
+        if value is None:
+            return None
+        return int(value)
+
+    def get_float(self, category: str, variable: str) -> float | None:
+        value = self.get(category, variable)
+        if value is None:
+            return None
+        return float(value)
+
+    def get_int_list(self, category: str, variable: str) -> list[int] | None:
+        value = self.get(category, variable)
+        if value is None:
+            return None
+        return [int(i) for i in value[1:-1:].split(",") if i]
+
+    def get_or_default(self, category: str, variable: str, default: str) -> str:
+        value = self.get(category, variable)
+        if value is None:
+            return default
+        return value
+
+    def get_or_throw(self, category: str, variable: str) -> str:
+        value = self.get(category, variable)
+        if value is None:
+            raise RuntimeError("No configuration for " + category + "." + variable + " in " + _config_file)
+        return value
+
+    def get_key_value_pairs(self, category: str, variable: str) -> dict[str, any]:
+        key_value_pairs = self.get_or_default(category, variable, "").strip().split("\n")
+        if key_value_pairs == [""]:
+            return {}
+        result = {}
+        for pair in key_value_pairs:
+            key, _, value = pair.strip().partition(" ")
+            try:
+                result[key] = _decoder.decode(value.strip())
+            except json.decoder.JSONDecodeError:
+                raise RuntimeError(f"Invalid value for {key} in {category}.{variable} in {_config_file}: "
+                                   f"expected JSON, got {value.strip()!r}")
+        return result
+
+    def get_endpoints(self, category: str, variable: str, default_token: str | None) -> list[EndpointConfiguration]:
+        """
+        Reads endpoints given one per line as a URL, optionally followed by a JSON object with the keys
+        "token" and "weight", the latter being positive.
+        """
+        lines = self.get_or_default(category, variable, "").strip().split("\n")
+        if lines == [""]:
+            return []
+        endpoints = []
+        for line in lines:
+            url, _, options = line.strip().partition(" ")
+            try:
+                options = _decoder.decode(options.strip()) if options.strip() else {}
+                if not isinstance(options, dict) or not set(options) <= {"token", "weight"}:
+                    raise ValueError()
+                weight = float(options.get("weight", 1.0))
+                if not weight > 0:
+                    raise ValueError()
+                endpoints.append(EndpointConfiguration(url, options.get("token", default_token), weight))
+            except ValueError:
+                raise RuntimeError(f"Invalid endpoint {line.strip()!r} in {category}.{variable} in {_config_file}: "
+                                   f"expected a URL optionally followed by {{\"token\": ..., \"weight\": ...}} "
+                                   f"with a positive weight")
+        return endpoints
+
+    def _get_int_set(self, category: str, variable: str) -> frozenset[int] | None:
+        values = self.get_int_list(category, variable)
+        return frozenset(values) if values is not None else None
+
+    def _get_rate_limit(self, category: str, prefix: str) -> tuple[float, float] | None:
+        """
+        Reads a token bucket as {prefix}RequestsPerMinute and {prefix}Burst, the latter being the requests
+        per minute by default.
+
+        Returns:
+            tuple[float, float] | None: The requests per minute and the burst, if limited.
+        """
+        per_minute = self.get_float(category, prefix + "RequestsPerMinute")
+        if per_minute is None:
+            return None
+        burst = self._get_number(category, prefix + "Burst", per_minute)
+        if not per_minute > 0 or not burst >= 1:
+            raise RuntimeError(f"Invalid {category}.{prefix}RequestsPerMinute or {category}.{prefix}Burst in "
+                               f"{_config_file}: expected a positive rate and a burst of at least 1")
+        return per_minute, burst
+
+    def _get_count(self, category: str, variable: str, default: int) -> int:
+        value = self.get_int(category, variable)
+        return value if value is not None else default
+
+    def _get_number(self, category: str, variable: str, default: float) -> float:
+        value = self.get_float(category, variable)
+        return value if value is not None else default
+
+    def _get_timeout(self, category: str, variable: str, default: float | None) -> float | None:
+        # 0 disables a timeout that is on by default
+        value = self.get_float(category, variable)
+        if value is None:
+            return default
+        return value if value > 0 else None
+
+    def _read_query_implementations(self) -> list[Configuration]:
+        implementations = []
+        for command in self._values:
+            if command in _INTERNAL_SECTIONS:
+                continue
+            feature = self.get_or_throw(command, "Feature")
+            if feature not in [f.value for f in Feature]:
+                raise RuntimeError(f"Unknown feature {feature!r} for {command} in {_config_file}")
+            balancing = self.get_or_default(command, "Balancing", "least-in-flight")
+            if balancing not in ["least-in-flight", "ewma"]:
+                raise RuntimeError(f"Unknown balancing {balancing!r} for {command} in {_config_file}")
+            image_format = self.get(command, "ImageFormat")
+            if image_format is not None and image_format.upper() not in ["JPEG", "PNG", "WEBP"]:
+                raise RuntimeError(f"Unknown image format {image_format!r} for {command} in {_config_file}")
+            overflow_mode = self.get_or_default(command, "OverflowMode", "messages").lower()
+            if overflow_mode not in ["messages", "document"]:
+                raise RuntimeError(f"Unknown overflow mode {overflow_mode!r} for {command} in {_config_file}")
+            overflow_format = self.get_or_default(command, "OverflowFormat", "md").lower()
+            if overflow_format not in ["md", "txt"]:
+                raise RuntimeError(f"Unknown overflow format {overflow_format!r} for {command} in {_config_file}")
+            token = self.get(command, "Token")
+            endpoints = self.get_endpoints(command, "Endpoints", token)
+            url = endpoints[0].url if endpoints else self.get_or_throw(command, "Url")
+            implementations.append(Configuration(command,
+                                                 self.get_or_throw(command, "Api"),
+                                                 feature,
+                                                 self.get_or_throw(command, "Model"),
+                                                 url,
+                                                 token,
+                                                 self.get_boolean_or_false(command, "Stream"),
+                                                 self.get_key_value_pairs(command, "Params"),
+                                                 endpoints,
+                                                 balancing,
+                                                 self._get_count(command, "EjectAfterErrors", 3),
+                                                 self._get_number(command, "EjectFor", 30.0),
+                                                 self.get_float(command, "HealthCheckInterval"),
+                                                 self.get_int(command, "MaxConcurrent"),
+                                                 self.get_float(command, "QueueTimeout"),
+                                                 self.get_int(command, "ContextTokens"),
+                                                 self.get_int(command, "ContextBytes"),
+                                                 self.get_int(command, "ImageMaxDimension"),
+                                                 self.get_int(command, "ImageQuality"),
+                                                 image_format.upper() if image_format is not None else None,
+                                                 self._get_timeout(command, "ConnectTimeout", 10.0),
+                                                 self._get_timeout(command, "FirstByteTimeout", 300.0),
+                                                 self._get_timeout(command, "IdleTimeout", 120.0),
+                                                 self._get_timeout(command, "TotalTimeout", None),
+                                                 self._get_count(command, "Retries", 2),
+                                                 self._get_rate_limit(command, ""),
+                                                 overflow_mode,
+                                                 self._get_count(command, "OverflowAfter", 3),
+                                                 overflow_format))
+        return implementations
+
+
+def _read() -> Snapshot:
+    parser = configparser.ConfigParser()
+    parser.read(_config_file, encoding='utf-8')
+    return Snapshot(parser)
+
+_current = _read()
+_reload_lock = threading.Lock()
+_reload_listeners = []
+
+def current() -> Snapshot:
+    return _current
+
+def on_reload(listener):
+    """
+    Registers a function to be called with the new Snapshot on each reload. The listener should prepare
+    everything that can fail and return a function that takes the prepared state into use (or None), and
+    which is only called once every listener has prepared successfully.
+    """
+    _reload_listeners.append(listener)
+
+def reload() -> bool:
+    """
+    Rereads config.ini and swaps the new snapshot in. If the file is invalid or any reload listener fails
+    to prepare for it, the error is logged and the previous configuration stays in effect as a whole.
+
+    Returns:
+        bool: Whether the new configuration was taken into use.
+    """
+    return _reload(_read)
+
+def _reload(read) -> bool:
+    global _current
+    with _reload_lock:
+        try:
+            snapshot = read()
+            commits = [listener(snapshot) for listener in _reload_listeners]
+        except Exception as e:
+            logging.exception("Configuration not reloaded: " + str(e), exc_info=True)
+            return False
+        _current = snapshot
+        for commit in commits:
+            if commit is not None:
+                commit()
+    return True
+
+def watch(interval: float):
+    """
+    Reloads the configuration whenever the modification time of config.ini changes, polling every
+    interval seconds in a daemon thread.
+    """
+    def modified() -> float | None:
+        try:
+            return os.stat(_config_file).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def poll(last_modified: float | None):
+        while True:
+            sleep(interval)
+            modification = modified()
+            if modification != last_modified:
+                last_modified = modification
+                reload()
+
+    threading.Thread(target=poll, args=(modified(),), name="config-watcher", daemon=True).start()
+
+
+def get(category: str, variable: str) -> str | None:
+    return _current.get(category, variable)
+
+def get_boolean_or_false(category: str, variable: str) -> bool | None:
+    return _current.get_boolean_or_false(category, variable)
+
+def get_int(category: str, variable: str) -> int | None:
+    return _current.get_int(category, variable)
+
+def get_float(category: str, variable: str) -> float | None:
+    return _current.get_float(category, variable)
+
+def get_int_list(category: str, variable: str) -> list[int] | None:
+    return _current.get_int_list(category, variable)
+
+def get_or_default(category: str, variable: str, default: str) -> str:
+    return _current.get_or_default(category, variable, default)
+
+def get_or_throw(category: str, variable: str) -> str:
+    return _current.get_or_throw(category, variable)
+
+def get_key_value_pairs(category: str, variable: str) -> dict[str, any]:
+    return _current.get_key_value_pairs(category, variable)
 
 def read_query_implementations() -> list[Configuration]:
-    implementations = []
-    for command in _config.sections():
-        if command in _INTERNAL_SECTIONS:
-            continue
-        implementations.append(Configuration(command,
-                                             get_or_throw(command, "Api"),
-                                             get_or_throw(command, "Feature"),
-                                             get_or_throw(command, "Model"),
-                                             get_or_throw(command, "Url"),
-                                             get(command, "Token"),
-                                             get_boolean_or_false(command, "Stream"),
-                                             get_key_value_pairs(command, "Params")))
-    return implementations
\ No newline at end of file
+    return list(_current.queries)
@@ -0,0 +1,151 @@
+import logging
+import threading
+from time import monotonic
+
+from . import metrics
+
+# The stages a deadline may fire in
+CONNECT = "connect"
+FIRST_BYTE = "first_byte"
+IDLE = "idle"
+TOTAL = "total"
+
+
+class Deadlines:
+    """
+    The idle and total deadlines of one upstream request, enforced by a shared watchdog thread which calls
+    the callbacks registered with on_expire, e.g. interrupting the response, once either passes. The
+    connect and first byte deadlines are socket timeouts, given to requests by timeout().
+    """
+
+    def __init__(self, command: str | None, connect: float | None, first_byte: float | None, idle: float | None,
+                 total: float | None):
+        self.command = command
+        self.connect = connect
+        self.first_byte = first_byte
+        self.idle = idle
+        self.stage: str | None = None
+        self._total_at = monotonic() + total if total is not None else None
+        self._waiting_since: float | None = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._stopped = False
+        if self._total_at is not None:
+            _watch(self)
+
+    @property
+    def expired(self) -> bool:
+        return self.stage is not None
+
+    def timeout(self) -> tuple[float | None, float | None] | None:
+        """
+        Returns:
+            The timeout for requests: the connect timeout, and the read timeout, which as a socket timeout
+            also bounds the gaps in a stream and is thus never shorter than the idle deadline.
+        """
+        reads = [t for t in (self.first_byte, self.idle) if t is not None]
+        read = max(reads) if reads else None
+        if self.connect is None and read is None:
+            return None
+        return self.connect, read
+
+    def waiting(self):
+        """
+        Starts the idle deadline, for the time waiting for the next part of the response; the time spent
+        on the parts received doesn't count.
+        """
+        if self.idle is not None:
+            self._waiting_since = monotonic()
+            _watch(self)
+
+    def received(self):
+        self._waiting_since = None
+
+    def next_deadline(self) -> float | None:
+        # Read once, as the handling thread may change it meanwhile
+        waiting_since = self._waiting_since
+        idle_at = waiting_since + self.idle if waiting_since is not None else None
+        deadlines = [d for d in (self._total_at, idle_at) if d is not None]
+        return min(deadlines) if deadlines else None
+
+    def check(self, now: float) -> bool:
+        if self._stopped:
+            return False
+        if self._total_at is not None and now >= self._total_at:
+            return self.expire(TOTAL)
+        waiting_since = self._waiting_since
+        if waiting_since is not None and now >= waiting_since + self.idle:
+            return self.expire(IDLE)
+        return False
+
+    def expire(self, stage: str) -> bool:
+        with self._lock:
+            if self.stage is not None:
+                return False
+            self.stage = stage
+            callbacks, self._callbacks = self._callbacks, []
+        metrics.increment("upstream_timeouts", command=self.command, stage=stage)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.exception(str(e), exc_info=True)
+        return True
+
+    def on_expire(self, callback):
+        """
+        Registers a function to be called once a deadline passes, or calls it right away if one has.
+        """
+        with self._lock:
+            if self.stage is None:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def stop(self):
+        with _condition:
+            self._stopped = True
+            _watched.discard(self)
+
+
+_condition = threading.Condition()
+_watched: set[Deadlines] = set()
+_watchdog: threading.Thread | None = None
+# When the watchdog wakes up next, or None if it waits for a deadline to be registered
+_wake_at: float | None = None
+
+
+def _watch(deadlines: Deadlines):
+    global _watchdog
+    with _condition:
+        if deadlines._stopped:
+            return
+        _watched.add(deadlines)
+        if _watchdog is None:
+            _watchdog = threading.Thread(target=_run_watchdog, name="deadline-watchdog", daemon=True)
+            _watchdog.start()
+        # The watchdog is only woken up for a deadline before the one it waits for: an idle deadline pushed
+        # later, as on every line of a stream, is found not due yet when it wakes up and waited for again
+        deadline = deadlines.next_deadline()
+        if deadline is not None and (_wake_at is None or deadline < _wake_at):
+            _condition.notify()
+
+
+def _run_watchdog():
+    global _wake_at
+    while True:
+        with _condition:
+            while True:
+                now = monotonic()
+                upcoming = {d: d.next_deadline() for d in _watched}
+                due = [d for d, deadline in upcoming.items() if deadline is not None and deadline <= now]
+                if due:
+                    _watched.difference_update(due)
+                    break
+                deadlines = [deadline for deadline in upcoming.values() if deadline is not None]
+                _wake_at = min(deadlines) if deadlines else None
+                _condition.wait(_wake_at - now if deadlines else None)
+        for deadlines in due:
+            # The idle deadline may have moved on since it was last looked at
+            if not deadlines.check(monotonic()) and not deadlines.expired:
+                _watch(deadlines)
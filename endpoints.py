@@ -0,0 +1,277 @@
+import socket
+import threading
+from time import perf_counter, time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from . import metrics
+
+
+def interrupt(response: requests.Response):
+    """
+    Closes the response from another thread than the one reading it. Closing alone doesn't wake a read
+    blocked on the socket, so the socket is shut down first.
+    """
+    _shut_down(getattr(response.raw, "_connection", None))
+    response.close()
+
+
+def _shut_down(connection):
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class Interruption:
+    """
+    Lets another thread interrupt a request at any point, also before there is a response to close: the
+    sockets of the connections it takes are shut down, which ends a wait for the response as well as a
+    read of it.
+    """
+
+    def __init__(self):
+        self.interrupted = False
+        self.response: requests.Response | None = None
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def interrupt(self):
+        with self._lock:
+            self.interrupted = True
+            connections = list(self._connections)
+        for connection in connections:
+            _shut_down(connection)
+        if self.response is not None:
+            interrupt(self.response)
+
+    def session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = _InterruptibleAdapter(self)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _taken(self, connection):
+        with self._lock:
+            if self.interrupted:
+                raise requests.ConnectionError("Request interrupted")
+            self._connections.append(connection)
+
+
+class _InterruptibleAdapter(HTTPAdapter):
+    def __init__(self, interruption: Interruption):
+        self.interruption = interruption
+        super().__init__()
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        interruption = self.interruption
+
+        def pool_class(base):
+            class InterruptiblePool(base):
+                def _get_conn(self, timeout=None):
+                    connection = super()._get_conn(timeout)
+                    interruption._taken(connection)
+                    return connection
+            return InterruptiblePool
+
+        self.poolmanager.pool_classes_by_scheme = {"http": pool_class(HTTPConnectionPool),
+                                                   "https": pool_class(HTTPSConnectionPool)}
+
+
+class Endpoint:
+    def __init__(self, url: str, token: str | None, weight: float = 1.0):
+        self.url = url
+        self.token = token
+        self.weight = weight
+        self.in_flight = 0
+        self.ewma_latency: float | None = None
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+
+    def is_available(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def stats(self) -> dict[str, any]:
+        return {"url": self.url,
+                "weight": self.weight,
+                "in_flight": self.in_flight,
+                "ewma_latency": self.ewma_latency,
+                "requests": self.requests,
+                "failures": self.failures,
+                "ejections": self.ejections,
+                "ejected": not self.is_available(time())}
+
+
+class Lease:
+    """
+    An endpoint chosen for one request. It counts as in flight until released, and the outcome of the
+    request is reported back through succeeded or failed.
+    """
+
+    def __init__(self, pool: 'EndpointPool', endpoint: Endpoint):
+        self.pool = pool
+        self.endpoint = endpoint
+        self.started = perf_counter()
+        self.released = False
+
+    def succeeded(self):
+        self.pool._succeeded(self.endpoint, perf_counter() - self.started)
+
+    def failed(self):
+        self.pool._failed(self.endpoint)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.pool._release(self.endpoint)
+
+
+class EndpointPool:
+    """
+    Spreads the requests of one command over its endpoints. Each request goes to the available endpoint
+    with the fewest requests in flight relative to its weight ("least-in-flight"), or to the one with the
+    lowest expected latency given its load ("ewma"), where the latency is a moving average of the time to
+    the response headers. An endpoint without a measured latency yet is expected to be as fast as the
+    average of the others, or, if none has been measured, the endpoints are chosen by load alone.
+
+    An endpoint is ejected for eject_seconds after eject_after_errors consecutive connection errors or 5xx
+    responses. Afterwards it's given a request again, and ejected again on failure. If
+    health_check_interval is given and there is more than one endpoint, ejected endpoints are also probed
+    actively with a GET and readmitted once it answers with any status below 500, as endpoints serving only
+    POST requests answer a GET with 404 or 405. A failed probe leaves the ejection as it is.
+    """
+
+    LEAST_IN_FLIGHT = "least-in-flight"
+    EWMA = "ewma"
+    EWMA_WEIGHT = 0.3
+
+    def __init__(self, endpoints: list[Endpoint], balancing: str = LEAST_IN_FLIGHT, eject_after_errors: int = 3,
+                 eject_seconds: float = 30.0, health_check_interval: float | None = None):
+        if not endpoints:
+            raise ValueError("No endpoints")
+        if balancing not in (EndpointPool.LEAST_IN_FLIGHT, EndpointPool.EWMA):
+            raise ValueError(f"Unknown balancing {balancing!r}")
+        self.endpoints = endpoints
+        self.balancing = balancing
+        self.eject_after_errors = eject_after_errors
+        self.eject_seconds = eject_seconds
+        self._lock = threading.Lock()
+        self._rotation = 0
+        self._closed = threading.Event()
+        if health_check_interval and len(endpoints) > 1:
+            threading.Thread(target=self._check_health, args=(health_check_interval,),
+                             name="endpoint-health-check", daemon=True).start()
+
+    def acquire(self) -> Lease:
+        with self._lock:
+            endpoint = self._choose()
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+        return Lease(self, endpoint)
+
+    def post(self, url_suffix: str, headers, interruption: Interruption | None = None,
+             **kwargs) -> tuple[requests.Response, Lease]:
+        """
+        Posts to the chosen endpoint, with headers given as a function of the endpoint's token. The
+        returned lease must be released once the response has been consumed. With an interruption, the
+        request can be interrupted from another thread from the start; being interrupted doesn't count as
+        a failure of the endpoint.
+        """
+        lease = self.acquire()
+        try:
+            if interruption is None:
+                response = requests.post(lease.endpoint.url + url_suffix, headers=headers(lease.endpoint.token),
+                                         **kwargs)
+            else:
+                with interruption.session() as session:
+                    response = session.post(lease.endpoint.url + url_suffix,
+                                            headers=headers(lease.endpoint.token), **kwargs)
+                interruption.response = response
+        except requests.RequestException:
+            if interruption is None or not interruption.interrupted:
+                lease.failed()
+            lease.release()
+            raise
+        if response.status_code >= 500:
+            lease.failed()
+        else:
+            lease.succeeded()
+        return response, lease
+
+    def stats(self) -> list[dict[str, any]]:
+        with self._lock:
+            return [endpoint.stats() for endpoint in self.endpoints]
+
+    def close(self):
+        self._closed.set()
+
+    def _choose(self) -> Endpoint:
+        now = time()
+        available = [e for e in self.endpoints if e.is_available(now)]
+        if not available:
+            return min(self.endpoints, key=lambda e: e.ejected_until)
+        self._rotation += 1
+        n = len(available)
+        latencies = [e.ewma_latency for e in available if e.ewma_latency is not None]
+        default_latency = sum(latencies) / len(latencies) if latencies else 1.0
+        # The rotation breaks ties so that equally good endpoints take turns
+        return min(enumerate(available),
+                   key=lambda p: (self._score(p[1], default_latency), (p[0] - self._rotation) % n))[1]
+
+    def _score(self, endpoint: Endpoint, default_latency: float) -> float:
+        load = (endpoint.in_flight + 1) / endpoint.weight
+        if self.balancing == EndpointPool.EWMA:
+            return load * (endpoint.ewma_latency if endpoint.ewma_latency is not None else default_latency)
+        return load
+
+    def _succeeded(self, endpoint: Endpoint, latency: float):
+        with self._lock:
+            endpoint.consecutive_failures = 0
+            endpoint.ejected_until = 0.0
+            if endpoint.ewma_latency is None:
+                endpoint.ewma_latency = latency
+            else:
+                endpoint.ewma_latency += EndpointPool.EWMA_WEIGHT * (latency - endpoint.ewma_latency)
+
+    def _failed(self, endpoint: Endpoint):
+        with self._lock:
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= self.eject_after_errors:
+                self._eject(endpoint)
+
+    def _eject(self, endpoint: Endpoint):
+        if endpoint.is_available(time()):
+            endpoint.ejections += 1
+            metrics.increment("endpoint_ejections", url=endpoint.url)
+        endpoint.ejected_until = time() + self.eject_seconds
+
+    def _release(self, endpoint: Endpoint):
+        with self._lock:
+            endpoint.in_flight -= 1
+
+    def _check_health(self, interval: float):
+        while not self._closed.wait(interval):
+            now = time()
+            for endpoint in [e for e in self.endpoints if not e.is_available(now)]:
+                if EndpointPool._probe(endpoint):
+                    with self._lock:
+                        endpoint.consecutive_failures = 0
+                        endpoint.ejected_until = 0.0
+
+    @staticmethod
+    def _probe(endpoint: Endpoint) -> bool:
+        try:
+            with requests.get(endpoint.url, timeout=5, stream=True) as response:
+                return response.status_code < 500
+        except requests.RequestException:
+            return False
@@ -0,0 +1,33 @@
+import threading
+from collections import OrderedDict
+
+
+class FileIdCache:
+    """
+    The IDs Telegram has given to files already uploaded, by the hash of the content and the kind of
+    upload (a photo gets a different ID than the same bytes sent as a document). Sending a file by its ID
+    doesn't upload it again.
+    """
+
+    def __init__(self, size: int = 256):
+        self.size = size
+        self._ids: OrderedDict[tuple[bytes, str], str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest: bytes, kind: str) -> str | None:
+        with self._lock:
+            file_id = self._ids.get((digest, kind))
+            if file_id is not None:
+                self._ids.move_to_end((digest, kind))
+            return file_id
+
+    def put(self, digest: bytes, kind: str, file_id: str):
+        with self._lock:
+            self._ids[(digest, kind)] = file_id
+            self._ids.move_to_end((digest, kind))
+            if len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+
+    def discard(self, digest: bytes, kind: str):
+        with self._lock:
+            self._ids.pop((digest, kind), None)
@@ -2,7 +2,8 @@ import warnings
 
 from telebot import formatting
 
-from .parsing import Formatter, format, format_matches
+from .parsing import Formatter, format
+from functools import lru_cache
 import re
 
 
@@ -79,140 +80,195 @@ class ChainedPartitionFormatter(Formatter):
         return self.inner.format(s, affect_state, finalized)
 
 
-class MatchPartitionFormatter(Formatter):
-    def __init__(self, pattern):
-        self.pattern = pattern
+class LaTeXFormatter(PartitionFormatter):
+    """
+    Interprets LaTeX outside backticks as Unicode if pylatexenc is installed, and passes the text through
+    otherwise. pylatexenc is slow to import, so it is only imported on first use.
 
-    def in_format(self, s: str, match: re.Match) -> str:
-        return s
-
-    def out_format(self, s: str) -> str:
-        return s
-
-    def format(self, s: str, affect_state: bool = False, finalized: bool = False) -> str:
-        return format_matches(s, self.pattern, self.in_format, self.out_format)
-
-
-class IdentityFormatter(Formatter):
-    def format(self, s: str, affect_state: bool = False, finalized: bool = False) -> str:
-        return s
-
-
-try:
-    from pylatexenc.latex2text import LatexNodes2Text # type: ignore
-
-    class LaTeXFormatter(PartitionFormatter):
-        def __init__(self):
-            super().__init__("`", "`")
+    As the whole reply is formatted again on every update, the conversions are cached, and text without any
+    of the characters pylatexenc would interpret is not converted at all.
+    """
 
-        def in_format(self, s: str) -> str:
-            return "`" + s + "`"
-
-        def out_format(self, s: str) -> str:
-            return LatexNodes2Text(keep_comments=True).latex_to_text(s.replace("&", "\&"))
-
-    latex_formatter = LaTeXFormatter()
-except ImportError as e:
-    warnings.warn("LaTeX -> Unicode formatting not available", stacklevel=2)
-    latex_formatter = IdentityFormatter()
+    # Everything LatexNodes2Text changes: macros, math, &, braces, ~ and the ligatures '' -- and ``
+    LATEX_MARKERS = re.compile(r"[\\$&{}~]|''|--|``")
+    CACHE_SIZE = 1024
 
+    _latex_to_text = None
+    _available = True
 
-
-class EscapeFormatter(MatchPartitionFormatter):
     def __init__(self):
-        super().__init__(r"\[([^[]+)\]\((https?://[^)]+)\)") # link
-
-    def in_format(self, s: str, match: re.Match) -> str:
-        return formatting.mlink(match.group(1), match.group(2))
-
-    def out_format(self, s: str) -> str:
-        return formatting.escape_markdown(s)
-
-escape_formatter = EscapeFormatter()
-
-
-class CompoundFormatter(Formatter):
-    def __init__(self, *formatters: Formatter):
-        self.formatters = formatters
+        super().__init__("`", "`")
+
+    @classmethod
+    def _import(cls) -> bool:
+        if cls._latex_to_text is None and cls._available:
+            try:
+                from pylatexenc.latex2text import LatexNodes2Text # type: ignore
+                converter = LatexNodes2Text(keep_comments=True)
+                cls._latex_to_text = lru_cache(maxsize=cls.CACHE_SIZE)(
+                    lambda s: converter.latex_to_text(s.replace("&", "\\&")))
+            except ImportError:
+                warnings.warn("LaTeX -> Unicode formatting not available", stacklevel=2)
+                cls._available = False
+        return cls._available
 
     def format(self, s: str, affect_state: bool = False, finalized: bool = False) -> str:
-        for formatter in self.formatters:
-            s = formatter.format(s, affect_state, finalized)
-        return s
-
-
-class BoldFormatter(ChainedPartitionFormatter):
-    def __init__(self):
-        super().__init__(escape_formatter, "**", "**")
-
-    def in_format(self, s: str) -> str:
-        return formatting.mbold(s, escape=False)
-
-bold_formatter = BoldFormatter()
+        if not LaTeXFormatter._import():
+            return s
+        return super().format(s, affect_state, finalized)
 
-class H1Formatter(ChainedPartitionFormatter):
-    def __init__(self):
-        super().__init__(bold_formatter, "# ", "\n")
     def in_format(self, s: str) -> str:
-        if not self.previous_segment or self.previous_segment.endswith("\n"):
-            return "\n        __" + (s if '*' in s else "*" + s + "*") + "__\n\n"
-        return "\\# " + s + "\n"
-h1_formatter = H1Formatter()
+        return "`" + s + "`"
 
-class H2Formatter(ChainedPartitionFormatter):
-    def __init__(self):
-        super().__init__(h1_formatter, "## ", "\n")
-    def in_format(self, s: str) -> str:
-        if not self.previous_segment or self.previous_segment.endswith("\n"):
-            return "\n    __" + (s if '*' in s else "*" + s + "*") + "__\n\n"
-        return "\\#\\# " + s + "\n"
-h2_formatter = H2Formatter()
+    def out_format(self, s: str) -> str:
+        if not LaTeXFormatter.LATEX_MARKERS.search(s):
+            return s
+        return LaTeXFormatter._latex_to_text(s)
 
-class H3Formatter(ChainedPartitionFormatter):
-    def __init__(self):
-        super().__init__(h2_formatter, "### ", "\n")
-    def in_format(self, s: str) -> str:
-        if not self.previous_segment or self.previous_segment.endswith("\n"):
-            return "\n  __" + s + "__\n\n"
-        return "\\#\\#\\# " + s + "\n"
-h3_formatter = H3Formatter()
 
-class H4Formatter(ChainedPartitionFormatter):
-    def __init__(self):
-        super().__init__(h3_formatter, "#### ", "\n")
-    def in_format(self, s: str) -> str:
-        if not self.previous_segment or self.previous_segment.endswith("\n"):
-            return  "\n__" + s + "__\n\n"
-        return "\\#\\#\\#\\# " + s + "\n"
-h4_formatter = H4Formatter()
 
-class MonospaceFormatter(MatchPartitionFormatter):
-    def __init__(self):
-        super().__init__(r"`([^`\n]+)`")  # link
+class ReplyFormatter(Formatter):
+    """
+    Formats a reply as MarkdownV2: fenced code blocks, LaTeX outside backticks, inline code, headers, bold and
+    links. The code blocks are split off first and LaTeX converted between backticks, after which the rest is
+    tokenized by a single scan into inline code, header markers, line changes and runs of asterisks, and the
+    formatted text is rendered from the tokens. Headers nest from #### down to #, then bold, then links and
+    escaping, each level only splitting the text between the markers of the levels above.
 
-    def in_format(self, s: str, match: re.Match) -> str:
-        return f"`{formatting.escape_markdown(match.group(1))}`"
+    Only whether a code block is open is carried from one page of the reply to the next.
+    """
 
-    def out_format(self, s: str) -> str:
-        return h4_formatter.format(s)
-monospaceFormatter = MonospaceFormatter()
+    # Inline code, a header marker (a run of #'s and a space), a line change or a run of asterisks
+    TOKENS = re.compile(r"`([^`\n]+)`|(#+) |\n|\*\*+")
+    CODE_BLOCK = re.compile(r"^([^\s.]+\n)?(.*)$", flags=re.S)
+    LINK = re.compile(r"\[([^[]+)\]\((https?://[^)]+)\)")
+    # Headers at the start of a line, by level
+    HEADER_INDENTS = {1: "        ", 2: "    ", 3: "  ", 4: ""}
 
-class CodeFormatter(ChainedPartitionFormatter):
     def __init__(self):
-        super().__init__(monospaceFormatter, "```", "```", inside_not_chained=True)
-
-    @staticmethod
-    def substitute(m: re.Match[str]) -> str:
-        language = m.group(1) or ""
-        contents = m.group(2) or ""
-        return "```" + formatting.escape_markdown(language) + "\n" + formatting.escape_markdown(contents) + "\n```"
+        self.latex = LaTeXFormatter()
+        self.reset()
 
-    def in_format(self, s: str) -> str:
-        return re.sub("^([^\s.]+\n)?(.*)$", self.substitute, s, flags=re.S)
+    def reset(self):
+        self.code_inside = False
 
-    def out_format(self, s: str) -> str:
-        return latex_formatter.format(s)
+    def format(self, s: str, affect_state: bool = False, finalized: bool = False) -> str:
+        if not s or not s.strip():
+            return s
+        result = []
+        inside = self.code_inside
+        for segment in s.split("```"):
+            if not inside:
+                result.append(self._format_text(segment))
+            elif segment.strip():
+                result.append(self._format_code(segment))
+            else:
+                result.append(segment)
+            inside = not inside
+        if affect_state:
+            self.code_inside = not inside
+        return "".join(result)
 
+    def _format_code(self, s: str) -> str:
+        m = ReplyFormatter.CODE_BLOCK.match(s)
+        return "```" + formatting.escape_markdown(m.group(1) or "") + "\n" + formatting.escape_markdown(m.group(2)) \
+            + "\n```"
 
-class ReplyFormatter(CodeFormatter):
-    pass
+    def _convert_latex(self, s: str) -> str:
+        if not LaTeXFormatter._import() or not s.strip():
+            return s
+        parts = s.split("`")
+        return "".join(self.latex.out_format(part) if i % 2 == 0 else "`" + part + "`" for i, part in enumerate(parts))
+
+    def _format_text(self, s: str) -> str:
+        s = self._convert_latex(s)
+        result = []
+        start = 0
+        tokens = []
+        for token in ReplyFormatter.TOKENS.finditer(s):
+            if token.group(1) is None:
+                tokens.append(token)
+                continue
+            result.append(self._format_headers(s, start, token.start(), tokens, 4))
+            result.append("`" + formatting.escape_markdown(token.group(1)) + "`")
+            start = token.end()
+            tokens = []
+        result.append(self._format_headers(s, start, len(s), tokens, 4))
+        return "".join(result)
+
+    def _format_headers(self, s: str, start: int, end: int, tokens: list[re.Match], level: int) -> str:
+        """
+        Formats s[start:end], given the tokens in it, splitting it at the headers of the level: from a marker
+        of as many #'s to the line change.
+        """
+        if level == 0:
+            return self._format_bold(s, start, end, tokens)
+        if not s[start:end].strip():
+            return s[start:end]
+        result = []
+        inside = False
+        previous = ""
+        segment_tokens = []
+        for token in tokens:
+            if inside and token.group() == "\n":
+                result.append(self._format_header(s, start, token.start(), segment_tokens, level, previous))
+            elif not inside and token.group(2) is not None and len(token.group(2)) >= level:
+                # The marker is the last #'s of the run and the space, the rest of the run stays text
+                marker = token.end() - level - 1
+                result.append(self._format_headers(s, start, marker, segment_tokens, level - 1))
+                previous = s[start:marker]
+            else:
+                segment_tokens.append(token)
+                continue
+            start = token.end()
+            inside = not inside
+            segment_tokens = []
+        if inside:
+            result.append(self._format_header(s, start, end, segment_tokens, level, previous))
+        else:
+            result.append(self._format_headers(s, start, end, segment_tokens, level - 1))
+        return "".join(result)
+
+    def _format_header(self, s: str, start: int, end: int, tokens: list[re.Match], level: int, previous: str) -> str:
+        if not s[start:end].strip():
+            return s[start:end]
+        header = self._format_headers(s, start, end, tokens, level - 1)
+        if previous and not previous.endswith("\n"):
+            return "\\#" * level + " " + header + "\n"
+        if level <= 2 and "*" not in header:
+            header = "*" + header + "*"
+        return "\n" + ReplyFormatter.HEADER_INDENTS[level] + "__" + header + "__\n\n"
+
+    def _format_bold(self, s: str, start: int, end: int, tokens: list[re.Match]) -> str:
+        if not s[start:end].strip():
+            return s[start:end]
+        result = []
+        inside = False
+        for token in tokens:
+            if token.group(2) is not None or token.group() == "\n":
+                continue
+            # Each pair of asterisks from the start of the run toggles bold
+            for marker in range(token.start(), token.end() - 1, 2):
+                result.append(self._format_bold_segment(s, start, marker, inside))
+                start = marker + 2
+                inside = not inside
+        result.append(self._format_bold_segment(s, start, end, inside))
+        return "".join(result)
+
+    def _format_bold_segment(self, s: str, start: int, end: int, inside: bool) -> str:
+        if not inside:
+            return self._escape(s, start, end)
+        if not s[start:end].strip():
+            return s[start:end]
+        return formatting.mbold(self._escape(s, start, end), escape=False)
+
+    def _escape(self, s: str, start: int, end: int) -> str:
+        if "](" not in s[start:end]:
+            return formatting.escape_markdown(s[start:end])
+        result = []
+        for link in ReplyFormatter.LINK.finditer(s, start, end):
+            result.append(formatting.escape_markdown(s[start:link.start()]))
+            result.append(formatting.mlink(link.group(1), link.group(2)))
+            start = link.end()
+        result.append(formatting.escape_markdown(s[start:end]))
+        return "".join(result)
@@ -0,0 +1,62 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from . import config, metrics
+from .parsing import Formatter, divide_to_before_and_after_character_limit
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+def paginate_and_format(formatter: Formatter, text: str, limit: int, data_ended: bool,
+                        postfix: str) -> tuple[str, str, str, Formatter]:
+    """
+    Cuts the text to fit in a message once formatted, and formats it, with the postfix appended if the reply
+    continues. The formatter state is only affected if the message is complete, i.e. there is a remainder.
+
+    Returns:
+        tuple[str, str, str, Formatter]: The text that fits, the remainder, the formatted message and the
+        formatter in its new state.
+    """
+    text, remainder = divide_to_before_and_after_character_limit(text, limit, formatter)
+    if remainder == "":
+        formatted = formatter.format(text + ("" if data_ended else postfix), finalized=data_ended)
+    else:
+        formatted = formatter.format(text + postfix, affect_state=True, finalized=True)
+    return text, remainder, formatted, formatter
+
+
+def run(formatter: Formatter, text: str, limit: int, data_ended: bool, postfix: str) -> tuple[str, str, str, Formatter]:
+    """
+    Runs paginate_and_format in the pool of FormatterProcesses processes, if configured and the text is
+    at least FormatInlineBelow characters long, and on the calling thread otherwise. The formatter
+    returned from the pool is a copy, which the caller should use from then on.
+    """
+    pool = _get_pool()
+    if pool is None or len(text) < config.current().format_inline_below:
+        return paginate_and_format(formatter, text, limit, data_ended, postfix)
+    try:
+        result = pool.submit(paginate_and_format, formatter, text, limit, data_ended, postfix).result()
+    except Exception as e:
+        logging.exception("Formatting in the pool failed: " + str(e), exc_info=True)
+        metrics.increment("format_pool_failures")
+        return paginate_and_format(formatter, text, limit, data_ended, postfix)
+    metrics.increment("format_pool_jobs")
+    return result
+
+
+def _get_pool() -> ProcessPoolExecutor | None:
+    global _pool
+    if _pool is not None:
+        return _pool
+    processes = config.current().formatter_processes
+    if not processes:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # Forking a process with other threads running may leave locks held in the child
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context(method))
+        return _pool
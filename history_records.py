@@ -0,0 +1,141 @@
+import base64
+import zlib
+from time import monotonic
+from array import array
+from bisect import bisect_left
+
+# Shorter texts would hardly shrink, given the overhead of zlib and of the bytes object
+COMPRESS_MIN_BYTES = 256
+
+
+class Record:
+    """
+    One message in a conversation history. The text may be held compressed while the message isn't used,
+    and a message without images holds None rather than an empty list of its own.
+    """
+
+    __slots__ = ("_text", "images", "reply_to_id", "cost", "reached")
+
+    def __init__(self, text: str | None, images: list[bytes] | None, reply_to_id: int | None):
+        self._text = text
+        self.images = images if images else None
+        self.reply_to_id = reply_to_id
+        # The estimated size of the message for budgeting the context, computed when first needed
+        self.cost: tuple[int, int, int, int] | None = None
+        # When the message was last recorded or part of a reply chain walked, for compacting the history
+        self.reached = monotonic()
+
+    @property
+    def text(self) -> str | None:
+        if isinstance(self._text, bytes):
+            return zlib.decompress(self._text).decode("utf-8")
+        return self._text
+
+    @property
+    def compressed(self) -> bool:
+        return isinstance(self._text, bytes)
+
+    def compress(self) -> int:
+        """
+        Returns:
+            int: The number of bytes saved.
+        """
+        if not isinstance(self._text, str) or len(self._text) < COMPRESS_MIN_BYTES:
+            return 0
+        encoded = self._text.encode("utf-8")
+        compressed = zlib.compress(encoded)
+        if len(compressed) >= len(encoded):
+            return 0
+        self._text = compressed
+        return len(encoded) - len(compressed)
+
+    def decompress(self):
+        self._text = self.text
+
+    def size(self) -> int:
+        """
+        Returns:
+            int: The bytes taken by the text, as held, and the images.
+        """
+        text = len(self._text) if isinstance(self._text, bytes) else len(self._text.encode("utf-8")) if self._text else 0
+        return text + sum(len(image) for image in self.images or [])
+
+    def to_list(self) -> list[any]:
+        # The images are base64 in the serialized form, which is JSON
+        return [self.text, [base64.b64encode(image).decode("ascii") for image in self.images or []], self.reply_to_id]
+
+    @staticmethod
+    def from_list(l: list[any]) -> 'Record':
+        text, images, reply_to_id = l
+        return Record(text, [base64.b64decode(image) for image in images], reply_to_id)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Record) and (self.text, self.images, self.reply_to_id) \
+            == (other.text, other.images, other.reply_to_id)
+
+    def __repr__(self) -> str:
+        return f"Record({self.text!r}, {self.images!r}, {self.reply_to_id!r})"
+
+
+class AliasMap:
+    """
+    Maps message IDs to the ID they're an alias of, e.g. the later messages of a reply split over several
+    to the first one, in two sorted arrays of machine integers instead of a dict of int objects. As message
+    IDs mostly grow, new aliases are mostly appended.
+    """
+
+    __slots__ = ("_keys", "_values")
+
+    def __init__(self, items=()):
+        self._keys = array("q")
+        self._values = array("q")
+        for key, value in sorted(items):
+            self._keys.append(key)
+            self._values.append(value)
+
+    def _index(self, key: int) -> int:
+        keys = self._keys
+        if keys and key > keys[-1]:
+            return len(keys)
+        return bisect_left(keys, key)
+
+    def get(self, key: int, default: int | None = None) -> int | None:
+        i = self._index(key)
+        if i < len(self._keys) and self._keys[i] == key:
+            return self._values[i]
+        return default
+
+    def __setitem__(self, key: int, value: int):
+        i = self._index(key)
+        if i < len(self._keys) and self._keys[i] == key:
+            self._values[i] = value
+        else:
+            self._keys.insert(i, key)
+            self._values.insert(i, value)
+
+    def __delitem__(self, key: int):
+        i = self._index(key)
+        if i == len(self._keys) or self._keys[i] != key:
+            raise KeyError(key)
+        del self._keys[i]
+        del self._values[i]
+
+    def __contains__(self, key: int) -> bool:
+        i = self._index(key)
+        return i < len(self._keys) and self._keys[i] == key
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def items(self):
+        return zip(self._keys, self._values)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, AliasMap):
+            return self._keys == other._keys and self._values == other._values
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"AliasMap({dict(self.items())!r})"
@@ -0,0 +1,113 @@
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import puremagic
+
+from . import config, metrics
+
+CACHE_SIZE = 128
+# Enough of the start of an image for its type to be told
+_MAGIC_BYTES = 64
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+_cache: OrderedDict[tuple, bytes] = OrderedDict()
+_cache_lock = threading.Lock()
+_available = True
+
+
+def ingest(data: bytes, max_dimension: int | None, quality: int | None, image_format: str | None) -> bytes:
+    """
+    Scales the image down to at most max_dimension pixels wide and high and recompresses it in the given
+    format and quality, if any of them is given and Pillow is installed. The work is done in a process pool
+    so that it doesn't hold the GIL, and the results are cached by the hash of the source image.
+
+    Returns:
+        bytes: The recompressed image, or the original if it would not be any smaller or couldn't be read.
+        An image in a format that can't be read is remembered as such in the cache.
+    """
+    if max_dimension is None and quality is None and image_format is None:
+        return data
+    if not _import():
+        return data
+
+    key = (hashlib.sha256(data).digest(), max_dimension, quality, image_format)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+            metrics.increment("image_ingest_cache_hits")
+            return cached
+
+    from PIL import UnidentifiedImageError # type: ignore
+    try:
+        result = _get_pool().submit(transcode, data, max_dimension, quality, image_format).result()
+    except UnidentifiedImageError as e:
+        # E.g. an animated sticker, which can't be recompressed, so it's passed through from now on
+        logging.warning("Image not recompressed, its format isn't supported: %s", e)
+        metrics.increment("image_ingest_unsupported")
+        result = data
+    except Exception as e:
+        logging.exception("Image not recompressed: " + str(e), exc_info=True)
+        return data
+    else:
+        metrics.increment("image_ingest_bytes_saved", len(data) - len(result))
+
+    with _cache_lock:
+        _cache[key] = result
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
+
+
+def mime_type(data: bytes) -> str:
+    return puremagic.from_string(bytes(memoryview(data)[:_MAGIC_BYTES]), mime=True)
+
+
+def transcode(data: bytes, max_dimension: int | None, quality: int | None, image_format: str | None) -> bytes:
+    from PIL import Image # type: ignore
+
+    with Image.open(io.BytesIO(data)) as image:
+        source_format = image.format
+        target_format = (image_format or source_format or "JPEG").upper()
+        if max_dimension is not None:
+            # Lets JPEG decode straight into a smaller size
+            image.draft("RGB", (max_dimension, max_dimension))
+            image.thumbnail((max_dimension, max_dimension))
+        if target_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, format=target_format, quality=quality or 85)
+
+    if len(output.getbuffer()) >= len(data) and target_format == source_format:
+        return data
+    return output.getvalue()
+
+
+def _import() -> bool:
+    global _available
+    if _available:
+        try:
+            import PIL # type: ignore
+        except ImportError:
+            warnings.warn("Image recompression not available without Pillow", stacklevel=3)
+            _available = False
+    return _available
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Forking a process with other threads running may leave locks held in the child
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool = ProcessPoolExecutor(config.get_int("TelegramBot", "ImageWorkers") or min(4, os.cpu_count() or 1),
+                                        mp_context=multiprocessing.get_context(method))
+        return _pool
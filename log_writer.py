@@ -0,0 +1,112 @@
+import atexit
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+from time import time, strftime, localtime
+
+
+class BufferedLogWriter:
+    """
+    Writes records as JSON lines to a file from a background thread, so that the callers only pay for a
+    queue insertion. The queued records are written in batches, and flushed at least every flush_interval
+    seconds. If max_bytes or rotate_seconds is given, the file is renamed with a timestamp suffix once it
+    grows too large or old, and the renamed segment is gzipped if compress is set.
+    """
+
+    _STOP = object()
+
+    def __init__(self, filename: str, flush_interval: float = 1.0, max_bytes: int | None = None,
+                 rotate_seconds: float | None = None, compress: bool = False):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.compress = compress
+        self._queue = queue.SimpleQueue()
+        self._file = None
+        self._opened_at = 0.0
+        self._thread = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def write(self, record: dict[str, any]):
+        if self._thread is None:
+            self._start()
+        self._queue.put(record)
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(BufferedLogWriter._STOP)
+            self._thread.join()
+            self._thread = None
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"log-writer:{self.filename}", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+                while True:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            # A write racing close may have queued records after the sentinel, which are written too
+            if any(record is BufferedLogWriter._STOP for record in batch):
+                batch = [record for record in batch if record is not BufferedLogWriter._STOP]
+                stopping = True
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                logging.exception(str(e), exc_info=True)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write_batch(self, batch: list[dict[str, any]]):
+        if batch:
+            if self._file is None:
+                self._open()
+            lines = []
+            for record in batch:
+                # A record that can't be serialized is dropped alone rather than with its batch
+                try:
+                    lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+                except (TypeError, ValueError) as e:
+                    logging.error("Log record not written to %s: %s", self.filename, e)
+            self._file.write("".join(lines))
+            self._file.flush()
+        if self._file is not None and self._rotation_due():
+            self._rotate()
+
+    def _open(self):
+        self._file = open(self.filename, "a", encoding="utf-8")
+        self._opened_at = time()
+
+    def _rotation_due(self) -> bool:
+        if self.max_bytes is not None and self._file.tell() >= self.max_bytes:
+            return True
+        return self.rotate_seconds is not None and time() - self._opened_at >= self.rotate_seconds
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        segment = f"{self.filename}.{strftime('%Y%m%d-%H%M%S', localtime(self._opened_at))}"
+        suffix = 1
+        while os.path.exists(segment) or os.path.exists(segment + ".gz"):
+            segment = f"{self.filename}.{strftime('%Y%m%d-%H%M%S', localtime(self._opened_at))}.{suffix}"
+            suffix += 1
+        os.replace(self.filename, segment)
+        if self.compress:
+            with open(segment, "rb") as src, gzip.open(segment + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(segment)
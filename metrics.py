@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+import threading
+from time import sleep, time
+
+from . import config
+
+
+_lock = threading.Lock()
+_counters: dict[str, float] = {}
+_observations: dict[str, list[float]] = {}
+_collectors = {}
+
+
+def _key(name: str, labels: dict[str, any]) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+
+def increment(name: str, amount: float = 1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def observe(name: str, value: float, **labels):
+    """
+    Records a sample, e.g. a duration, of which the count, sum and maximum are kept.
+    """
+    key = _key(name, labels)
+    with _lock:
+        observation = _observations.get(key)
+        if observation is None:
+            _observations[key] = [1, value, value]
+        else:
+            observation[0] += 1
+            observation[1] += value
+            observation[2] = max(observation[2], value)
+
+def register_collector(name: str, collector):
+    """
+    Registers a function returning the current state of some component, to be included in the snapshot
+    under the given name. A collector registered with an existing name replaces the previous one.
+    """
+    with _lock:
+        _collectors[name] = collector
+
+def unregister_collector(name: str, collector):
+    with _lock:
+        if _collectors.get(name) == collector:
+            del _collectors[name]
+
+def snapshot() -> dict[str, any]:
+    with _lock:
+        counters = dict(_counters)
+        observations = {k: {"count": c, "sum": s, "max": m} for k, (c, s, m) in _observations.items()}
+        collectors = dict(_collectors)
+    collected = {}
+    for name, collector in collectors.items():
+        try:
+            collected[name] = collector()
+        except Exception as e:
+            logging.exception(str(e), exc_info=True)
+    return {"time": time(), "counters": counters, "observations": observations, "collected": collected}
+
+
+def write(filename: str, metrics: dict[str, any]):
+    temporary = filename + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(metrics, f, indent=2)
+    os.replace(temporary, filename)
+
+def start_export():
+    """
+    Writes the snapshot to MetricsLog every MetricsInterval seconds (60 by default), if configured.
+    """
+    filename = config.get("TelegramBot", "MetricsLog")
+    if not filename:
+        return
+    interval = config.get_float("TelegramBot", "MetricsInterval") or 60.0
+
+    def export():
+        while True:
+            sleep(interval)
+            try:
+                write(filename, snapshot())
+            except Exception as e:
+                logging.exception(str(e), exc_info=True)
+
+    threading.Thread(target=export, name="metrics-export", daemon=True).start()
@@ -0,0 +1,112 @@
+import base64
+import json
+import uuid
+
+# Encoded a multiple of 3 bytes at a time, so that the pieces concatenate into the encoding of the whole
+_CHUNK_BYTES = 3 * 64 * 1024
+
+
+def base64_length(data: bytes) -> int:
+    return (len(data) + 2) // 3 * 4
+
+
+class Base64:
+    """
+    Stands for an image in an object to be sent as JSON, as its base64 encoding following the prefix. The
+    image is encoded piece by piece as the request is sent instead of as a whole up front.
+    """
+
+    __slots__ = ("data", "prefix")
+
+    def __init__(self, data: bytes, prefix: str = ""):
+        self.data = data
+        self.prefix = prefix
+
+    def __len__(self) -> int:
+        return len(self.prefix) + base64_length(self.data)
+
+    def chunks(self):
+        if self.prefix:
+            yield self.prefix.encode("ascii")
+        view = memoryview(self.data)
+        for start in range(0, len(view), _CHUNK_BYTES):
+            yield base64.b64encode(view[start:start + _CHUNK_BYTES])
+
+
+class JsonBody:
+    """
+    A JSON request body read as a file by requests, with the Base64 images in it encoded as they're read.
+    It has a length, so it's sent with Content-Length rather than chunked.
+    """
+
+    def __init__(self, parts: list[bytes | Base64]):
+        self._parts = parts
+        self._length = sum(len(part) for part in parts)
+        self.seek(0)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self):
+        for part in self._parts:
+            if isinstance(part, Base64):
+                yield from part.chunks()
+            else:
+                yield part
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._position += len(data)
+        return data
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        # Only rewinding is supported, for requests to send the body again
+        if offset != 0 or whence != 0:
+            raise OSError("JsonBody can only be rewound")
+        self._chunks = iter(self)
+        self._buffer = bytearray()
+        self._position = 0
+        return 0
+
+    def getvalue(self) -> bytes:
+        return b"".join(self)
+
+
+def dumps(obj: any) -> str | JsonBody:
+    """
+    Serializes the object as JSON, the same as json.dumps, but if it contains Base64 images, as a JsonBody
+    encoding them while sent.
+    """
+    images = []
+    marker = uuid.uuid4().hex
+
+    def placeholder(o):
+        if not isinstance(o, Base64):
+            raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+        images.append(o)
+        return f"{marker}{len(images) - 1}{marker}"
+
+    serialized = json.dumps(obj, default=placeholder)
+    if not images:
+        return serialized
+
+    parts = []
+    pieces = serialized.split(marker)
+    # The pieces alternate between the JSON around the images and the indices of the images
+    for i, piece in enumerate(pieces):
+        if i % 2 == 0:
+            parts.append(piece.encode("utf-8"))
+        else:
+            parts.append(images[int(piece)])
+    return JsonBody(parts)
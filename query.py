@@ -4,95 +4,305 @@ from telebot.formatting import escape_markdown, mcite  # type: ignore
 
 from .config import Configuration, Feature
 from .parsing import Formatter
+from .endpoints import Endpoint, EndpointPool
+from .concurrency import FairLimiter
 from .formatters import ReplyFormatter
-from . import config
+from .history_records import AliasMap, Record
+from .payload import base64_length
+from . import config, metrics
 import json
+import os
 import re
+import sys
+import threading
 from enum import auto, Flag, Enum
+from time import monotonic
+
+
+# Rough figures for budgeting the context, as the actual tokenization depends on the model
+BYTES_PER_TOKEN = 4
+IMAGE_TOKEN_ESTIMATE = 768
+
+def estimate_tokens(text_bytes: int) -> int:
+    return (text_bytes + BYTES_PER_TOKEN - 1) // BYTES_PER_TOKEN
 
 
 class Query:
     class History:
+        """
+        The conversation history of one chat. Each history has a lock of its own, so the messages of a chat
+        may be handled in parallel with those of others without waiting for them, and the file of a
+        persistent history is written after the lock is released.
+        """
+
         def __init__(self, query: 'Query', history_printer, chat_id: int):
             self.query = query
             self.history_printer = history_printer
-            self._history = {}
-            self.id_table = {}
+            self._history: dict[int, Record] = {}
+            self.id_table = AliasMap()
             self.chat_id = chat_id
+            self._lock = threading.RLock()
+            # Messages used since the previous compression, whose texts are thus kept uncompressed
+            self._touched: set[int] = set()
+            self._last_compression = monotonic()
+            # Writes may finish out of order, so each is numbered to keep an older one from replacing a newer
+            self._version = 0
+            self._written_version = 0
+            self._write_lock = threading.Lock()
             self._register_file_caching()
             self._load()
 
-        def record(self, text: str | None, message_ids: list[int], reply_to_id: int | None, images_base64: list[str] = None):
-            for message_id in message_ids:
-                if message_id != message_ids[0]:
-                    self.id_table[message_id] = message_ids[0]
-            if images_base64 is None:
-                images_base64 = []
-            self._history[message_ids[0]] = self.query.transform_reply_for_history(text), images_base64, reply_to_id
-            self._save()
+        def record(self, text: str | None, message_ids: list[int], reply_to_id: int | None, images: list[bytes] = None):
+            text = self.query.transform_reply_for_history(text)
+            compress_after = config.current().history_compress_after
+            with self._lock:
+                for message_id in message_ids:
+                    if message_id != message_ids[0]:
+                        self.id_table[message_id] = message_ids[0]
+                self._history[message_ids[0]] = Record(text, images, reply_to_id)
+                if compress_after is not None:
+                    self._touched.add(message_ids[0])
+                    self._compress_cold(compress_after)
+                if self._filename is None:
+                    return
+                self._version += 1
+                version = self._version
+                serialized = Query.History.serialize(self)
+            self._save(serialized, version)
+
+        def _compress_cold(self, interval: float):
+            now = monotonic()
+            if now - self._last_compression < interval:
+                return
+            self._last_compression = now
+            saved = 0
+            for message_id, record in self._history.items():
+                if message_id not in self._touched:
+                    saved += record.compress()
+            self._touched.clear()
+            if saved:
+                metrics.increment("history_bytes_compressed", saved)
+
+        def compact(self, retention: float) -> tuple[int, int, int]:
+            """
+            Drops the messages that aren't part of any reply chain recorded or walked within the last
+            retention seconds, along with their images and the aliases of their IDs, and rewrites the file
+            of a persistent history.
+
+            Returns:
+                tuple[int, int, int]: The numbers of messages and aliases dropped, and the bytes of texts and
+                images freed.
+            """
+            cutoff = monotonic() - retention
+            with self._lock:
+                kept = set()
+                for message_id, record in self._history.items():
+                    if record.reached < cutoff:
+                        continue
+                    # The messages replied to are kept with the message, as they're part of its chain
+                    while message_id not in kept and record is not None:
+                        kept.add(message_id)
+                        if record.reply_to_id is None:
+                            break
+                        message_id = self._normalize_id(record.reply_to_id)
+                        record = self._history.get(message_id)
+                dropped = [message_id for message_id in self._history if message_id not in kept]
+                if not dropped:
+                    return 0, 0, 0
+                freed = sum(self._history[message_id].size() for message_id in dropped)
+                for message_id in dropped:
+                    del self._history[message_id]
+                aliases = len(self.id_table)
+                self.id_table = AliasMap((alias, message_id) for alias, message_id in self.id_table.items()
+                                         if message_id in kept)
+                aliases -= len(self.id_table)
+                self._touched.intersection_update(kept)
+                if self._filename is None:
+                    return len(dropped), aliases, freed
+                self._version += 1
+                version = self._version
+                serialized = Query.History.serialize(self)
+            self._save(serialized, version)
+            return len(dropped), aliases, freed
 
         def _normalize_id(self, message_id: int) -> int:
             tabled = self.id_table.get(message_id, None)
             return tabled if tabled is not None else message_id
 
         def get(self, reply_to_id):
+            with self._lock:
+                if self.query.context_tokens is None and self.query.context_bytes is None:
+                    l = self._walk(reply_to_id)
+                else:
+                    l = self._walk_within_budget(reply_to_id)
+            return self.history_printer(l)
+
+        def _next(self, reply_to_id: int) -> tuple[int, Record | None]:
+            message_id = self._normalize_id(reply_to_id)
+            record = self._history.get(message_id)
+            if record is not None:
+                record.reached = monotonic()
+            if record is not None and config.current().history_compress_after is not None:
+                self._touched.add(message_id)
+                if record.compressed:
+                    record.decompress()
+            return message_id, record
+
+        def _walk(self, reply_to_id) -> list[tuple[str, str | None, list[bytes]]]:
             l = []
-            role = self.query.get_user_role()
+            user, assistant = self.query.get_roles()
+            role = user
             while reply_to_id is not None:
-                text, images_base64, reply_to_id = self._history.get(self._normalize_id(reply_to_id), ("", None, None))
-                if text != "":
-                    l.append((role, text, images_base64))
-                    role = self.query.get_user_role() if role == self.query.get_assistant_role() else self.query.get_assistant_role()
+                _, record = self._next(reply_to_id)
+                if record is None:
+                    break
+                reply_to_id = record.reply_to_id
+                if record.text != "":
+                    l.append((role, record.text, record.images or []))
+                    role = user if role is assistant else assistant
             l.reverse()
-            return self.history_printer(l)
+            return l
+
+        def _walk_within_budget(self, reply_to_id) -> list[tuple[str, str | None, list[bytes]]]:
+            """
+            Walks the reply chain from the newest message for as long as the messages fit in the context
+            budget of the query. The images of the older messages are left out first, and then the older
+            messages themselves, while the newest message is always included.
+            """
+            max_tokens = self.query.context_tokens
+            max_bytes = self.query.context_bytes
+            tokens = 0
+            size = 0
+            images_left_out = False
+            truncated = False
+            l = []
+
+            def fits(more_tokens: int, more_bytes: int) -> bool:
+                return not l or ((max_tokens is None or tokens + more_tokens <= max_tokens)
+                                 and (max_bytes is None or size + more_bytes <= max_bytes))
+
+            user, assistant = self.query.get_roles()
+            role = user
+            while reply_to_id is not None:
+                _, record = self._next(reply_to_id)
+                if record is None:
+                    break
+                reply_to_id = record.reply_to_id
+                text = record.text
+                if text == "":
+                    continue
+                message_images = record.images or []
+                text_tokens, text_bytes, image_tokens, image_bytes = self._cost(record, text)
+                if message_images and (images_left_out or not fits(text_tokens + image_tokens, text_bytes + image_bytes)):
+                    images_left_out = True
+                    message_images = []
+                    image_tokens = image_bytes = 0
+                if not fits(text_tokens + image_tokens, text_bytes + image_bytes):
+                    truncated = True
+                    break
+                tokens += text_tokens + image_tokens
+                size += text_bytes + image_bytes
+                l.append((role, text, message_images))
+                role = user if role is assistant else assistant
+            if truncated:
+                metrics.increment("context_truncations", command=self.query.command)
+                # The context starts with a prompt, as some APIs require
+                if len(l) > 1 and l[-1][0] is assistant:
+                    l.pop()
+            l.reverse()
+            return l
+
+        @staticmethod
+        def _cost(record: Record, text: str | None) -> tuple[int, int, int, int]:
+            # Cached in the record, as budgeting walks the same chains repeatedly
+            if record.cost is None:
+                text_bytes = len(text.encode("utf-8")) if text else 0
+                images = record.images or []
+                # Images are sent base64 encoded
+                record.cost = (estimate_tokens(text_bytes), text_bytes,
+                               IMAGE_TOKEN_ESTIMATE * len(images), sum(base64_length(image) for image in images))
+            return record.cost
 
         @staticmethod
         def serialize(history: 'Query.History') -> str:
-            return json.dumps(history.id_table) + '|' + json.dumps(history._history)
+            return json.dumps(dict(history.id_table.items())) + '|' \
+                + json.dumps({message_id: record.to_list() for message_id, record in history._history.items()})
 
         @staticmethod
-        def deserialize(serialized: str) -> tuple[dict[int, tuple[any]], dict[int, list[int]]]:
+        def deserialize(serialized: str) -> tuple[dict[int, Record], AliasMap]:
             id_table, history = serialized.split('|', maxsplit=1)
-            return {int(k): tuple(v) for k, v in json.loads(history).items()}, {int(k): v for k, v in json.loads(id_table).items()}
+            return {int(k): Record.from_list(v) for k, v in json.loads(history).items()}, \
+                AliasMap((int(k), v) for k, v in json.loads(id_table).items())
 
         def _unique_identifier(self) -> str:
             return f'{self.query.__class__.__name__}_{self.query.command}_{self.chat_id}'
 
-        def _register_file_caching(self):
-            cacheable_chat_ids = config.get_int_list("TelegramBot", "ChatIDFilterForPersistentHistory")
+        def _register_file_caching(self, snapshot: config.Snapshot | None = None):
+            cacheable_chat_ids = (snapshot or config.current()).persistent_history_chat_ids
             if not self.query.transient_history and cacheable_chat_ids is not None and self.chat_id in cacheable_chat_ids:
-                filename = f'{self._unique_identifier()}.history'
-                def save():
-                    with open(filename, 'w+') as f:
-                        f.write(Query.History.serialize(self))
-                def load():
-                    try:
-                        with open(filename) as f:
-                            self._history, self.id_table = Query.History.deserialize(f.read())
-                    except FileNotFoundError:
-                        pass
-                self._save = save
-                self._load = load
+                self._filename = f'{self._unique_identifier()}.history'
             else:
-                self._save = lambda : None
-                self._load = lambda : None
-
-    def __init__(self, formatter: Formatter = ReplyFormatter(), transient_history: bool = False):
+                self._filename = None
+
+        def _save(self, serialized: str, version: int):
+            with self._write_lock:
+                if version <= self._written_version:
+                    return
+                # Replacing the file whole, so that it's never left partly written
+                temporary = self._filename + '.tmp'
+                with open(temporary, 'w') as f:
+                    f.write(serialized)
+                os.replace(temporary, self._filename)
+                self._written_version = version
+
+        def _load(self):
+            if self._filename is None:
+                return
+            try:
+                with open(self._filename) as f:
+                    history, id_table = Query.History.deserialize(f.read())
+            except FileNotFoundError:
+                return
+            with self._lock:
+                self._history, self.id_table = history, id_table
+
+    def __init__(self, formatter_factory=None, transient_history: bool = False):
         self.command = None
         self.model = None
         self.url = None
         self.token = None
         self.stream = False
         self.params = None
+        self.endpoints: EndpointPool | None = None
+        self.limiter: FairLimiter | None = None
+        self.queue_timeout = None
+        self.context_tokens: int | None = None
+        self.context_bytes: int | None = None
+        self.image_max_dimension: int | None = None
+        self.image_quality: int | None = None
+        self.image_format: str | None = None
+        self.connect_timeout: float | None = None
+        self.first_byte_timeout: float | None = None
+        self.idle_timeout: float | None = None
+        self.total_timeout: float | None = None
+        self.retries = 0
+        self.overflow_mode = "messages"
+        self.overflow_after = 3
+        self.overflow_format = "md"
         self.output_types = None
-        self.formatter = formatter
+        # Each reply is formatted with a formatter of its own, as the formatters keep state
+        self.formatter_factory = formatter_factory if formatter_factory is not None else ReplyFormatter
         self.transient_history = transient_history
         self._history_printer = self.history_printer
         self._histories: dict[int, Query.History] = {}
+        self._histories_lock = threading.Lock()
 
     def history_printer(self, l):
         raise NotImplementedError
 
+    def new_formatter(self) -> Formatter:
+        return self.formatter_factory()
+
     def get_data(self, chat_id: int, reply_to_id: int) -> any:
         raise NotImplementedError
 
@@ -111,19 +321,60 @@ class Query:
     def is_configured(self):
         return self.command and self.url and self.model
 
+    def has_tokens(self) -> bool:
+        return self.endpoints is not None and all(e.token for e in self.endpoints.endpoints)
+
     def get_history(self, chat_id: int) -> History:
         history = self._histories.get(chat_id, None)
         if history is None:
-            history = Query.History(self, self._history_printer, chat_id)
-            self._histories[chat_id] = history
+            with self._histories_lock:
+                history = self._histories.get(chat_id, None)
+                if history is None:
+                    history = Query.History(self, self._history_printer, chat_id)
+                    self._histories[chat_id] = history
         return history
 
+    def compact_histories(self, retention: float) -> tuple[int, int, int]:
+        """
+        Compacts the history of each chat, see History.compact.
+        """
+        with self._histories_lock:
+            histories = list(self._histories.values())
+        totals = (0, 0, 0)
+        for history in histories:
+            totals = tuple(total + reclaimed for total, reclaimed in zip(totals, history.compact(retention)))
+        return totals
+
+    def adopt(self, previous: 'Query', snapshot: config.Snapshot):
+        """
+        Takes over the conversation histories and the concurrency limiter of a previous instance of the
+        same query, which is being replaced due to a configuration reload into the given snapshot.
+        """
+        self.adopt_histories(previous, snapshot)
+        if self.limiter is not None and previous.limiter is not None:
+            # Keeps counting the requests still running on the previous instance against the limit
+            previous.limiter.resize(self.limiter.max_concurrent)
+            self.limiter = previous.limiter
+            previous.limiter = None
+
+    def adopt_histories(self, previous: 'Query', snapshot: config.Snapshot):
+        self._histories = previous._histories
+        self._histories_lock = previous._histories_lock
+        for history in self._histories.values():
+            history.query = self
+            history.history_printer = self._history_printer
+            history._register_file_caching(snapshot)
+
     def transform_reply_for_history(self, reply: str | None) -> str | None:
         return reply
 
     def get_user_role(self):
         return "user"
 
+    def get_roles(self) -> tuple[str, str]:
+        # Interned, so that the roles of all messages are the same two objects and can be compared by identity
+        return sys.intern(self.get_user_role()), sys.intern(self.get_assistant_role())
+
     def get_assistant_role(self):
         return "assistant"
 
@@ -133,8 +384,9 @@ class Query:
     def get_content_type(self) -> 'ContentType':
         return ContentType.JSON
 
-    def get_headers(self):
-        h = {"Authorization": f"Bearer {self.token}"} if self.token else {}
+    def get_headers(self, token: str | None = None):
+        token = token if token is not None else self.token
+        h = {"Authorization": f"Bearer {token}"} if token else {}
         if self.get_content_type() == ContentType.FORM:
             return h
         return {"Content-Type": self.get_content_type().value} | h
@@ -146,7 +398,38 @@ class Query:
         self.token = configuration.token
         self.stream = configuration.stream
         self.params = configuration.params
+        self.endpoints = EndpointPool([Endpoint(e.url, e.token, e.weight) for e in configuration.endpoints],
+                                      configuration.balancing, configuration.eject_after_errors,
+                                      configuration.eject_seconds, configuration.health_check_interval)
         self.output_types = Output.from_feature(configuration.feature)
+        if configuration.max_concurrent:
+            self.limiter = FairLimiter(configuration.max_concurrent)
+            self.queue_timeout = configuration.queue_timeout
+        self.context_tokens = configuration.context_tokens
+        self.context_bytes = configuration.context_bytes
+        self.image_max_dimension = configuration.image_max_dimension
+        self.image_quality = configuration.image_quality
+        self.image_format = configuration.image_format
+        self.connect_timeout = configuration.connect_timeout
+        self.first_byte_timeout = configuration.first_byte_timeout
+        self.idle_timeout = configuration.idle_timeout
+        self.total_timeout = configuration.total_timeout
+        self.retries = configuration.retries
+        self.overflow_mode = configuration.overflow_mode
+        self.overflow_after = configuration.overflow_after
+        self.overflow_format = configuration.overflow_format
+
+    def register_metrics(self):
+        metrics.register_collector(f"endpoints:{self.command}", self.endpoints.stats)
+        if self.limiter is not None:
+            metrics.register_collector(f"queue:{self.command}", self.limiter.stats)
+
+    def close(self):
+        if self.endpoints is not None:
+            self.endpoints.close()
+            metrics.unregister_collector(f"endpoints:{self.command}", self.endpoints.stats)
+        if self.limiter is not None:
+            metrics.unregister_collector(f"queue:{self.command}", self.limiter.stats)
 
 
 class TextGenQuery(Query):
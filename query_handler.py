@@ -1,15 +1,26 @@
 import base64
-from time import time, sleep
+import hashlib
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, time, sleep
 
 import requests
 from requests import Response
-from telebot import TeleBot
+from telebot import TeleBot, apihelper
+from telebot.apihelper import ApiTelegramException
+from urllib3.exceptions import ReadTimeoutError
 from telebot.formatting import escape_markdown, mcite
 from telebot.types import Message
 
-from AIProxyTelegramBot import config, texts, util
-from AIProxyTelegramBot.parsing import divide_to_before_and_after_character_limit
-from AIProxyTelegramBot.query import Query, Output, ContentType
+from . import cancellation, config, deadlines, formatting_pool, images, metrics, recording, retries, texts, \
+    tracing, util
+from .cancellation import Generation
+from .deadlines import Deadlines
+from .parsing import divide_to_before_and_after_character_limit
+from .query import Query, Output, ContentType
+from .endpoints import Interruption, Lease
+from .file_ids import FileIdCache
 
 # Telegram limitations:
 MAX_CHARACTERS_PER_MESSAGE = 4096
@@ -17,48 +28,140 @@ MIN_SECONDS_PER_UPDATE = 3
 
 CONTINUATION_PREFIX = "...\n"
 CONTINUATION_POSTFIX = "\n..."
+# The end of a reply shown while it's written to a document
+OVERFLOW_PREVIEW_CHARACTERS = 1000
+
+# Uploads running alongside the one on the handling thread
+_uploads = ThreadPoolExecutor(thread_name_prefix="upload")
+# Placeholders sent while the upstream request starts
+_placeholders = ThreadPoolExecutor(thread_name_prefix="placeholder")
+file_ids = FileIdCache()
 
 class QueryHandler:
-    def __init__(self, bot: TeleBot, msg: Message, query: Query):
+    def __init__(self, bot: TeleBot, msg: Message, query: Query, generation: Generation):
         self.bot = bot
         self.msg = msg
         self.query = query
-        self.query.formatter.reset()
+        self.generation = generation
+        self.formatter = query.new_formatter()
         self.total_message = ""
         self.total_reply = ""
         self.image = None
-        self.image_base64 = None
         self.data_ended = False
-        self.messages_left = int(config.get_or_default("TelegramBot", "MaxMessagesPerReply", "9999"))
-        self.initial_bot_msg = self.send_message(escape_markdown(texts.please_wait))
-        self.last_bot_msg = self.initial_bot_msg
-        self.sent_message_ids = [self.last_bot_msg.id]
+        self.messages_left = config.current().max_messages_per_reply
+        self.initial_bot_msg = None
+        self.last_bot_msg = None
+        self.sent_message_ids = []
+        self.queue_position_shown = False
+        self.reply_shown = False
+        self.overflowed = False
+        # The placeholder is sent in the background, and skipped if something else is shown before it's sent
+        self._placeholder_lock = threading.Lock()
+        self._placeholder_started = False
+        self._placeholder_skipped = threading.Event()
+        self._placeholder = _placeholders.submit(self._send_placeholder, config.current().placeholder_delay)
+
+    def _send_placeholder(self, delay: float):
+        if delay > 0 and self._placeholder_skipped.wait(delay):
+            return
+        with self._placeholder_lock:
+            if self._placeholder_skipped.is_set():
+                return
+            self._placeholder_started = True
+        self._send_first_message(escape_markdown(texts.please_wait))
+
+    def _send_first_message(self, message: str):
+        self.initial_bot_msg = self.send_message(message)
+        self.sent_message_ids.append(self.initial_bot_msg.id)
+
+    def _placeholder_shown(self) -> bool:
+        """
+        Waits for the placeholder if it's being sent, or skips it if it hasn't been started yet.
+
+        Returns:
+            bool: Whether the placeholder was sent, for it to be edited.
+        """
+        with self._placeholder_lock:
+            if not self._placeholder_started:
+                if not self._placeholder_skipped.is_set():
+                    self._placeholder_skipped.set()
+                    metrics.increment("placeholders_skipped", command=self.query.command)
+                return self.initial_bot_msg is not None
+        with tracing.span("placeholder_wait"):
+            self._placeholder.result()
+        return True
 
-    def send_message(self, message: str) -> Message:
-        self.last_bot_msg = self.bot.send_message(self.msg.chat.id, message, reply_to_message_id=self.msg.id)
-        self.messages_left -= 1
-        return self.last_bot_msg
+    def placeholder_pending(self) -> bool:
+        return not self._placeholder_started and not self._placeholder_skipped.is_set()
 
-    def send_photo(self, image) -> Message:
-        self.last_bot_msg = self.bot.send_photo(self.msg.chat.id, image, reply_to_message_id=self.msg.id)
-        self.messages_left -= 1
-        return self.last_bot_msg
+    def skip_placeholder(self):
+        """
+        Keeps the placeholder from being sent once the reply has ended otherwise.
+        """
+        with self._placeholder_lock:
+            self._placeholder_skipped.set()
 
-    def send_document(self, document) -> Message:
-        self.last_bot_msg = self.bot.send_document(self.msg.chat.id, document, reply_to_message_id=self.msg.id)
+    def send_message(self, message: str) -> Message:
+        with tracing.span("send_message"):
+            self.last_bot_msg = retries.telegram("send_message", self.bot.send_message, self.msg.chat.id, message,
+                                                 reply_to_message_id=self.msg.id)
+        self.generation.reply_ids.add(self.last_bot_msg.id)
         self.messages_left -= 1
         return self.last_bot_msg
 
+    def send_file(self, kind: str, content: bytes, digest: bytes) -> Message:
+        """
+        Sends the content as a photo or a document, by the file ID of an earlier upload of the same content
+        if there is one. Meant to be called concurrently, so the state of the handler is left as is.
+        """
+        send = self.bot.send_photo if kind == "photo" else self.bot.send_document
+        file_id = file_ids.get(digest, kind)
+        if file_id is not None:
+            try:
+                message = retries.telegram(f"send_{kind}", send, self.msg.chat.id, file_id,
+                                           reply_to_message_id=self.msg.id)
+                metrics.increment("uploads_deduplicated", kind=kind)
+                return message
+            except ApiTelegramException:
+                # The ID is no longer valid, so the content is uploaded again
+                file_ids.discard(digest, kind)
+        message = retries.telegram(f"send_{kind}", send, self.msg.chat.id, content, reply_to_message_id=self.msg.id)
+        uploaded = message.photo[-1] if kind == "photo" else message.document
+        if uploaded is not None:
+            file_ids.put(digest, kind, uploaded.file_id)
+        return message
+
     def edit_last_message(self, message: str):
-        self.bot.edit_message_text(message, self.msg.chat.id, self.last_bot_msg.message_id)
+        if not self._placeholder_shown():
+            self._send_first_message(message)
+            return
+        with tracing.span("edit_message_text"):
+            retries.telegram("edit_message_text", self.bot.edit_message_text, message, self.msg.chat.id,
+                             self.last_bot_msg.message_id, idempotent=True)
+
+    def show_queue_position(self, position: int):
+        self.edit_last_message(escape_markdown(texts.queued.replace("{position}", str(position))))
+        self.queue_position_shown = True
+
+    def end_queueing(self):
+        if self.queue_position_shown:
+            self.edit_last_message(escape_markdown(texts.please_wait))
+
+    def show_cancelled(self):
+        # A partial reply already shown is left as is
+        if not self.reply_shown:
+            self.edit_last_message(escape_markdown(texts.cancelled))
 
     def delete_initial_message(self):
-        self.bot.delete_message(self.msg.chat.id, self.initial_bot_msg.message_id)
+        if not self._placeholder_shown():
+            return
+        retries.telegram("delete_message", self.bot.delete_message, self.msg.chat.id, self.initial_bot_msg.message_id,
+                         idempotent=True)
 
-    def record_history(self, message=None, image_base64=None):
+    def record_history(self, message=None, image=None):
         if not self.query.transient_history:
-            images_base64 = [image_base64] if image_base64 is not None else []
-            self.query.get_history(self.msg.chat.id).record(message, self.sent_message_ids, self.msg.id, images_base64)
+            reply_images = [image] if image is not None else []
+            self.query.get_history(self.msg.chat.id).record(message, self.sent_message_ids, self.msg.id, reply_images)
 
     def register_text_reply(self, line) -> bool:
         response = self.query.get_response_text(line)
@@ -76,49 +179,100 @@ class QueryHandler:
             return False
 
         limit = MAX_CHARACTERS_PER_MESSAGE - len(escape_markdown(CONTINUATION_POSTFIX))
-        self.total_message, remainder = divide_to_before_and_after_character_limit(self.total_message, limit,
-                                                                                   self.query.formatter)
-
+        if not self.overflowed and self.query.overflow_mode == "document":
+            # The messages still to be sent for the text so far, which is at least escaped to be this long,
+            # counting the current one unless it has been sent already, e.g. as the placeholder
+            more_messages = -(-len(self.total_message) // limit) - (1 if self._placeholder_shown() else 0)
+            self.overflowed = len(self.sent_message_ids) + more_messages > self.query.overflow_after \
+                or more_messages >= self.messages_left
+        if self.overflowed:
+            return self.process_overflowed_reply()
+
+        with tracing.span("format"):
+            self.total_message, remainder, formatted, self.formatter = formatting_pool.run(
+                self.formatter, self.total_message, limit, self.data_ended, CONTINUATION_POSTFIX)
+
+        self.reply_shown = True
+        self.edit_last_message(formatted)
         if remainder == "":
-            message_text = self.total_message + ("" if self.data_ended else CONTINUATION_POSTFIX)
-            self.edit_last_message(self.query.formatter.format(message_text, finalized=self.data_ended))
-            if self.data_ended:
-                return False
-        else:
-            message_text = self.total_message + CONTINUATION_POSTFIX
-            self.edit_last_message(self.query.formatter.format(message_text, affect_state=True, finalized=True))
-
-            if self.messages_left == 1:
-                self.send_message(escape_markdown(texts.thats_enough))
-                return False
-
-            self.send_message(escape_markdown(texts.to_be_continued))
-            self.sent_message_ids.append(self.last_bot_msg.id)
-            self.total_message = CONTINUATION_PREFIX + remainder
+            return not self.data_ended
+
+        if self.messages_left == 1:
+            self.send_message(escape_markdown(texts.thats_enough))
+            return False
 
+        self.send_message(escape_markdown(texts.to_be_continued))
+        self.sent_message_ids.append(self.last_bot_msg.id)
+        self.total_message = CONTINUATION_PREFIX + remainder
         return True
 
+    def process_overflowed_reply(self) -> bool:
+        """
+        Shows the end of the reply in the current message, and once the reply has ended, sends it whole as
+        a document.
+        """
+        tail = self.total_reply[-OVERFLOW_PREVIEW_CHARACTERS:]
+        if len(tail) < len(self.total_reply):
+            tail = CONTINUATION_PREFIX + tail
+        self.reply_shown = True
+        if not self.data_ended:
+            self.edit_last_message(escape_markdown(tail + "\n\n" + texts.writing_document))
+            return True
+
+        with tracing.span("send_document"):
+            document = retries.telegram("send_document", self.bot.send_document, self.msg.chat.id,
+                                        self.total_reply.encode("utf-8"), reply_to_message_id=self.msg.id,
+                                        visible_file_name=f"reply_{self.msg.id}.{self.query.overflow_format}")
+        metrics.increment("replies_sent_as_document", command=self.query.command)
+        self.generation.reply_ids.add(document.id)
+        self.messages_left -= 1
+        self.edit_last_message(escape_markdown(tail + "\n\n" + texts.sent_as_document))
+        self.sent_message_ids.append(document.id)
+        return False
+
     def register_image_reply(self, line) -> bool:
         response = self.query.get_response_image_base64(line)
         if response is None:
-            self.image_base64 = None
             self.image = None
             return False
-        self.image_base64 = response
+        # The only decode of the image, which is held as bytes from here on
         self.image = base64.b64decode(response)
         return True
 
     def process_image_reply(self):
-        if not self.image_base64:
+        if not self.image:
             return
-        photo_id = self.send_document(self.image)
-        photo_compressed_id = self.send_photo(self.image)
-        self.sent_message_ids.append(photo_id.id)
-        self.sent_message_ids.append(photo_compressed_id.id)
+        # The placeholder is waited for if it's being sent, so that it isn't sent after the image
+        self._placeholder_shown()
+        self.reply_shown = True
+        digest = hashlib.sha256(self.image).digest()
+        with tracing.span("send_image"):
+            document = _uploads.submit(self.send_file, "document", self.image, digest)
+            photo_msg = self.send_file("photo", self.image, digest)
+            document_msg = document.result()
+        for sent in (document_msg, photo_msg):
+            self.last_bot_msg = sent
+            self.generation.reply_ids.add(sent.id)
+            self.messages_left -= 1
+            self.sent_message_ids.append(sent.id)
 
 
 def handle(bot: TeleBot, prompt: str, msg: Message, query: Query):
+    with tracing.trace(msg.chat.id, query.command):
+        _handle(bot, prompt, msg, query)
+
+
+def _handle(bot: TeleBot, prompt: str, msg: Message, query: Query):
+    start_time = time()
+    queue_wait = 0.0
+    generation_start_time = None
     r = None
+    lease = None
+    limiter = None
+    handler = None
+    timeouts = None
+    generation = cancellation.start(msg.chat.id, msg.id, query.command,
+                                    msg.from_user.id if msg.from_user else None)
     try:
         if msg.reply_to_message and msg.reply_to_message.any_text and msg.reply_to_message.from_user.id != bot.user.id:
             prompt = mcite(msg.reply_to_message.any_text) + "\n" + prompt
@@ -127,21 +281,57 @@ def handle(bot: TeleBot, prompt: str, msg: Message, query: Query):
         read_reply_to_image = True
         if msg.reply_to_message and history.get(msg.reply_to_message.id) != []:
             read_reply_to_image = False
-        images_base64 = get_message_images(bot, msg, read_reply_to_image)
-        history.record(prompt, [msg.id], msg.reply_to_message.id if msg.reply_to_message else None, images_base64)
+        with tracing.span("get_message_images"):
+            prompt_images = get_message_images(bot, msg, query, read_reply_to_image)
+        with tracing.span("record_history"):
+            history.record(prompt, [msg.id], msg.reply_to_message.id if msg.reply_to_message else None, prompt_images)
+
+        # Sends the placeholder while the request is made
+        handler = QueryHandler(bot, msg, query, generation)
+
+        # Read once, as a reload hands the limiter over to the new instance of the query meanwhile
+        query_limiter = query.limiter
+        if query_limiter is not None:
+            queued_at = time()
+            generation.on_cancel(query_limiter.interrupt)
+            with tracing.span("queue"):
+                admitted = query_limiter.acquire(msg.chat.id, query.queue_timeout, handler.show_queue_position,
+                                                 MIN_SECONDS_PER_UPDATE, lambda: generation.cancelled)
+            queue_wait = time() - queued_at
+            metrics.observe("queue_wait_seconds", queue_wait, command=query.command)
+            if generation.cancelled:
+                handler.show_cancelled()
+                return
+            if not admitted:
+                metrics.increment("queue_timeouts", command=query.command)
+                handler.edit_last_message(escape_markdown(texts.too_busy))
+                return
+            limiter = query_limiter
+            handler.end_queueing()
 
-        handler = QueryHandler(bot, msg, query)
+        if generation.cancelled:
+            handler.show_cancelled()
+            return
 
-        r = http_post(msg, query)
-        r.encoding = 'utf-8'
+        generation_start_time = time()
+        timeouts = Deadlines(query.command, query.connect_timeout, query.first_byte_timeout, query.idle_timeout,
+                             query.total_timeout)
+        upstream = request_upstream(msg, query, timeouts, generation)
+        if upstream is None:
+            handler.show_cancelled()
+            return
+        r, lease, it = upstream
 
         last_update_time = time()
         parsing_caused_error = False
         raw = ""
-        it = r.iter_lines(decode_unicode=True) if query.stream else iter([r.text])
         output_sent = False
         while True:
-            line = next(it, None)
+            with tracing.span("upstream_read"):
+                line = read_line(it, timeouts, generation)
+            if generation.cancelled:
+                handler.show_cancelled()
+                return
             handler.data_ended = line is None
             if not handler.data_ended:
                 if not line:
@@ -152,12 +342,13 @@ def handle(bot: TeleBot, prompt: str, msg: Message, query: Query):
                     continue
                 try:
                     has_output_to_process = False
-                    if Output.TEXT in query.output_types:
-                        if handler.register_text_reply(line):
-                            has_output_to_process = True
-                    if Output.IMAGE in query.output_types:
-                        if handler.register_image_reply(line):
-                            has_output_to_process = True
+                    with tracing.span("parse"):
+                        if Output.TEXT in query.output_types:
+                            if handler.register_text_reply(line):
+                                has_output_to_process = True
+                        if Output.IMAGE in query.output_types:
+                            if handler.register_image_reply(line):
+                                has_output_to_process = True
                     if not has_output_to_process:
                         continue
                 except:
@@ -169,8 +360,12 @@ def handle(bot: TeleBot, prompt: str, msg: Message, query: Query):
                 handler.total_message = raw
                 error_occurred = True
 
-            if time() - last_update_time <= MIN_SECONDS_PER_UPDATE:
-                continue
+            # Nothing shown yet means nothing to rate limit against, so the reply may replace the placeholder
+            if time() - last_update_time <= MIN_SECONDS_PER_UPDATE and not handler.placeholder_pending():
+                if not handler.data_ended:
+                    continue
+                # Nothing is left to read, so the rest of the interval is slept rather than spun through
+                sleep(max(0.0, last_update_time + MIN_SECONDS_PER_UPDATE - time()))
 
             in_progress = False
             sent_text = None
@@ -181,8 +376,8 @@ def handle(bot: TeleBot, prompt: str, msg: Message, query: Query):
                     sent_text = handler.total_reply
             if Output.IMAGE in query.output_types:
                 handler.process_image_reply()
-                sent_image = handler.image_base64
-                handler.image_base64 = None
+                sent_image = handler.image
+                handler.image = None
 
             output_sent_this_iteration = False
             if sent_text or sent_image:
@@ -191,16 +386,17 @@ def handle(bot: TeleBot, prompt: str, msg: Message, query: Query):
 
             if not error_occurred:
                 if output_sent_this_iteration:
-                    handler.record_history(message=sent_text, image_base64=sent_image)
+                    handler.record_history(message=sent_text, image=sent_image)
                 if sent_text:
-                    util.log_reply(query.command, query.model, sent_text, msg.chat.id)
+                    util.log_reply(query.command, query.model, sent_text, msg.chat.id, time() - start_time, queue_wait)
 
             if not in_progress:
                 if handler.data_ended:
                     if output_sent and not sent_text:
                         handler.delete_initial_message()
                     if not output_sent and not error_occurred:
-                        bot.send_message(msg.chat.id, escape_markdown(texts.empty_reply))
+                        retries.telegram("send_message", bot.send_message, msg.chat.id,
+                                         escape_markdown(texts.timed_out if timeouts.expired else texts.empty_reply))
                 return
 
             if handler.data_ended:
@@ -209,29 +405,137 @@ def handle(bot: TeleBot, prompt: str, msg: Message, query: Query):
             last_update_time = time()
 
     except Exception as e:
+        if generation.cancelled:
+            if handler is not None:
+                handler.show_cancelled()
+            return
+        if handler is not None:
+            handler.skip_placeholder()
         error, _ = divide_to_before_and_after_character_limit(escape_markdown(str(e)), MAX_CHARACTERS_PER_MESSAGE)
         bot.send_message(msg.chat.id, error)
         raise e
     finally:
+        cancellation.finish(generation)
+        if handler is not None:
+            handler.skip_placeholder()
+        if timeouts:
+            timeouts.stop()
         if r:
             r.close()
-
-
-def http_post(msg: Message, query: Query) -> Response:
-    if query.get_content_type() == ContentType.FORM:
-        return requests.post(query.url + query.get_url_suffix(), files=query.get_data(msg.chat.id, msg.id), headers=query.get_headers(), stream=query.stream)
-
-    return requests.post(query.url + query.get_url_suffix(), data=query.get_data(msg.chat.id, msg.id), headers=query.get_headers(), stream=query.stream)
-
-
-def get_message_images(bot: TeleBot, msg: Message, read_reply_to_image: bool) -> list[str]:
-    images_base64 = []
+        if lease:
+            lease.release()
+        if limiter:
+            limiter.release()
+        if generation_start_time is not None:
+            metrics.observe("generation_seconds", time() - generation_start_time, command=query.command)
+
+
+def request_upstream(msg: Message, query: Query, timeouts: Deadlines,
+                     generation: Generation) -> tuple[Response, Lease, any] | None:
+    """
+    Posts the request and reads the first line of the response, retrying up to Retries times on
+    connection errors and retryable statuses, as long as nothing of the response has been received.
+
+    Returns:
+        The response, its lease and the lines of the response, or None if cancelled meanwhile.
+    """
+    snapshot = config.current()
+    attempt = 0
+    while True:
+        r, lease = None, None
+        requested_at = perf_counter()
+        # Interrupting the request from the cancelling or watchdog thread ends the wait for the response or
+        # the read in progress
+        interruption = Interruption()
+        generation.on_cancel(interruption.interrupt)
+        timeouts.on_expire(interruption.interrupt)
+        try:
+            r, lease = http_post(msg, query, timeouts, interruption)
+            r.encoding = 'utf-8'
+            if r.status_code in retries.RETRYABLE_STATUSES and attempt < query.retries:
+                reason = str(r.status_code)
+            else:
+                if r.status_code in retries.RETRYABLE_STATUSES and attempt > 0:
+                    metrics.increment("upstream_give_ups", command=query.command, reason=str(r.status_code))
+                it = r.iter_lines(decode_unicode=True) if query.stream else iter([r.text])
+                it = recording.stream(it, query.command, r.status_code, requested_at)
+                first = read_line(it, timeouts, generation)
+                return r, lease, itertools.chain([first], it)
+        except requests.RequestException as e:
+            if generation.cancelled:
+                _release(r, lease)
+                return None
+            if isinstance(e, requests.Timeout) or timeouts.expired or attempt >= query.retries:
+                _release(r, lease)
+                if attempt > 0:
+                    metrics.increment("upstream_give_ups", command=query.command, reason="connection")
+                raise
+            reason = "connection"
+        _release(r, lease)
+        metrics.increment("upstream_retries", command=query.command, reason=reason)
+        sleep(retries.backoff(attempt, snapshot))
+        attempt += 1
+        if generation.cancelled:
+            return None
+
+
+def _release(r: Response | None, lease: Lease | None):
+    if r is not None:
+        r.close()
+    if lease is not None:
+        lease.release()
+
+
+def read_line(it, timeouts: Deadlines, generation: Generation) -> str | None:
+    """
+    Returns:
+        The next line of the response, or None once it has ended or a deadline has passed.
+    """
+    timeouts.waiting()
+    try:
+        line = next(it, None)
+    except Exception as e:
+        # A gap in the stream longer than the socket timeout
+        if isinstance(e, requests.ConnectionError) and e.args and isinstance(e.args[0], ReadTimeoutError):
+            timeouts.expire(deadlines.IDLE)
+        if not timeouts.expired or generation.cancelled:
+            raise
+        # What was received so far is kept as the reply
+        line = None
+    timeouts.received()
+    return line
+
+
+def http_post(msg: Message, query: Query, timeouts: Deadlines, interruption: Interruption) -> tuple[Response, Lease]:
+    with tracing.span("get_data"):
+        data = query.get_data(msg.chat.id, msg.id)
+
+    with tracing.span("http_post"):
+        try:
+            if query.get_content_type() == ContentType.FORM:
+                return query.endpoints.post(query.get_url_suffix(), query.get_headers, interruption, files=data,
+                                            stream=query.stream, timeout=timeouts.timeout())
+
+            return query.endpoints.post(query.get_url_suffix(), query.get_headers, interruption, data=data,
+                                        stream=query.stream, timeout=timeouts.timeout())
+        except requests.ConnectTimeout:
+            timeouts.expire(deadlines.CONNECT)
+            raise
+        except requests.ReadTimeout:
+            timeouts.expire(deadlines.FIRST_BYTE)
+            raise
+
+
+def get_message_images(bot: TeleBot, msg: Message, query: Query, read_reply_to_image: bool) -> list[bytes]:
+    message_images = []
     images_url = get_message_images_url(bot, msg, read_reply_to_image)
     for image_url in images_url:
-        r = requests.get(image_url)
+        r = requests.get(image_url, timeout=(apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT))
         if r.ok:
-            images_base64.append(base64.b64encode(r.content).decode('utf-8'))
-    return images_base64
+            with tracing.span("image_ingest"):
+                message_images.append(images.ingest(r.content, query.image_max_dimension, query.image_quality,
+                                                    query.image_format))
+    return message_images
 
 
 def get_message_images_url(bot: TeleBot, msg: Message, read_reply_to_image: bool) -> list[str]:
@@ -0,0 +1,94 @@
+from . import api_impl, config, metrics
+from .query import Query, ApiImplementations
+
+import importlib
+import logging
+import threading
+from time import sleep
+
+
+class QueryImplementations:
+    """
+    The configured queries, replaced as a whole on configuration reload. Replies in progress keep using
+    the Query instances they started with, while the conversation histories carry over to the new ones.
+    """
+
+    def __init__(self, implementations: list[Query]):
+        self.current = implementations
+        for query in implementations:
+            query.register_metrics()
+
+    def reload(self, snapshot: config.Snapshot):
+        """
+        Builds the queries of the new configuration, raising if any of them can't be, and returns the
+        function that swaps them in.
+        """
+        implementations = get_query_implementations(snapshot)
+
+        def commit():
+            previous = {(q.__class__, q.command): q for q in self.current}
+            for query in implementations:
+                if (query.__class__, query.command) in previous:
+                    query.adopt(previous[(query.__class__, query.command)], snapshot)
+            replaced = self.current
+            self.current = implementations
+            for query in replaced:
+                query.close()
+            for query in implementations:
+                query.register_metrics()
+
+        return commit
+
+
+def start_compaction(query_implementations: QueryImplementations):
+    """
+    Compacts the histories of the queries every HistoryCompactInterval seconds, dropping the messages not
+    reached within HistoryRetention seconds, if configured.
+    """
+    def compact():
+        while True:
+            sleep(config.current().history_compact_interval)
+            retention = config.current().history_retention
+            if retention is None:
+                continue
+            for query in query_implementations.current:
+                try:
+                    messages, aliases, freed = query.compact_histories(retention)
+                except Exception as e:
+                    logging.exception(str(e), exc_info=True)
+                    continue
+                if messages:
+                    metrics.increment("history_messages_compacted", messages, command=query.command)
+                    metrics.increment("history_aliases_compacted", aliases, command=query.command)
+                    metrics.increment("history_bytes_reclaimed", freed, command=query.command)
+                    logging.info(f"Compacted the histories of {query.command}: {messages} messages, {aliases} aliases, "
+                                 f"{freed} bytes")
+
+    threading.Thread(target=compact, name="history-compaction", daemon=True).start()
+
+
+def get_api_modules(snapshot: config.Snapshot) -> list[str]:
+    modules = []
+    for configuration in snapshot.queries:
+        module = api_impl.MODULES.get(configuration.api)
+        if module is None:
+            return api_impl.__all__
+        if module not in modules:
+            modules.append(module)
+    return modules
+
+
+def get_query_implementations(snapshot: config.Snapshot) -> list[Query]:
+    query_implementations = []
+    api_implementations = ApiImplementations()
+
+    for module in get_api_modules(snapshot):
+        api = importlib.import_module(f'..api_impl.{module}', package=__name__)
+        api.bind(api_implementations)
+
+    for configuration in snapshot.queries:
+        impl = api_implementations.get(configuration.api, configuration.feature)
+        impl.configure(configuration)
+        query_implementations.append(impl)
+
+    return query_implementations
@@ -0,0 +1,98 @@
+import hashlib
+import os
+from time import perf_counter
+
+from telebot.types import Message # type: ignore
+
+from . import config
+from .log_writer import BufferedLogWriter
+from .sharding import per_shard
+
+_record_log = config.get("TelegramBot", "RecordLog")
+_writer = BufferedLogWriter(per_shard(_record_log)) if _record_log else None
+# A key of the process only, so that the IDs in a trace can't be traced back to the users and chats
+_key = os.urandom(16)
+_origin = perf_counter()
+
+
+def enabled() -> bool:
+    return _writer is not None
+
+
+def anonymise(id: int | None) -> int | None:
+    """
+    Returns:
+        int | None: The ID replaced by a keyed hash, the same for the same ID throughout the trace.
+    """
+    if id is None:
+        return None
+    return int.from_bytes(hashlib.blake2b(str(id).encode("ascii"), key=_key, digest_size=6).digest(), "big")
+
+
+def _now() -> float:
+    return round(perf_counter() - _origin, 4)
+
+
+def update(msg: Message, command: str, prompt: str):
+    """
+    Records a message addressed to the AI configuration, with the lengths of its texts in place of them.
+    """
+    if _writer is None:
+        return
+    photo = max(msg.photo, key=lambda p: p.width * p.height) if msg.photo else None
+    reply_to = msg.reply_to_message
+    _writer.write({"type": "update",
+                   "t": _now(),
+                   "edited": msg.edit_date is not None,
+                   "chat": anonymise(msg.chat.id),
+                   "chat_type": msg.chat.type,
+                   "user": anonymise(msg.from_user.id if msg.from_user else None),
+                   "message": anonymise(msg.id),
+                   "reply_to": anonymise(reply_to.id) if reply_to else None,
+                   "command": command,
+                   "prompt_length": len(prompt),
+                   "photo": [photo.width, photo.height] if photo else None})
+
+
+def stream(lines, command: str, status: int, requested_at: float):
+    """
+    Returns:
+        The lines of an upstream response, recording the gap before each and its length once they've been
+        read, or the lines as they are if recording is off.
+    """
+    if _writer is None:
+        return lines
+    return _recorded_stream(lines, command, status, requested_at)
+
+
+def _recorded_stream(lines, command: str, status: int, requested_at: float):
+    chunks = []
+    last = requested_at
+    try:
+        for line in lines:
+            now = perf_counter()
+            chunks.append([round(now - last, 4), len(line)])
+            last = now
+            yield line
+    finally:
+        _writer.write({"type": "stream",
+                       "t": round(requested_at - _origin, 4),
+                       "command": command,
+                       "status": status,
+                       "chunks": chunks})
+
+
+def telegram(method: str, started: float, result: any = None, error: str | None = None):
+    """
+    Records the latency of a Telegram API call, and the message it sent, for replies to it to be replayed.
+    """
+    if _writer is None:
+        return
+    chat = getattr(result, "chat", None)
+    _writer.write({"type": "telegram",
+                   "t": round(started - _origin, 4),
+                   "method": method,
+                   "latency": round(perf_counter() - started, 4),
+                   "error": error,
+                   "chat": anonymise(chat.id) if chat is not None else None,
+                   "message": anonymise(result.id) if chat is not None else None})
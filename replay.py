@@ -0,0 +1,407 @@
+"""
+Replays a trace written per RecordLog through the bot, against fake Telegram and upstream servers on
+localhost, and reports the throughput, the latency percentiles and the CPU time of the bot:
+
+    python -m AIProxyTelegramBot.replay trace.jsonl [--speed 10] [--config config.ini]
+
+The updates are fed at the pace they were recorded at, divided by the speed, as are the gaps of the
+upstream streams and the latencies of the Telegram API. Each AI configuration in the trace is served as
+an OpenAI compatible stream of lines as long as the ones recorded; the rest of its settings are taken from
+the configuration as is, so that builds and settings can be compared on the same traffic.
+"""
+import argparse
+import configparser
+import io
+import json
+import os
+import random
+import re
+import threading
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, process_time, sleep, time
+from urllib.parse import parse_qs, urlsplit
+
+from telebot import TeleBot, apihelper # type: ignore
+from telebot.types import Update # type: ignore
+
+from . import bot, config, recording
+
+_TOKEN = "1:replay"
+_BOT_USER = {"id": 1, "is_bot": True, "first_name": "replay", "username": "replay_bot"}
+_FILLER = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore "
+           "et dolore magna aliqua ") * 64
+_STREAM_PREFIX = 'data: {"choices":[{"delta":{"content":"'
+_STREAM_SUFFIX = '"}}]}'
+
+
+def _snake_case(method: str) -> str:
+    return re.sub(r"(?<!^)([A-Z])", r"_\1", method).lower()
+
+
+class FakeTelegram(ThreadingHTTPServer):
+    """
+    Answers the Telegram API calls of the bot after a latency drawn from the ones recorded for the method,
+    and serves the photos of the updates.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latencies: dict[str, list[float]], speed: float):
+        super().__init__(("127.0.0.1", 0), _TelegramHandler)
+        self.latencies = latencies
+        self.speed = speed
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._next_id = 1
+        # The messages sent by the bot by chat in the order sent, and their texts
+        self.sent: dict[int, list[int]] = defaultdict(list)
+        self.texts: dict[int, str] = {}
+        self._photos: dict[str, bytes] = {}
+
+    def new_message_id(self) -> int:
+        with self._lock:
+            message_id = self._next_id
+            self._next_id += 1
+            return message_id
+
+    def call(self, method: str, params: dict[str, str]) -> any:
+        name = _snake_case(method)
+        with self._lock:
+            self.calls[name] += 1
+        latencies = self.latencies.get(name)
+        if latencies:
+            sleep(random.choice(latencies) / self.speed)
+        if method == "getMe":
+            return _BOT_USER
+        if method == "getFile":
+            return {"file_id": params["file_id"], "file_unique_id": params["file_id"],
+                    "file_path": f"photos/{params['file_id']}.jpg"}
+        if not method.startswith("send") and not method.startswith("edit"):
+            return True
+        chat_id = int(params["chat_id"])
+        message = {"date": int(time()), "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+                   "from": _BOT_USER}
+        if method.startswith("edit"):
+            message_id = int(params["message_id"])
+            self.texts[message_id] = params.get("text", "")
+        else:
+            message_id = self.new_message_id()
+            self.texts[message_id] = params.get("text", "")
+            with self._lock:
+                self.sent[chat_id].append(message_id)
+        message["message_id"] = message_id
+        message["text"] = self.texts[message_id]
+        if method == "sendPhoto":
+            message["photo"] = [{"file_id": f"sent{message_id}", "file_unique_id": f"sent{message_id}",
+                                 "width": 1, "height": 1}]
+        elif method == "sendDocument":
+            message["document"] = {"file_id": f"sent{message_id}", "file_unique_id": f"sent{message_id}"}
+        return message
+
+    def photo(self, file_id: str) -> bytes:
+        with self._lock:
+            photo = self._photos.get(file_id)
+        if photo is None:
+            width, height = (int(d) for d in file_id.split("x"))
+            photo = _make_photo(width, height)
+            with self._lock:
+                self._photos[file_id] = photo
+        return photo
+
+
+def _make_photo(width: int, height: int) -> bytes:
+    try:
+        from PIL import Image # type: ignore
+    except ImportError:
+        # Passed through as is without Pillow, so only the size matters
+        return b"\xff\xd8\xff" + os.urandom(width * height // 8)
+    output = io.BytesIO()
+    Image.effect_noise((width, height), 64).convert("RGB").save(output, "JPEG")
+    return output.getvalue()
+
+
+class _TelegramHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        if parts[0] == "file":
+            self._respond(200, self.server.photo(os.path.splitext(parts[-1])[0]), "image/jpeg")
+            return
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        result = self.server.call(parts[-1], params)
+        self._respond(200, json.dumps({"ok": True, "result": result}).encode("utf-8"), "application/json")
+
+    def _respond(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeUpstream(ThreadingHTTPServer):
+    """
+    Answers the requests for each AI configuration with its recorded streams in turn: the same status, and
+    lines as long as the ones recorded after the same gaps.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, commands: list[str], streams: dict[str, list[dict[str, any]]], speed: float):
+        super().__init__(("127.0.0.1", 0), _UpstreamHandler)
+        self.commands = commands
+        self.recorded = streams
+        self.speed = speed
+        self.requests = 0
+        self._queues = {command: deque(streams.get(command, [])) for command in commands}
+        self._lock = threading.Lock()
+
+    def next_stream(self, command: str) -> dict[str, any]:
+        with self._lock:
+            self.requests += 1
+            queue = self._queues[command]
+            if queue:
+                return queue.popleft()
+        # More requests than recorded, e.g. retries
+        recorded = self.recorded.get(command)
+        return random.choice(recorded) if recorded else {"status": 200, "chunks": [[0.0, 100]]}
+
+
+class _UpstreamHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        command = self.server.commands[int(self.path.strip("/"))]
+        stream = self.server.next_stream(command)
+        chunks = stream["chunks"]
+        if chunks:
+            sleep(chunks[0][0] / self.server.speed)
+        self.send_response(stream["status"])
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for i, (gap, length) in enumerate(chunks):
+            if i > 0:
+                sleep(gap / self.server.speed)
+            self.wfile.write(_line(length).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _line(length: int) -> str:
+    if length == 0:
+        return ""
+    content_length = max(1, length - len(_STREAM_PREFIX) - len(_STREAM_SUFFIX))
+    start = random.randrange(len(_FILLER) // 2)
+    content = _FILLER[start:start + content_length] if content_length < len(_FILLER) // 2 \
+        else (_FILLER * (content_length // len(_FILLER) + 1))[:content_length]
+    return _STREAM_PREFIX + content + _STREAM_SUFFIX
+
+
+def read_trace(path: str) -> list[dict[str, any]]:
+    with open(path, encoding="utf-8") as f:
+        return sorted((json.loads(line) for line in f if line.strip()), key=lambda r: r["t"])
+
+
+def configure(path: str, commands: list[str], upstream_url: str):
+    """
+    Takes the configuration into use with the AI configurations of the trace pointed to the fake upstream,
+    and without persistent histories.
+    """
+    parser = configparser.ConfigParser()
+    parser.read(path, encoding="utf-8")
+    for section in parser.sections():
+        if section not in config._INTERNAL_SECTIONS and section not in commands:
+            parser.remove_section(section)
+    if not parser.has_section("TelegramBot"):
+        parser.add_section("TelegramBot")
+    parser["TelegramBot"]["Token"] = _TOKEN
+    parser.remove_option("TelegramBot", "ChatIDFilterForPersistentHistory")
+    for i, command in enumerate(commands):
+        if not parser.has_section(command):
+            parser.add_section(command)
+        section = parser[command]
+        for option in ("Endpoints", "Url"):
+            parser.remove_option(command, option)
+        section["Api"] = "OpenAI"
+        section["Token"] = "replay"
+        section["Feature"] = config.Feature.TEXT_GENERATION.value
+        section["Url"] = f"{upstream_url}/{i}"
+        section["Model"] = section.get("Model", "replay")
+        section["Stream"] = "true"
+    if not config._reload(lambda: config.Snapshot(parser)):
+        raise RuntimeError(f"Invalid configuration in {path}")
+
+
+class Replayer:
+    def __init__(self, records: list[dict[str, any]], telegram: FakeTelegram, telebot: TeleBot, speed: float):
+        self.updates = [r for r in records if r["type"] == "update"]
+        self.telegram = telegram
+        self.telebot = telebot
+        self.speed = speed
+        self.latencies: list[float] = []
+        self._fed: dict[tuple[int, int], float] = {}
+        self._pending = 0
+        self._condition = threading.Condition()
+        # The messages of the trace by their anonymised IDs: the users' by update, the bot's by the order
+        # sent in their chat, which the replay is assumed to follow
+        self._user_messages: dict[int, dict[str, any]] = {}
+        self._bot_messages: dict[int, tuple[int, int]] = {}
+        sent_counts = Counter()
+        for r in records:
+            if r["type"] == "telegram" and r["method"].startswith("send") and r["message"] is not None:
+                self._bot_messages[r["message"]] = (r["chat"], sent_counts[r["chat"]])
+                sent_counts[r["chat"]] += 1
+        for handlers in (telebot.message_handlers, telebot.edited_message_handlers):
+            for handler in handlers:
+                handler["function"] = self._timed(handler["function"])
+
+    def _timed(self, function):
+        def timed(message):
+            try:
+                return function(message)
+            finally:
+                with self._condition:
+                    fed = self._fed.pop((message.chat.id, message.id), None)
+                    if fed is not None:
+                        self.latencies.append(perf_counter() - fed)
+                    self._pending -= 1
+                    self._condition.notify_all()
+        return timed
+
+    def run(self, timeout: float) -> float:
+        """
+        Returns:
+            float: The seconds taken to feed the updates and handle them all.
+        """
+        if not self.updates:
+            return 0.0
+        origin = self.updates[0]["t"]
+        started = perf_counter()
+        for update_id, update in enumerate(self.updates, 1):
+            delay = (update["t"] - origin) / self.speed - (perf_counter() - started)
+            if delay > 0:
+                sleep(delay)
+            message = self._message(update)
+            with self._condition:
+                self._pending += 1
+                self._fed[(message["chat"]["id"], message["message_id"])] = perf_counter()
+            kind = "edited_message" if update["edited"] else "message"
+            self.telebot.process_new_updates([Update.de_json({"update_id": update_id, kind: message})])
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending == 0, timeout)
+        return perf_counter() - started
+
+    def _message(self, update: dict[str, any]) -> dict[str, any]:
+        chat_id = update["chat"] if update["chat_type"] == "private" else -update["chat"]
+        original = self._user_messages.get(update["message"]) if update["edited"] else None
+        message = {"message_id": original["message_id"] if original else self.telegram.new_message_id(),
+                   "date": int(time()),
+                   "chat": {"id": chat_id, "type": update["chat_type"]},
+                   "from": {"id": update["user"] or 0, "is_bot": False, "first_name": "user"}}
+        text = update["command"] + " " + _FILLER[:update["prompt_length"]].ljust(update["prompt_length"], "x")
+        if update["photo"] is not None:
+            width, height = update["photo"]
+            file_id = f"{width}x{height}"
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": width, "height": height}]
+            message["caption"] = text
+        else:
+            message["text"] = text
+        if update["edited"]:
+            message["edit_date"] = int(time())
+        reply_to = self._reply_to(update["reply_to"], chat_id)
+        if reply_to is not None:
+            message["reply_to_message"] = reply_to
+        self._user_messages[update["message"]] = message
+        return message
+
+    def _reply_to(self, anonymised: int | None, chat_id: int) -> dict[str, any] | None:
+        if anonymised is None:
+            return None
+        user_message = self._user_messages.get(anonymised)
+        if user_message is not None:
+            return {k: v for k, v in user_message.items() if k != "reply_to_message"}
+        if anonymised not in self._bot_messages:
+            return None
+        _, index = self._bot_messages[anonymised]
+        sent = self.telegram.sent.get(chat_id, [])
+        if index >= len(sent):
+            # Not sent in the replay (yet)
+            return None
+        message_id = sent[index]
+        return {"message_id": message_id, "date": int(time()), "chat": {"id": chat_id, "type": "private"},
+                "from": _BOT_USER, "text": self.telegram.texts.get(message_id, "")}
+
+
+def _percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays a trace recorded per RecordLog against fake servers.")
+    parser.add_argument("trace")
+    parser.add_argument("--speed", type=float, default=1.0, help="how many times faster than recorded")
+    parser.add_argument("--config", default=config._config_file)
+    parser.add_argument("--timeout", type=float, default=600.0,
+                        help="seconds to wait for the replies after the last update")
+    args = parser.parse_args()
+
+    # The replay itself isn't recorded
+    recording._writer = None
+
+    records = read_trace(args.trace)
+    commands = sorted({r["command"] for r in records if r["type"] == "update"})
+    streams = defaultdict(list)
+    latencies = defaultdict(list)
+    for r in records:
+        if r["type"] == "stream":
+            streams[r["command"]].append(r)
+        elif r["type"] == "telegram" and r["error"] is None:
+            latencies[r["method"]].append(r["latency"])
+
+    telegram = FakeTelegram(latencies, args.speed)
+    upstream = FakeUpstream(commands, streams, args.speed)
+    for server in (telegram, upstream):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    apihelper.API_URL = f"http://127.0.0.1:{telegram.server_port}/bot{{0}}/{{1}}"
+    apihelper.FILE_URL = f"http://127.0.0.1:{telegram.server_port}/file/bot{{0}}/{{1}}"
+    configure(args.config, commands, f"http://127.0.0.1:{upstream.server_port}")
+
+    telebot = TeleBot(_TOKEN, parse_mode="MarkdownV2", num_threads=config.get_int("TelegramBot", "WorkerThreads") or 1)
+    bot.register(telebot)
+    replayer = Replayer(records, telegram, telebot, args.speed)
+
+    cpu_started = process_time()
+    elapsed = replayer.run(args.timeout)
+    cpu = process_time() - cpu_started
+
+    handled = len(replayer.latencies)
+    recorded = replayer.updates[-1]["t"] - replayer.updates[0]["t"] if replayer.updates else 0.0
+    print(f"Updates: {len(replayer.updates)} over {recorded:.1f} s recorded, replayed at {args.speed:g}x "
+          f"in {elapsed:.1f} s")
+    print(f"Handled: {handled}, {handled / elapsed if elapsed else 0.0:.2f} per second")
+    if handled:
+        print("Latency: " + ", ".join(f"p{p} {_percentile(replayer.latencies, p):.3f} s" for p in (50, 90, 99))
+              + f", max {max(replayer.latencies):.3f} s")
+    print(f"CPU: {cpu:.2f} s, {cpu / elapsed * 100 if elapsed else 0.0:.0f}% of a core")
+    print(f"Upstream requests: {upstream.requests}")
+    print("Telegram calls: " + ", ".join(f"{method} {count}" for method, count in sorted(telegram.calls.items())))
+    telebot.stop_bot()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import random
+from time import perf_counter, sleep
+
+import requests
+from telebot.apihelper import ApiHTTPException, ApiTelegramException # type: ignore
+
+from . import config, metrics, recording
+
+# Statuses of a response which a later attempt may well not get
+RETRYABLE_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+def backoff(attempt: int, snapshot: config.Snapshot) -> float:
+    """
+    Returns:
+        float: The delay before the given retry, starting from 0: exponential, capped, and fully jittered so
+        that the retries of replies failing at once are spread out.
+    """
+    return random.uniform(0, min(snapshot.retry_max_delay, snapshot.retry_base_delay * 2 ** attempt))
+
+
+def telegram(method: str, call, *args, idempotent: bool = False, **kwargs):
+    """
+    Calls the Telegram API, retrying on rate limits, server errors and, for idempotent calls such as edits,
+    connection errors. A call that isn't idempotent is only retried if it certainly wasn't delivered, so
+    that a message is never sent twice. The retry_after of a rate limit is waited out before retrying.
+
+    Returns:
+        any: What the call returns, or None if a retried edit turns out to have been delivered.
+    """
+    snapshot = config.current()
+    attempt = 0
+    while True:
+        try:
+            return _call(method, call, args, kwargs)
+        except ApiTelegramException as e:
+            if attempt > 0 and idempotent and "message is not modified" in e.description:
+                # The previous attempt was delivered even though its response wasn't
+                return None
+            if e.error_code not in RETRYABLE_STATUSES:
+                raise
+            retry_after = (e.result_json.get("parameters") or {}).get("retry_after")
+            reason = str(e.error_code)
+            error = e
+        except ApiHTTPException as e:
+            if e.result.status_code not in RETRYABLE_STATUSES:
+                raise
+            retry_after = None
+            reason = str(e.result.status_code)
+            error = e
+        except requests.ConnectTimeout as e:
+            retry_after = None
+            reason = "connect"
+            error = e
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if not idempotent:
+                raise
+            retry_after = None
+            reason = "connection"
+            error = e
+
+        if attempt >= snapshot.telegram_retries:
+            metrics.increment("telegram_give_ups", method=method, reason=reason)
+            raise error
+        if retry_after is not None:
+            # Jittered too, for the replies limited at once not to retry at once
+            delay = retry_after + random.uniform(0, snapshot.retry_base_delay)
+        else:
+            delay = backoff(attempt, snapshot)
+        metrics.increment("telegram_retries", method=method, reason=reason)
+        sleep(delay)
+        attempt += 1
+
+
+def _call(method: str, call, args, kwargs):
+    if not recording.enabled():
+        return call(*args, **kwargs)
+    started = perf_counter()
+    try:
+        result = call(*args, **kwargs)
+    except Exception as e:
+        recording.telegram(method, started, error=type(e).__name__)
+        raise
+    recording.telegram(method, started, result)
+    return result
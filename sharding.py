@@ -0,0 +1,192 @@
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from queue import Empty
+from time import sleep, time
+
+from . import config, metrics
+
+_SHARD_VARIABLE = "AI_PROXY_TELEGRAM_BOT_SHARD"
+
+# Each shard is a separate interpreter, so that the formatting work of the shards runs in parallel
+_context = multiprocessing.get_context("spawn")
+
+
+def current_shard() -> int | None:
+    shard = os.environ.get(_SHARD_VARIABLE)
+    return int(shard) if shard is not None else None
+
+def per_shard(filename: str) -> str:
+    """
+    Gives each shard a file of its own in place of a file shared by the whole bot, as the log writers of
+    the shard processes can't coordinate their writes and rotations.
+    """
+    shard = current_shard()
+    if shard is None:
+        return filename
+    root, extension = os.path.splitext(filename)
+    return f"{root}.shard{shard}{extension}"
+
+def chat_id_of(update: dict[str, any]) -> int:
+    for kind in ("message", "edited_message", "channel_post", "edited_channel_post", "business_message",
+                 "edited_business_message", "message_reaction", "my_chat_member", "chat_member", "chat_join_request"):
+        if kind in update:
+            return update[kind]["chat"]["id"]
+    if "callback_query" in update and "message" in update["callback_query"]:
+        return update["callback_query"]["message"]["chat"]["id"]
+    return 0
+
+def shard_of(update: dict[str, any], shards: int) -> int:
+    # All updates of a chat go to the same shard, which thus owns the histories of the chat
+    return chat_id_of(update) % shards
+
+def aggregate(snapshots: dict[int, dict[str, any]]) -> dict[str, any]:
+    """
+    Combines the metrics snapshots of the shards: counters are summed, observations merged, and the
+    collected component states are kept per shard.
+    """
+    counters = {}
+    observations = {}
+    collected = {}
+    for shard, snapshot in sorted(snapshots.items()):
+        for key, value in snapshot["counters"].items():
+            counters[key] = counters.get(key, 0) + value
+        for key, observation in snapshot["observations"].items():
+            merged = observations.get(key)
+            if merged is None:
+                observations[key] = dict(observation)
+            else:
+                merged["count"] += observation["count"]
+                merged["sum"] += observation["sum"]
+                merged["max"] = max(merged["max"], observation["max"])
+        for name, state in snapshot["collected"].items():
+            collected[f"shard{shard}:{name}"] = state
+    return {"time": time(), "counters": counters, "observations": observations, "collected": collected}
+
+
+class Shard:
+    def __init__(self, index: int, metrics_queue):
+        self.index = index
+        self.updates = _context.Queue()
+        self.metrics_queue = metrics_queue
+        self.process = None
+
+    def start(self):
+        # The spawned process inherits the environment as it is when started
+        os.environ[_SHARD_VARIABLE] = str(self.index)
+        try:
+            self.process = _context.Process(target=run_shard, args=(self.updates, self.metrics_queue),
+                                            name=f"shard{self.index}", daemon=True)
+            self.process.start()
+        finally:
+            del os.environ[_SHARD_VARIABLE]
+
+    def ensure_alive(self):
+        if not self.process.is_alive():
+            logging.error(f"Shard {self.index} exited with {self.process.exitcode}, restarting")
+            metrics.increment("shard_restarts", shard=self.index)
+            self.start()
+
+
+def run(token: str, shards: int):
+    """
+    Runs the bot as a front process polling the updates and routing each to one of the shard processes by
+    the chat, with the metrics of the shards aggregated into MetricsLog.
+    """
+    from telebot import apihelper # type: ignore
+
+    metrics_queue = _context.Queue()
+    workers = [Shard(i, metrics_queue) for i in range(shards)]
+    for worker in workers:
+        worker.start()
+
+    if hasattr(signal, "SIGHUP"):
+        def forward_reload(signum, frame):
+            for worker in workers:
+                if worker.process.is_alive():
+                    os.kill(worker.process.pid, signal.SIGHUP)
+        signal.signal(signal.SIGHUP, forward_reload)
+
+    _start_metrics_aggregation(metrics_queue)
+
+    offset = None
+    while True:
+        try:
+            updates = apihelper.get_updates(token, offset=offset, timeout=30, long_polling_timeout=20)
+        except Exception as e:
+            logging.exception(str(e), exc_info=True)
+            sleep(3)
+            continue
+        for worker in workers:
+            worker.ensure_alive()
+        for update in updates:
+            offset = update["update_id"] + 1
+            shard = shard_of(update, shards)
+            workers[shard].updates.put(json.dumps(update))
+            metrics.increment("updates_routed", shard=shard)
+
+
+def run_shard(updates, metrics_queue):
+    from telebot import TeleBot # type: ignore
+    from telebot.types import Update # type: ignore
+    from . import bot
+    from .main import setup_config_reloading
+    from .util import setup_logging
+
+    setup_logging()
+    telebot = TeleBot(config.get_or_throw("TelegramBot", "Token"), parse_mode='MarkdownV2',
+                      num_threads=config.get_int("TelegramBot", "WorkerThreads") or 1)
+    bot.register(telebot)
+    setup_config_reloading()
+    _start_metrics_reporting(metrics_queue)
+
+    while True:
+        update = updates.get()
+        try:
+            telebot.process_new_updates([Update.de_json(update)])
+        except Exception as e:
+            logging.exception(str(e), exc_info=True)
+
+
+def _start_metrics_reporting(metrics_queue):
+    if not config.get("TelegramBot", "MetricsLog"):
+        return
+    interval = config.get_float("TelegramBot", "MetricsInterval") or 60.0
+    shard = current_shard()
+
+    def report():
+        while True:
+            sleep(interval)
+            metrics_queue.put((shard, metrics.snapshot()))
+
+    threading.Thread(target=report, name="metrics-report", daemon=True).start()
+
+
+def _start_metrics_aggregation(metrics_queue):
+    filename = config.get("TelegramBot", "MetricsLog")
+    if not filename:
+        return
+    interval = config.get_float("TelegramBot", "MetricsInterval") or 60.0
+
+    def collect():
+        # The front process reports its own metrics as shard -1
+        snapshots = {}
+        next_write = time() + interval
+        while True:
+            try:
+                shard, snapshot = metrics_queue.get(timeout=max(0.0, next_write - time()))
+                snapshots[shard] = snapshot
+            except Empty:
+                pass
+            if time() >= next_write:
+                next_write = time() + interval
+                snapshots[-1] = metrics.snapshot()
+                try:
+                    metrics.write(filename, aggregate(snapshots))
+                except Exception as e:
+                    logging.exception(str(e), exc_info=True)
+
+    threading.Thread(target=collect, name="metrics-aggregation", daemon=True).start()
@@ -0,0 +1,60 @@
+import configparser
+
+import pytest
+
+from .. import admission, config
+from ..admission import AdmissionControl, TokenBuckets
+
+@pytest.fixture
+def configure(monkeypatch):
+    def configure(ini: str):
+        parser = configparser.ConfigParser()
+        parser.read_string(ini)
+        monkeypatch.setattr(config, "_current", config.Snapshot(parser))
+    return configure
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission, "monotonic", lambda: now[0])
+    return now
+
+def test_token_bucket_refills_and_evicts():
+    buckets = TokenBuckets()
+    bucket = buckets.refill("a", 1.0, 2, 0.0)
+    bucket[0] -= 2
+    assert buckets.refill("a", 1.0, 2, 1.5)[0] == 1.5
+    buckets.refill("b", 1.0, 2, 1.5)
+    # "a" is full again by now, so it's dropped as "c" comes in
+    buckets.refill("c", 1.0, 2, 10.0)
+    assert len(buckets) == 1
+
+def test_user_chat_and_command_limits(configure, clock):
+    configure("[TelegramBot]\nUserRequestsPerMinute = 2\nChatRequestsPerMinute = 60\nChatBurst = 3\n"
+              "[gpt]\nApi = OpenAI\nFeature = Text gen\nUrl = u\nModel = m\nRequestsPerMinute = 6\nBurst = 3\n")
+    control = AdmissionControl()
+    assert control.admit(1, 10, "gpt") is None
+    assert control.admit(1, 10, "gpt") is None
+    assert control.admit(1, 10, "gpt") == admission.USER
+    assert control.admit(2, 10, "gpt") is None
+    # The refusals above didn't use up the tokens of the chat
+    assert control.admit(3, 10, "gpt") == admission.CHAT
+    assert control.admit(3, 11, "gpt") == admission.COMMAND
+    clock[0] += 30
+    assert control.admit(1, 11, "gpt") is None
+    assert control.stats()["in_flight"] == 4
+
+def test_in_flight_cap(configure, clock):
+    configure("[TelegramBot]\nMaxInFlight = 2\n")
+    control = AdmissionControl()
+    assert control.admit(1, 10, "gpt") is None
+    assert control.admit(2, 20, "gpt") is None
+    assert control.admit(3, 30, "gpt") == admission.IN_FLIGHT
+    control.release()
+    assert control.admit(3, 30, "gpt") is None
+
+def test_invalid_rate_limit():
+    parser = configparser.ConfigParser()
+    parser.read_string("[TelegramBot]\nUserRequestsPerMinute = 0\n")
+    with pytest.raises(RuntimeError, match="UserRequestsPerMinute"):
+        config.Snapshot(parser)
@@ -0,0 +1,54 @@
+from .. import cancellation
+
+def test_edit_cancels_previous_generation():
+    closed = []
+    first = cancellation.start(1, 10)
+    first.on_cancel(lambda: closed.append("first"))
+
+    second = cancellation.start(1, 10)
+    assert first.cancelled and first.reason == "edit"
+    assert closed == ["first"]
+    assert not second.cancelled
+
+    cancellation.finish(first)  # The cancelled one finishing doesn't unregister its successor
+    assert cancellation.cancel(1, 10) == 1
+    assert second.reason == "stop"
+    cancellation.finish(second)
+    assert cancellation.in_progress() == 0
+
+def test_cancel_by_reply_and_chat():
+    a = cancellation.start(1, 10)
+    a.reply_ids.add(11)
+    b = cancellation.start(1, 20)
+    c = cancellation.start(2, 10)
+
+    assert cancellation.cancel(1, 11) == 1
+    assert a.cancelled and not b.cancelled
+    assert cancellation.cancel(1) == 1
+    assert b.cancelled and not c.cancelled
+    assert cancellation.cancel(1) == 0
+
+    for generation in (a, b, c):
+        cancellation.finish(generation)
+
+def test_callback_after_cancellation_runs_immediately():
+    generation = cancellation.start(3, 30)
+    generation.cancel("stop")
+    called = []
+    generation.on_cancel(lambda: called.append(True))
+    assert called == [True]
+    assert not generation.cancel("edit")
+    assert generation.reason == "stop"
+    cancellation.finish(generation)
+
+def test_bare_stop_limited_to_user():
+    a = cancellation.start(4, 10, user_id=100)
+    b = cancellation.start(4, 20, user_id=200)
+
+    assert cancellation.cancel(4, user_id=200) == 1
+    assert b.cancelled and not a.cancelled
+    assert cancellation.cancel(4, 10) == 1  # Replying to a prompt stops it whoever sent it
+    assert a.cancelled
+
+    for generation in (a, b):
+        cancellation.finish(generation)
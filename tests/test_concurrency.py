@@ -0,0 +1,132 @@
+import threading
+import pytest
+
+from ..concurrency import FairLimiter
+
+def wait_until(condition):
+    for _ in range(500):
+        if condition():
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError("Timed out")
+
+def start(target, *args) -> threading.Thread:
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+def test_limit_and_round_robin_across_chats():
+    limiter = FairLimiter(2)
+    assert limiter.acquire(1)
+    assert limiter.acquire(1)
+
+    order = []
+    def request(chat_id, name):
+        if limiter.acquire(chat_id, timeout=10):
+            order.append(name)
+
+    threads = []
+    for chat_id, name in [(1, "a1"), (1, "a2"), (1, "a3"), (2, "b1"), (3, "c1"), (2, "b2")]:
+        threads.append(start(request, chat_id, name))
+        wait_until(lambda: limiter.stats()["waiting"] == len(threads))
+
+    assert limiter.stats() == {"max_concurrent": 2, "active": 2, "waiting": 6, "waiting_chats": 3}
+    for i in range(6):
+        limiter.release()
+        wait_until(lambda: len(order) == i + 1)
+    for thread in threads:
+        thread.join(10)
+
+    assert order == ["a1", "b1", "c1", "a2", "b2", "a3"]
+    limiter.release()
+    limiter.release()
+    assert limiter.stats() == {"max_concurrent": 2, "active": 0, "waiting": 0, "waiting_chats": 0}
+
+def test_queue_positions():
+    limiter = FairLimiter(1)
+    assert limiter.acquire(0)
+
+    positions = {}
+    def request(chat_id, name):
+        def on_position(position):
+            positions[name] = position
+        if limiter.acquire(chat_id, timeout=10, on_position=on_position):
+            limiter.release()
+
+    threads = []
+    try:
+        for chat_id, name in [(1, "a1"), (1, "a2"), (2, "b1")]:
+            threads.append(start(request, chat_id, name))
+            wait_until(lambda: name in positions and limiter.stats()["waiting"] == len(threads))
+
+        # b1 joined after a2 but takes its turn ahead of it, which a2 is told about
+        wait_until(lambda: positions == {"a1": 1, "a2": 3, "b1": 2})
+    finally:
+        limiter.release()
+        for thread in threads:
+            thread.join(10)
+
+def test_position_reports_throttled_but_not_lost():
+    limiter = FairLimiter(1)
+    assert limiter.acquire(0)
+
+    done = threading.Event()
+    def hold():
+        if limiter.acquire(1, timeout=10):
+            done.wait(10)
+            limiter.release()
+
+    second = []
+    threads = [start(hold)]
+    wait_until(lambda: limiter.stats()["waiting"] == 1)
+    threads.append(start(lambda: limiter.acquire(1, timeout=10, on_position=second.append,
+                                                 report_interval=0.3) and limiter.release()))
+    try:
+        wait_until(lambda: second == [2])
+        limiter.release()  # Now the first request runs and the second one is next
+        wait_until(lambda: second == [2, 1])
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join(10)
+
+def test_timeout():
+    limiter = FairLimiter(1)
+    assert limiter.acquire(1)
+    assert not limiter.acquire(2, timeout=0.05)
+    assert limiter.stats()["waiting"] == 0
+    limiter.release()
+    assert limiter.acquire(2, timeout=0.05)
+
+def test_resize():
+    limiter = FairLimiter(1)
+    assert limiter.acquire(1)
+    admitted = []
+    thread = start(lambda: admitted.append(limiter.acquire(2, timeout=10)))
+    wait_until(lambda: limiter.stats()["waiting"] == 1)
+
+    limiter.resize(2)
+    thread.join(10)
+    assert admitted == [True]
+    assert limiter.stats()["active"] == 2
+
+    limiter.resize(1)
+    limiter.release()
+    assert limiter.stats()["active"] == 1
+    assert limiter.acquire(3, timeout=0.05) is False
+
+def test_cancelled_while_queued():
+    limiter = FairLimiter(1)
+    assert limiter.acquire(1)
+    cancelled = threading.Event()
+    results = []
+    thread = start(lambda: results.append(limiter.acquire(2, timeout=10, cancelled=cancelled.is_set)))
+    wait_until(lambda: limiter.stats()["waiting"] == 1)
+
+    cancelled.set()
+    limiter.interrupt()
+    thread.join(5)
+    assert results == [False]
+    assert limiter.stats()["waiting"] == 0
+    limiter.release()
+    assert limiter.stats()["active"] == 0
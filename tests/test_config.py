@@ -0,0 +1,124 @@
+import configparser
+import pytest
+
+from ..config import Snapshot, Feature
+
+def snapshot(ini: str) -> Snapshot:
+    parser = configparser.ConfigParser()
+    parser.read_string(ini)
+    return Snapshot(parser)
+
+def test_typed_values():
+    s = snapshot("""
+[TelegramBot]
+Token = abc
+MaxMessagesPerReply = 3
+ChatIDFilterForReplyLog = [1234567890, -9876543210]
+
+[gpt]
+Api = OpenAI
+Feature = Text gen
+Url = https://api.openai.com/v1/chat/completions
+Model = gpt-4o
+Stream = true
+Params =
+    temperature 0.5
+    stop ["a b", "c"]
+""")
+    assert s.max_messages_per_reply == 3
+    assert s.reply_log_chat_ids == {1234567890, -9876543210}
+    assert s.persistent_history_chat_ids is None
+    assert len(s.queries) == 1
+    assert s.queries[0].command == "gpt"
+    assert s.queries[0].feature == Feature.TEXT_GENERATION
+    assert s.queries[0].stream
+    assert s.queries[0].params == {"temperature": 0.5, "stop": ["a b", "c"]}
+
+def test_defaults():
+    s = snapshot("[TelegramBot]\nToken = abc\n")
+    assert s.max_messages_per_reply == 9999
+    assert s.reply_log_chat_ids is None
+    assert s.queries == ()
+
+def test_immutable():
+    s = snapshot("[TelegramBot]\nToken = abc\n")
+    with pytest.raises(AttributeError):
+        s.max_messages_per_reply = 1
+
+def test_nothing_shared_mutable():
+    parser = configparser.ConfigParser()
+    parser.read_string("[TelegramBot]\nToken = abc\n[gpt]\nApi = OpenAI\nFeature = Text gen\nUrl = u\nModel = m\n"
+                       "RequestsPerMinute = 6\n")
+    s = Snapshot(parser)
+    parser["TelegramBot"]["Token"] = "changed"
+    assert s.get("TelegramBot", "Token") == "abc"
+    with pytest.raises(TypeError):
+        s.command_rate_limits["gpt"] = (1, 1)
+
+def test_explicit_zero():
+    s = snapshot("[TelegramBot]\nPlaceholderDelay = 0\nRetryBaseDelay = 0\n"
+                 "[gpt]\nApi = OpenAI\nFeature = Text gen\nUrl = u\nModel = m\nEjectAfterErrors = 0\n")
+    assert s.placeholder_delay == 0.0
+    assert s.retry_base_delay == 0.0
+    assert s.queries[0].eject_after_errors == 0
+
+def test_formatting_pool_settings():
+    assert snapshot("").format_inline_below == 1000
+    s = snapshot("[TelegramBot]\nFormatterProcesses = 2\nFormatInlineBelow = 0\n")
+    assert s.formatter_processes == 2
+    assert s.format_inline_below == 0
+
+def test_invalid_params():
+    with pytest.raises(RuntimeError, match="temperature"):
+        snapshot("[gpt]\nApi = OpenAI\nFeature = Text gen\nUrl = u\nModel = m\nParams =\n    temperature warm\n")
+
+def test_invalid_feature():
+    with pytest.raises(RuntimeError, match="Text generation"):
+        snapshot("[gpt]\nApi = OpenAI\nFeature = Text generation\nUrl = u\nModel = m\n")
+
+def test_endpoints():
+    s = snapshot("""
+[ollama]
+Api = Ollama
+Feature = Text gen
+Model = llama3
+Token = default
+Balancing = ewma
+Endpoints =
+    http://gpu1:11434/api/chat
+    http://gpu2:11434/api/chat {"weight": 2, "token": "other"}
+""")
+    configuration = s.queries[0]
+    assert configuration.url == "http://gpu1:11434/api/chat"
+    assert configuration.balancing == "ewma"
+    assert [(e.url, e.token, e.weight) for e in configuration.endpoints] \
+           == [("http://gpu1:11434/api/chat", "default", 1.0), ("http://gpu2:11434/api/chat", "other", 2.0)]
+
+def test_single_url_endpoint():
+    s = snapshot("[gpt]\nApi = OpenAI\nFeature = Text gen\nUrl = u\nModel = m\nToken = t\n")
+    assert [(e.url, e.token, e.weight) for e in s.queries[0].endpoints] == [("u", "t", 1.0)]
+
+def test_invalid_endpoint():
+    with pytest.raises(RuntimeError, match="Invalid endpoint"):
+        snapshot("[gpt]\nApi = OpenAI\nFeature = Text gen\nModel = m\nEndpoints =\n    u {\"wieght\": 2}\n")
+
+@pytest.mark.parametrize("weight", ["0", "-1"])
+def test_non_positive_weight(weight):
+    with pytest.raises(RuntimeError, match="positive weight"):
+        snapshot("[gpt]\nApi = OpenAI\nFeature = Text gen\nModel = m\nEndpoints =\n    u {\"weight\": " + weight + "}\n")
+
+def test_timeouts():
+    s = snapshot("[gpt]\nApi = OpenAI\nFeature = Text gen\nUrl = u\nModel = m\n"
+                 "ConnectTimeout = 3\nIdleTimeout = 0\nTotalTimeout = 600\n")
+    configuration = s.queries[0]
+    assert (configuration.connect_timeout, configuration.first_byte_timeout, configuration.idle_timeout,
+            configuration.total_timeout) == (3.0, 300.0, None, 600.0)
+
+def test_overflow():
+    s = snapshot("[gpt]\nApi = OpenAI\nFeature = Text gen\nUrl = u\nModel = m\n"
+                 "OverflowMode = Document\nOverflowAfter = 5\nOverflowFormat = txt\n")
+    configuration = s.queries[0]
+    assert (configuration.overflow_mode, configuration.overflow_after, configuration.overflow_format) \
+        == ("document", 5, "txt")
+    with pytest.raises(RuntimeError, match="overflow mode"):
+        snapshot("[gpt]\nApi = OpenAI\nFeature = Text gen\nUrl = u\nModel = m\nOverflowMode = file\n")
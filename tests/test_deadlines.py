@@ -0,0 +1,130 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+
+from .. import deadlines
+from ..deadlines import Deadlines
+from ..endpoints import Endpoint, EndpointPool, Interruption, interrupt
+
+def test_idle_deadline_only_counts_waiting():
+    timeouts = Deadlines("dummy", None, None, 0.2, None)
+    expired = threading.Event()
+    timeouts.on_expire(expired.set)
+    for _ in range(3):
+        timeouts.waiting()
+        time.sleep(0.1)
+        timeouts.received()
+        time.sleep(0.2) # handling a part of the response
+    assert not timeouts.expired
+    timeouts.waiting()
+    assert expired.wait(2)
+    assert timeouts.stage == deadlines.IDLE
+    timeouts.stop()
+
+def test_total_deadline():
+    timeouts = Deadlines("dummy", None, None, 10, 0.1)
+    timeouts.waiting()
+    time.sleep(0.3)
+    assert timeouts.stage == deadlines.TOTAL
+    # Callbacks registered late are called right away
+    called = []
+    timeouts.on_expire(lambda: called.append(True))
+    assert called == [True]
+    timeouts.stop()
+
+def test_stopped_deadline_does_not_fire():
+    timeouts = Deadlines("dummy", None, None, None, 0.1)
+    timeouts.stop()
+    time.sleep(0.3)
+    assert not timeouts.expired
+
+def test_idle_deadline_pushed_later_does_not_wake_watchdog(monkeypatch):
+    timeouts = Deadlines("dummy", None, None, 5, None)
+    timeouts.waiting()
+    time.sleep(0.1)
+    notified = []
+    monkeypatch.setattr(deadlines._condition, "notify", lambda *args: notified.append(True))
+    for _ in range(10):
+        timeouts.received()
+        timeouts.waiting()
+    assert notified == []
+    earlier = Deadlines("dummy", None, None, None, 1)
+    assert notified == [True]
+    earlier.stop()
+    timeouts.stop()
+
+def test_timeout_for_requests():
+    assert Deadlines("dummy", None, None, None, None).timeout() is None
+    assert Deadlines("dummy", 5, 300, 120, None).timeout() == (5, 300)
+    # The socket timeout mustn't cut a stream before the idle deadline
+    assert Deadlines("dummy", 5, 30, 120, None).timeout() == (5, 120)
+
+def test_interrupt_ends_a_blocked_read():
+    done = threading.Event()
+
+    class StallingHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.wfile.write(b"6\r\nfirst\n\r\n")
+            self.wfile.flush()
+            done.wait(5)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), StallingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        response = requests.get(f"http://127.0.0.1:{server.server_port}/", stream=True, timeout=(5, 30))
+        lines = response.iter_lines()
+        assert next(lines) == b"first"
+        threading.Timer(0.2, interrupt, args=(response,)).start()
+        started = time.monotonic()
+        try:
+            next(lines, None)
+        except requests.RequestException:
+            pass
+        assert time.monotonic() - started < 2
+    finally:
+        done.set()
+        server.shutdown()
+
+def test_interruption_ends_a_wait_for_the_response():
+    done = threading.Event()
+
+    class StallingHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            done.wait(5)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), StallingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        pool = EndpointPool([Endpoint(f"http://127.0.0.1:{server.server_port}", None)], eject_after_errors=1)
+        interruption = Interruption()
+        threading.Timer(0.2, interruption.interrupt).start()
+        started = time.monotonic()
+        try:
+            pool.post("/", lambda token: {}, interruption, data="{}", timeout=(5, 30))
+            assert False, "Not interrupted"
+        except requests.RequestException:
+            pass
+        assert time.monotonic() - started < 2
+        # Being interrupted isn't the endpoint's failure
+        assert pool.stats()[0]["failures"] == 0 and pool.stats()[0]["in_flight"] == 0
+        try:
+            pool.post("/", lambda token: {}, interruption, data="{}", timeout=(5, 30))
+            assert False, "Not interrupted"
+        except requests.RequestException:
+            pass
+    finally:
+        done.set()
+        server.shutdown()
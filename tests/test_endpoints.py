@@ -0,0 +1,201 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+
+from ..endpoints import Endpoint, EndpointPool
+
+class StandIn:
+    def __init__(self, status: int = 200):
+        self.status = status
+        self.requests = 0
+        self.tokens = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                stand_in.requests += 1
+                stand_in.tokens.append(self.headers.get("Authorization"))
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.send_response(stand_in.status)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"ok")
+
+            def do_GET(self):
+                self.send_response(stand_in.status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.server.block_on_close = False
+        threading.Thread(target=self.server.serve_forever, args=(0.01,), daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def stand_ins():
+    created = []
+    def create(status: int = 200) -> StandIn:
+        created.append(StandIn(status))
+        return created[-1]
+    yield create
+    for stand_in in created:
+        stand_in.close()
+
+def headers(token):
+    return {"Authorization": f"Bearer {token}"} if token else {}
+
+def post(pool: EndpointPool):
+    response, lease = pool.post("/", headers, data="{}")
+    lease.release()
+    return response
+
+def test_least_in_flight_spreads_by_weight(stand_ins):
+    a, b = stand_ins(), stand_ins()
+    pool = EndpointPool([Endpoint(a.url, "x"), Endpoint(b.url, "y", weight=2)])
+
+    leases = [pool.acquire() for _ in range(6)]
+    assert sum(1 for l in leases if l.endpoint.url == a.url) == 2
+    assert sum(1 for l in leases if l.endpoint.url == b.url) == 4
+    for lease in leases:
+        lease.release()
+    assert [s["in_flight"] for s in pool.stats()] == [0, 0]
+
+def test_endpoint_tokens(stand_ins):
+    a, b = stand_ins(), stand_ins()
+    pool = EndpointPool([Endpoint(a.url, "x"), Endpoint(b.url, None)])
+    for _ in range(4):
+        assert post(pool).text == "ok"
+    assert a.tokens == ["Bearer x"] * 2
+    assert b.tokens == [None] * 2
+
+def test_ewma_prefers_faster(stand_ins):
+    a, b = stand_ins(), stand_ins()
+    pool = EndpointPool([Endpoint(a.url, None), Endpoint(b.url, None)], balancing=EndpointPool.EWMA)
+    pool.endpoints[0].ewma_latency = 0.5
+    pool.endpoints[1].ewma_latency = 0.01
+    for _ in range(5):
+        post(pool)
+    assert b.requests == 5
+    assert a.requests == 0
+
+def test_ewma_unmeasured_endpoint_expected_average(stand_ins):
+    a, b, c = stand_ins(), stand_ins(), stand_ins()
+    pool = EndpointPool([Endpoint(a.url, None), Endpoint(b.url, None), Endpoint(c.url, None)],
+                        balancing=EndpointPool.EWMA)
+    pool.endpoints[0].ewma_latency = 0.1
+    pool.endpoints[1].ewma_latency = 0.5
+    # c is expected to take 0.3, so it's chosen over b but not over a
+    assert pool._choose() is pool.endpoints[0]
+    pool.endpoints[0].in_flight = 3
+    assert pool._choose() is pool.endpoints[2]
+
+def test_ewma_without_measurements_balances_load(stand_ins):
+    a, b = stand_ins(), stand_ins()
+    pool = EndpointPool([Endpoint(a.url, None), Endpoint(b.url, None)], balancing=EndpointPool.EWMA)
+    pool.endpoints[0].in_flight = 1
+    assert pool._choose() is pool.endpoints[1]
+
+def test_failing_endpoint_ejected_and_readmitted(stand_ins):
+    failing, healthy = stand_ins(500), stand_ins()
+    pool = EndpointPool([Endpoint(failing.url, None), Endpoint(healthy.url, None)],
+                        eject_after_errors=2, eject_seconds=60)
+    for _ in range(10):
+        post(pool)
+    assert failing.requests == 2
+    assert healthy.requests == 8
+    assert pool.stats()[0]["ejected"]
+    assert pool.stats()[0]["ejections"] == 1
+    assert pool.stats()[0]["failures"] == 2
+
+    failing.status = 200
+    pool.endpoints[0].ejected_until = 0  # Ejection period over
+    post(pool)
+    post(pool)
+    assert failing.requests == 3
+    assert not pool.stats()[0]["ejected"]
+    assert pool.endpoints[0].consecutive_failures == 0
+
+def test_unreachable_endpoint_ejected(stand_ins):
+    gone, healthy = stand_ins(), stand_ins()
+    gone.close()
+    pool = EndpointPool([Endpoint(gone.url, None), Endpoint(healthy.url, None)], eject_after_errors=1)
+    for _ in range(4):
+        try:
+            post(pool)
+        except requests.ConnectionError:
+            pass
+    assert healthy.requests == 3
+    assert pool.stats()[0]["ejected"]
+    assert pool.stats()[0]["in_flight"] == 0
+
+def test_active_health_check_readmits(stand_ins):
+    failing, healthy = stand_ins(500), stand_ins()
+    pool = EndpointPool([Endpoint(failing.url, None), Endpoint(healthy.url, None)],
+                        eject_after_errors=1, eject_seconds=60, health_check_interval=0.05)
+    try:
+        post(pool)
+        post(pool)
+        assert pool.stats()[0]["ejected"]
+
+        failing.status = 200
+        for _ in range(100):
+            if not pool.stats()[0]["ejected"]:
+                break
+            threading.Event().wait(0.05)
+        assert not pool.stats()[0]["ejected"]
+    finally:
+        pool.close()
+
+def test_all_ejected_still_served(stand_ins):
+    a = stand_ins(500)
+    pool = EndpointPool([Endpoint(a.url, None)], eject_after_errors=1)
+    assert post(pool).status_code == 500
+    assert post(pool).status_code == 500
+    assert a.requests == 2
+
+def test_probe_accepts_any_answer_below_500(stand_ins):
+    post_only, missing, healthy = stand_ins(405), stand_ins(404), stand_ins(204)
+    assert EndpointPool._probe(Endpoint(post_only.url, None))
+    assert EndpointPool._probe(Endpoint(missing.url, None))
+    assert EndpointPool._probe(Endpoint(healthy.url, None))
+    assert not EndpointPool._probe(Endpoint(stand_ins(503).url, None))
+
+def test_post_only_endpoint_readmitted(stand_ins):
+    failing, healthy = stand_ins(500), stand_ins()
+    pool = EndpointPool([Endpoint(failing.url, None), Endpoint(healthy.url, None)],
+                        eject_after_errors=1, eject_seconds=60, health_check_interval=0.05)
+    try:
+        post(pool)
+        post(pool)
+        assert pool.stats()[0]["ejected"]
+
+        failing.status = 405
+        for _ in range(100):
+            if not pool.stats()[0]["ejected"]:
+                break
+            threading.Event().wait(0.05)
+        assert not pool.stats()[0]["ejected"]
+    finally:
+        pool.close()
+
+def test_failed_probe_keeps_ejection(stand_ins):
+    failing, healthy = stand_ins(500), stand_ins()
+    pool = EndpointPool([Endpoint(failing.url, None), Endpoint(healthy.url, None)],
+                        eject_after_errors=1, eject_seconds=60, health_check_interval=0.05)
+    try:
+        post(pool)
+        post(pool)
+        ejected_until = pool.endpoints[0].ejected_until
+        threading.Event().wait(0.3)
+        assert pool.endpoints[0].ejected_until == ejected_until
+        assert pool.stats()[0]["ejections"] == 1
+    finally:
+        pool.close()
@@ -0,0 +1,21 @@
+from ..file_ids import FileIdCache
+
+def test_by_digest_and_kind():
+    cache = FileIdCache()
+    cache.put(b"a", "photo", "p1")
+    cache.put(b"a", "document", "d1")
+    assert cache.get(b"a", "photo") == "p1"
+    assert cache.get(b"a", "document") == "d1"
+    assert cache.get(b"b", "photo") is None
+    cache.discard(b"a", "photo")
+    assert cache.get(b"a", "photo") is None
+
+def test_least_recently_used_evicted():
+    cache = FileIdCache(size=2)
+    cache.put(b"a", "photo", "1")
+    cache.put(b"b", "photo", "2")
+    cache.get(b"a", "photo")
+    cache.put(b"c", "photo", "3")
+    assert cache.get(b"a", "photo") == "1"
+    assert cache.get(b"b", "photo") is None
+    assert cache.get(b"c", "photo") == "3"
@@ -1,7 +1,7 @@
 import pytest
 
 from ..api_impl.ollama import OllamaQuery
-from ..formatters import PartitionFormatter, ChainedPartitionFormatter, ReplyFormatter
+from ..formatters import PartitionFormatter, ChainedPartitionFormatter, ReplyFormatter, LaTeXFormatter
 from .. import texts
 
 class SimpleFormatter(PartitionFormatter):
@@ -124,4 +124,65 @@ def test_LaTeX_formatting():
             "LaTeX formatted outside code \\frac{2}{3} ```plaintext\nbut not inside \\frac{2}{3}```") \
                == "LaTeX formatted outside code 2/3 ```plaintext\n\nbut not inside \\\\frac\\{2\\}\\{3\\}\n```"
     except ImportError as e:
-        pass
\ No newline at end of file
+        pass
+
+def test_LaTeX_fast_path():
+    try:
+        from pylatexenc.latex2text import LatexNodes2Text  # type: ignore
+        import random
+
+        latex_formatter = LaTeXFormatter()
+        latex_formatter.format("")  # Imports pylatexenc
+        converter = LatexNodes2Text(keep_comments=True)
+        random.seed(0)
+        alphabet = "ab1 .,:;!?%'-\\$&{}~^_\n"
+        for _ in range(2000):
+            s = "".join(random.choice(alphabet) for _ in range(random.randint(0, 12)))
+            assert latex_formatter.out_format(s) == converter.latex_to_text(s.replace("&", "\\&"))
+    except ImportError as e:
+        pass
+
+def test_formatters_not_shared():
+    a, b = ReplyFormatter(), ReplyFormatter()
+    a.format("```code continues", affect_state=True)
+    assert a.format("in code") == "```\nin code\n```"
+    assert b.format("in code") == "in code"
+    assert OllamaQuery().new_formatter() is not OllamaQuery().new_formatter()
+
+def test_parallel_formatting():
+    import sys
+    import threading
+
+    def stream(i: int) -> list[str]:
+        # Pages split inside code blocks, so that the state carried from page to page matters
+        text = f"# Reply {i}\n" + f"**bold {i}** and `code {i}`\n```\n" * (i % 3 + 1) + "x\n" * i + "```\n## end"
+        formatter = ReplyFormatter()
+        results = []
+        for page in range(0, len(text), 7):
+            for end in range(page + 1, min(page + 7, len(text)) + 1):
+                results.append(formatter.format(text[page:end]))
+            formatter.format(text[page:page + 7], affect_state=True)
+        return results
+
+    expected = [stream(i) for i in range(32)]
+    results = [None] * 32
+    barrier = threading.Barrier(32)
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # Lets the threads interleave as often as possible
+
+    def run(i: int):
+        barrier.wait()
+        for _ in range(5):
+            results[i] = stream(i)
+            if results[i] != expected[i]:
+                return
+
+    threads = [threading.Thread(target=run, args=(i,), daemon=True) for i in range(32)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join(60)
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert results == expected
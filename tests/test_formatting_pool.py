@@ -0,0 +1,30 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+from .. import formatting_pool
+from ..formatters import ReplyFormatter
+
+TEXT = "Here:\n```python\nprint('a')\n" + "x = 1\n" * 600 + "```\nand **done**"
+
+def test_pool_matches_inline(monkeypatch):
+    inline = formatting_pool.paginate_and_format(ReplyFormatter(), TEXT, 1000, False, "\n...")
+
+    pool = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"))
+    monkeypatch.setattr(formatting_pool, "_pool", pool)
+    try:
+        pooled = formatting_pool.run(ReplyFormatter(), TEXT, 1000, False, "\n...")
+    finally:
+        pool.shutdown()
+
+    assert pooled[:3] == inline[:3]
+    assert inline[1]  # Split in the code block, which the next message continues
+    assert pooled[3].code_inside and inline[3].code_inside
+    # The formatter returned carries the state on to the rest of the reply
+    assert pooled[3].format("done\n```").startswith("```")
+
+def test_short_text_formatted_inline(monkeypatch):
+    monkeypatch.setattr(formatting_pool, "_pool", object())  # Would fail if used
+    formatter = ReplyFormatter()
+    text, remainder, formatted, returned = formatting_pool.run(formatter, "**hi**", 1000, True, "\n...")
+    assert (text, remainder, formatted) == ("**hi**", "", "*hi*")
+    assert returned is formatter
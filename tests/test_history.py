@@ -62,4 +62,163 @@ def test_history_serialization():
     history.record("Fine ty. Waddup?", [22], 16)
 
     assert Query.History.serialize(history) == '{"17": 16, "18": 16}|{"4": ["How r u?", [], null], "16": ["Fine, how bout u?", [], 4], "22": ["Fine ty. Waddup?", [], 16]}'
-    assert Query.History.deserialize(Query.History.serialize(history)) == (history._history, history.id_table)
\ No newline at end of file
+    assert Query.History.deserialize(Query.History.serialize(history)) == (history._history, history.id_table)
+
+def test_context_budget():
+    query = DummyQuery()
+    query.context_tokens = 10
+    history = query.get_history(0)
+
+    history.record("a" * 16, [1], None)  # 4 tokens each
+    history.record("b" * 16, [2], 1)
+    history.record("c" * 16, [3], 2)
+    history.record("d" * 80, [4], 3)
+
+    # The oldest message doesn't fit, and the context doesn't start with the assistant's
+    assert history.get(3) == [{"role": "user", "content": "c" * 16}]
+    query.context_tokens = 12
+    assert [m["content"] for m in history.get(3)] == ["a" * 16, "b" * 16, "c" * 16]
+    # The newest message is included regardless
+    assert history.get(4) == [{"role": "user", "content": "d" * 80}]
+
+def test_context_budget_leaves_out_older_images_first():
+    class ImageQuery(TextGenQuery):
+        def history_printer(self, l):
+            return [(t, i) for (r, t, i) in l]
+
+    query = ImageQuery()
+    query.context_bytes = 1000
+    history = query.get_history(0)
+    # 600 bytes each as sent, base64 encoded
+    history.record("first", [1], None, [b"x" * 450])
+    history.record("reply", [2], 1)
+    history.record("second", [3], 2, [b"y" * 450])
+
+    assert history.get(3) == [("first", []), ("reply", []), ("second", [b"y" * 450])]
+    query.context_bytes = 615
+    assert history.get(3) == [("second", [b"y" * 450])]
+    query.context_bytes = 10
+    assert history.get(3) == [("second", [b"y" * 450])]
+
+def test_concurrent_records_and_persistence(monkeypatch, tmp_path):
+    import configparser
+    import sys
+    import threading
+    from .. import config
+
+    parser = configparser.ConfigParser()
+    parser.read_string("[TelegramBot]\nChatIDFilterForPersistentHistory = [1, 2]\n")
+    monkeypatch.setattr(config, "_current", config.Snapshot(parser))
+    monkeypatch.chdir(tmp_path)
+    query = DummyQuery()
+    query.command = "dummy"
+
+    chats, threads_per_chat, records_per_thread = (1, 2, 3), 4, 50
+    barrier = threading.Barrier(len(chats) * threads_per_chat)
+    errors = []
+
+    def record(chat_id: int, thread: int):
+        barrier.wait()
+        for i in range(records_per_thread):
+            message_id = thread * 1000 + i * 2
+            history = query.get_history(chat_id)
+            history.record(f"prompt {message_id}", [message_id], message_id - 1 if i else None)
+            history.record(f"reply {message_id}", [message_id + 1, message_id + 100001], message_id)
+            if len(history.get(message_id + 100001)) != 2 * (i + 1):
+                errors.append((chat_id, message_id))
+
+    recording = threading.Event()
+    recording.set()
+
+    def read():
+        # A restart in the middle of writing would read the file as it is
+        while recording.is_set():
+            try:
+                with open(tmp_path / "DummyQuery_dummy_1.history") as f:
+                    Query.History.deserialize(f.read())
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                errors.append("torn")
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    threads = [threading.Thread(target=record, args=(chat_id, thread), daemon=True)
+               for chat_id in chats for thread in range(threads_per_chat)]
+    reader = threading.Thread(target=read, daemon=True)
+    try:
+        reader.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+    finally:
+        recording.clear()
+        sys.setswitchinterval(switch_interval)
+    reader.join(5)
+
+    assert errors == []
+    for chat_id in chats:
+        history = query.get_history(chat_id)
+        assert len(history._history) == threads_per_chat * records_per_thread * 2
+        assert len(history.id_table) == threads_per_chat * records_per_thread
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["DummyQuery_dummy_1.history", "DummyQuery_dummy_2.history"]
+    for chat_id in (1, 2):
+        with open(tmp_path / f"DummyQuery_dummy_{chat_id}.history") as f:
+            assert Query.History.deserialize(f.read()) == (query.get_history(chat_id)._history,
+                                                           query.get_history(chat_id).id_table)
+
+def test_cold_records_compressed(monkeypatch):
+    import configparser
+    from .. import config
+
+    parser = configparser.ConfigParser()
+    parser.read_string("[TelegramBot]\nHistoryCompressAfter = 0\n")
+    monkeypatch.setattr(config, "_current", config.Snapshot(parser))
+    query = DummyQuery()
+    history = query.get_history(0)
+    history.record("a" * 1000, [1], None)
+    history.record("b" * 1000, [2], 1)
+    history.record("c" * 1000, [3], None) # compresses the records untouched since the previous
+    history.record("d" * 1000, [4], 3)
+
+    assert history._history[1].compressed and history._history[2].compressed
+    assert not history._history[4].compressed
+    assert [m["content"] for m in history.get(2)] == ["a" * 1000, "b" * 1000]
+    assert not history._history[1].compressed and not history._history[2].compressed
+
+def test_compaction_drops_unreached_branches(monkeypatch, tmp_path):
+    import configparser
+    from .. import config
+    from .. import query as query_module
+
+    parser = configparser.ConfigParser()
+    parser.read_string("[TelegramBot]\nChatIDFilterForPersistentHistory = [0]\n")
+    monkeypatch.setattr(config, "_current", config.Snapshot(parser))
+    monkeypatch.chdir(tmp_path)
+    now = [1000.0]
+    monkeypatch.setattr(query_module, "monotonic", lambda: now[0])
+    query = DummyQuery()
+    query.command = "dummy"
+    history = query.get_history(0)
+    history.record("How r u?", [4], None)
+    history.record("Fine, how bout u?", [16, 17], 4)
+    history.record("Abandoned reply", [20, 21], 4)
+    for record in history._history.values():
+        record.reached = now[0]
+
+    now[0] += 100
+    history.record("Fine ty", [22], 17)
+    history._history[22].reached = now[0]
+    assert history.compact(50) == (1, 1, len("Abandoned reply"))
+    assert sorted(history._history) == [4, 16, 22]
+    assert history.id_table == {17: 16}
+    with open(tmp_path / "DummyQuery_dummy_0.history") as f:
+        assert Query.History.deserialize(f.read()) == (history._history, history.id_table)
+
+    now[0] += 100
+    assert history.get(22)[-1]["content"] == "Fine ty"
+    assert query.compact_histories(50) == (0, 0, 0)
+    now[0] += 100
+    assert query.compact_histories(50) == (3, 1, len("How r u?Fine, how bout u?Fine ty"))
+    assert history._history == {} and len(history.id_table) == 0
@@ -0,0 +1,44 @@
+from ..history_records import AliasMap, Record
+
+def test_record_compression():
+    text = "How r u? " * 100
+    record = Record(text, [], 4)
+    assert record.images is None
+    assert record.to_list() == [text, [], 4]
+
+    saved = record.compress()
+    assert saved > 0
+    assert record.compressed
+    assert record.text == text
+    assert record == Record(text, None, 4)
+
+    record.decompress()
+    assert not record.compressed
+    assert record.text == text
+
+def test_record_images_serialized_as_base64():
+    record = Record("Look", [b"\x89PNG\r\n"], 4)
+    assert record.to_list() == ["Look", ["iVBORw0K"], 4]
+    assert Record.from_list(record.to_list()) == record
+
+def test_record_short_text_not_compressed():
+    record = Record("Fine ty", None, None)
+    assert record.compress() == 0
+    assert not record.compressed
+    assert Record(None, None, None).compress() == 0
+
+def test_alias_map():
+    aliases = AliasMap([(18, 16), (17, 16)])
+    aliases[30] = 29
+    aliases[5] = 4 # out of order
+    aliases[17] = 15 # overwritten
+
+    assert list(aliases.items()) == [(5, 4), (17, 15), (18, 16), (30, 29)]
+    assert aliases.get(17) == 15
+    assert aliases.get(16) is None
+    assert 30 in aliases and 29 not in aliases
+    assert aliases == {5: 4, 17: 15, 18: 16, 30: 29}
+
+    del aliases[5]
+    assert len(aliases) == 3
+    assert aliases == AliasMap({17: 15, 18: 16, 30: 29}.items())
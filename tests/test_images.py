@@ -0,0 +1,70 @@
+import io
+import pytest
+
+from .. import images
+
+Image = pytest.importorskip("PIL.Image")
+
+def jpeg(width: int, height: int, quality: int = 95) -> bytes:
+    output = io.BytesIO()
+    Image.effect_noise((width, height), 64).convert("RGB").save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+def test_transcode_scales_down():
+    data = jpeg(2000, 1000)
+    result = images.transcode(data, 512, 80, None)
+    with Image.open(io.BytesIO(result)) as image:
+        assert image.size == (512, 256)
+        assert image.format == "JPEG"
+    assert len(result) < len(data)
+
+def test_transcode_changes_format():
+    with Image.open(io.BytesIO(images.transcode(jpeg(100, 100), None, None, "WEBP"))) as image:
+        assert image.format == "WEBP"
+
+def test_transcode_keeps_smaller_original():
+    data = jpeg(64, 64, quality=10)
+    assert images.transcode(data, 1024, 95, None) is data
+
+def test_ingest_passes_through_unconfigured():
+    data = b"not an image"
+    assert images.ingest(data, None, None, None) is data
+
+def test_ingest_cached_and_failure_passes_through():
+    data = jpeg(800, 800)
+    first = images.ingest(data, 200, 80, None)
+    assert len(first) < len(data)
+    assert images.ingest(data, 200, 80, None) is first
+    assert images.ingest(b"not an image", 200, 80, None) == b"not an image"
+
+def test_ingest_unsupported_format_logged_once_and_cached(monkeypatch, caplog):
+    data = b"\x1aE\xdf\xa3" + b"webm sticker" * 10
+    with caplog.at_level("WARNING"):
+        assert images.ingest(data, 200, 80, None) is data
+    assert [r.exc_info for r in caplog.records] == [None]
+    monkeypatch.setattr(images, "_get_pool", lambda: pytest.fail("Not remembered as unsupported"))
+    assert images.ingest(data, 200, 80, None) is data
+
+def test_images_encoded_only_in_payload():
+    import base64
+    import json
+    from ..api_impl.google import GoogleChatQuery
+    from ..api_impl.openai import OpenAIChatQuery
+
+    data = jpeg(32, 32)
+    assert images.mime_type(data) == "image/jpeg"
+
+    query = GoogleChatQuery()
+    query.params = {}
+    history = query.get_history(0)
+    history.record("What is this?", [1], None, [data])
+    assert history._history[1].images == [data]
+    body = query.get_data(0, 1)
+    assert json.loads(body.getvalue()) == {"contents": [{"role": "user", "parts": [
+        {"text": "What is this?"}, {"inlineData": {"mimeType": "image/jpeg", "data": base64.b64encode(data).decode()}}]}]}
+
+    query = OpenAIChatQuery()
+    query.model, query.stream, query.params = "gpt", False, {}
+    query.get_history(0).record("What is this?", [1], None, [data])
+    url = json.loads(query.get_data(0, 1).getvalue())["messages"][0]["content"][1]["image_url"]["url"]
+    assert url == "data:image/jpeg;base64," + base64.b64encode(data).decode()
@@ -0,0 +1,70 @@
+import gzip
+import json
+import pytest
+
+from ..log_writer import BufferedLogWriter
+
+def read_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def test_records_written_as_json_lines(tmp_path):
+    filename = tmp_path / "replies.jsonl"
+    writer = BufferedLogWriter(str(filename), flush_interval=0.01)
+    for i in range(100):
+        writer.write({"chat_id": i, "reply": "ä" * i})
+    writer.close()
+
+    records = read_lines(filename)
+    assert [r["chat_id"] for r in records] == list(range(100))
+    assert records[3]["reply"] == "äää"
+
+def test_rotation_by_size(tmp_path):
+    filename = tmp_path / "replies.jsonl"
+    writer = BufferedLogWriter(str(filename), flush_interval=0.01, max_bytes=30)
+    writer.write({"n": 1})
+    writer.close()
+    assert read_lines(filename) == [{"n": 1}]
+
+    writer.write({"n": 2, "padding": "..."})
+    writer.close()
+    assert not filename.exists()
+
+    segments = list(tmp_path.iterdir())
+    assert len(segments) == 1
+    assert read_lines(segments[0]) == [{"n": 1}, {"n": 2, "padding": "..."}]
+
+def test_rotated_segments_compressed(tmp_path):
+    filename = tmp_path / "replies.jsonl"
+    writer = BufferedLogWriter(str(filename), flush_interval=0.01, max_bytes=1, compress=True)
+    writer.write({"n": 1})
+    writer.close()
+
+    segments = list(tmp_path.iterdir())
+    assert len(segments) == 1
+    assert segments[0].name.endswith(".gz")
+    with gzip.open(segments[0], "rt", encoding="utf-8") as f:
+        assert json.loads(f.read()) == {"n": 1}
+
+def test_unserializable_record_dropped_alone(tmp_path):
+    filename = tmp_path / "replies.jsonl"
+    writer = BufferedLogWriter(str(filename), flush_interval=0.01)
+    writer.write({"chat_id": 1})
+    writer.write({"chat_id": object()})
+    writer.write({"chat_id": 3})
+    writer.close()
+
+    assert [r["chat_id"] for r in read_lines(filename)] == [1, 3]
+
+def test_write_racing_close(tmp_path):
+    filename = tmp_path / "replies.jsonl"
+    writer = BufferedLogWriter(str(filename), flush_interval=0.01)
+    # As if a write landed between close queueing the sentinel and the thread taking it
+    writer._queue.put({"chat_id": 1})
+    writer._queue.put(BufferedLogWriter._STOP)
+    writer._queue.put({"chat_id": 2})
+    writer._start()
+    writer._thread.join(5)
+
+    assert not writer._thread.is_alive()
+    assert [r["chat_id"] for r in read_lines(filename)] == [1, 2]
@@ -0,0 +1,27 @@
+import base64
+import json
+import os
+
+from .. import payload
+from ..payload import Base64
+
+def test_dumps_without_images_is_json():
+    assert payload.dumps({"a": [1, "b"]}) == json.dumps({"a": [1, "b"]})
+
+def test_body_encodes_images_while_read():
+    images = [os.urandom(payload._CHUNK_BYTES + 1), b"\x00\x01"]
+    obj = {"text": "ä \"quoted\"", "images": [Base64(images[0]), Base64(images[1], "data:x;base64,")]}
+    body = payload.dumps(obj)
+    expected = json.dumps({"text": obj["text"], "images": [base64.b64encode(images[0]).decode(),
+                                                           "data:x;base64," + base64.b64encode(images[1]).decode()]})
+
+    assert len(body) == len(expected.encode())
+    read = b""
+    while chunk := body.read(1000):
+        read += chunk
+    assert read == expected.encode()
+    assert body.tell() == len(body)
+
+    body.seek(0)
+    assert body.read() == expected.encode()
+    assert body.getvalue() == expected.encode()
@@ -0,0 +1,104 @@
+import configparser
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from .. import cancellation, config, metrics, query_handler
+from ..query import TextGenQuery
+
+class FakeBot:
+    def __init__(self, send_seconds: float = 0.0):
+        self.send_seconds = send_seconds
+        self.calls = []
+        self.ids = iter(range(100, 1000))
+        self.lock = threading.Lock()
+
+    def sent(self, call: str) -> SimpleNamespace:
+        with self.lock:
+            self.calls.append(call)
+            file = SimpleNamespace(file_id=f"{call}-{len(self.calls)}")
+            return SimpleNamespace(id=next(self.ids), message_id=len(self.calls), photo=[file], document=file)
+
+    def send_message(self, chat_id, text, reply_to_message_id=None):
+        time.sleep(self.send_seconds)
+        return self.sent("message")
+
+    def edit_message_text(self, text, chat_id, message_id):
+        self.sent("edit")
+
+    def send_photo(self, chat_id, photo, reply_to_message_id=None):
+        return self.sent("photo")
+
+    def send_document(self, chat_id, document, reply_to_message_id=None, visible_file_name=None):
+        return self.sent("document")
+
+@pytest.fixture
+def handler(monkeypatch):
+    def create(bot: FakeBot, placeholder_delay: float, query=None) -> query_handler.QueryHandler:
+        parser = configparser.ConfigParser()
+        parser.read_string(f"[TelegramBot]\nPlaceholderDelay = {placeholder_delay}\n")
+        monkeypatch.setattr(config, "_current", config.Snapshot(parser))
+        query = query or TextGenQuery()
+        query.command = "test"
+        msg = SimpleNamespace(id=len(created) + 1, chat=SimpleNamespace(id=1))
+        created.append(query_handler.QueryHandler(bot, msg, query, cancellation.start(1, msg.id)))
+        return created[-1]
+    created = []
+    yield create
+    for h in created:
+        h.skip_placeholder()
+        h._placeholder.result()
+        cancellation.finish(h.generation)
+
+def test_image_reply_after_placeholder(handler):
+    bot = FakeBot()
+    h = handler(bot, 0)
+    h._placeholder.result()
+    h.image = b"image"
+    h.process_image_reply()
+    assert bot.calls[0] == "message"
+    assert sorted(bot.calls[1:]) == ["document", "photo"]
+    assert len(h.sent_message_ids) == 3
+
+def test_image_reply_skips_placeholder(handler):
+    skipped = lambda: metrics.snapshot()["counters"].get("placeholders_skipped{command=test}", 0)
+    before = skipped()
+    bot = FakeBot()
+    h = handler(bot, 10)
+    h.image = b"image"
+    h.process_image_reply()
+    assert skipped() == before + 1
+    h.skip_placeholder()
+    h._placeholder.result()
+    assert sorted(bot.calls) == ["document", "photo"]
+
+def test_image_reply_waits_for_placeholder_in_flight(handler):
+    bot = FakeBot(send_seconds=0.3)
+    h = handler(bot, 0)
+    time.sleep(0.1)
+    h.image = b"image"
+    h.process_image_reply()
+    # The placeholder isn't sent after the image, to be left undeleted
+    assert bot.calls[0] == "message"
+    assert len(h.sent_message_ids) == 3
+
+@pytest.mark.parametrize("placeholder_delay", [0, 10])
+def test_overflow_after_counts_current_message(handler, placeholder_delay):
+    query = TextGenQuery()
+    query.overflow_mode = "document"
+    query.overflow_after = 2
+    bot = FakeBot()
+    h = handler(bot, placeholder_delay, query)
+    if placeholder_delay == 0:
+        h._placeholder.result()
+    # A reply needing three messages received whole, as when not streamed
+    h.total_message = h.total_reply = "".join(f"line {i} " * 40 + "\n" for i in range(30))
+    h.data_ended = True
+    while h.process_text_reply():
+        pass
+    assert h.overflowed
+    # The placeholder, or the message sent in its place, is the only message besides the document
+    assert bot.calls.count("message") == 1
+    assert bot.calls.count("document") == 1
@@ -0,0 +1,84 @@
+import configparser
+
+from .. import api_impl, config, metrics
+from ..config import Snapshot
+from ..query_implementations import QueryImplementations, get_api_modules, get_query_implementations
+
+def snapshot(ini: str) -> Snapshot:
+    parser = configparser.ConfigParser()
+    parser.read_string(ini)
+    return Snapshot(parser)
+
+INI = """
+[gpt]
+Api = OpenAI
+Feature = Text gen
+Url = https://api.openai.com/v1/chat/completions
+Model = {model}
+Token = abc
+MaxConcurrent = {max_concurrent}
+"""
+
+def test_reload_carries_histories_over(monkeypatch):
+    monkeypatch.setattr(config, "_reload_listeners", [])
+    implementations = QueryImplementations(get_query_implementations(snapshot(INI.format(model="gpt-4o", max_concurrent=2))))
+    config.on_reload(implementations.reload)
+    previous = implementations.current[0]
+    previous.get_history(1).record("How r u?", [4], None)
+
+    assert config._reload(lambda: snapshot(INI.format(model="gpt-4.1", max_concurrent=3)))
+
+    query = implementations.current[0]
+    assert query is not previous and query.model == "gpt-4.1"
+    assert query.get_history(1).get(4) == [{"role": "user", "content": "How r u?"}]
+    assert query.get_history(1).query is query
+    assert previous.endpoints._closed.is_set()
+    assert query.limiter.max_concurrent == 3
+    assert metrics.snapshot()["collected"]["queue:gpt"]["max_concurrent"] == 3
+    query.close()
+
+def test_failed_reload_keeps_everything(monkeypatch):
+    monkeypatch.setattr(config, "_reload_listeners", [])
+    implementations = QueryImplementations(get_query_implementations(snapshot(INI.format(model="gpt-4o", max_concurrent=2))))
+    config.on_reload(implementations.reload)
+    previous = implementations.current[0]
+    current = config.current()
+
+    assert not config._reload(lambda: snapshot(INI.format(model="gpt-4.1", max_concurrent=2).replace("OpenAI", "Nonexistent")))
+
+    assert implementations.current == [previous]
+    assert not previous.endpoints._closed.is_set()
+    assert config.current() is current
+    previous.close()
+
+def test_get_api_modules():
+    assert get_api_modules(snapshot(INI.format(model="gpt-4o", max_concurrent=2))) == ["openai"]
+    assert get_api_modules(snapshot(INI.format(model="gpt-4o", max_concurrent=2)
+                                    + INI.replace("[gpt]", "[gemini]").replace("OpenAI", "Google").format(model="gemini", max_concurrent=1)
+                                    + INI.replace("[gpt]", "[gpt2]").format(model="gpt-4.1", max_concurrent=1))) \
+        == ["openai", "google"]
+    assert get_api_modules(snapshot(INI.replace("OpenAI", "Custom").format(model="gpt-4o", max_concurrent=2))) \
+        == api_impl.__all__
+    assert get_api_modules(snapshot("")) == []
+
+def test_configured_with_endpoint_tokens():
+    [query] = get_query_implementations(snapshot("""
+[gpt]
+Api = OpenAI
+Feature = Text gen
+Model = gpt-4o
+Endpoints =
+    https://a.example.com/v1/chat/completions {"token": "a"}
+    https://b.example.com/v1/chat/completions {"token": "b"}
+"""))
+    assert query.is_configured()
+    [query] = get_query_implementations(snapshot("""
+[gpt]
+Api = OpenAI
+Feature = Text gen
+Model = gpt-4o
+Endpoints =
+    https://a.example.com/v1/chat/completions {"token": "a"}
+    https://b.example.com/v1/chat/completions
+"""))
+    assert not query.is_configured()
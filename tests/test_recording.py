@@ -0,0 +1,48 @@
+from time import perf_counter
+
+from .. import recording
+
+class ListWriter(list):
+    def write(self, record):
+        self.append(record)
+
+def test_disabled_recording_passes_lines_through():
+    assert not recording.enabled()
+    lines = iter(["a", "b"])
+    assert recording.stream(lines, "gpt", 200, perf_counter()) is lines
+
+def test_ids_are_anonymised_consistently():
+    assert recording.anonymise(1234567890) == recording.anonymise(1234567890)
+    assert recording.anonymise(1234567890) != 1234567890
+    assert recording.anonymise(1234567890) != recording.anonymise(1234567891)
+    assert recording.anonymise(None) is None
+
+def test_stream_records_gaps_and_lengths(monkeypatch):
+    writer = ListWriter()
+    monkeypatch.setattr(recording, "_writer", writer)
+
+    lines = recording.stream(iter(["data: {}", "", "data: [DONE]"]), "gpt", 200, perf_counter())
+    assert list(lines) == ["data: {}", "", "data: [DONE]"]
+
+    [record] = writer
+    assert record["type"] == "stream"
+    assert record["command"] == "gpt"
+    assert record["status"] == 200
+    assert [length for _, length in record["chunks"]] == [8, 0, 12]
+    assert all(gap >= 0 for gap, _ in record["chunks"])
+
+def test_interrupted_stream_is_recorded(monkeypatch):
+    writer = ListWriter()
+    monkeypatch.setattr(recording, "_writer", writer)
+
+    def interrupted():
+        yield "data: {}"
+        raise ConnectionError()
+
+    lines = recording.stream(interrupted(), "gpt", 200, perf_counter())
+    assert next(lines) == "data: {}"
+    try:
+        next(lines)
+    except ConnectionError:
+        pass
+    assert [length for _, length in writer[0]["chunks"]] == [8]
@@ -0,0 +1,64 @@
+import pytest
+import requests
+from telebot.apihelper import ApiTelegramException
+
+from .. import metrics, retries
+
+def telegram_error(code: int, description: str = "error", retry_after: int | None = None) -> ApiTelegramException:
+    result_json = {"ok": False, "error_code": code, "description": description}
+    if retry_after is not None:
+        result_json["parameters"] = {"retry_after": retry_after}
+    return ApiTelegramException("sendMessage", None, result_json)
+
+class FlakyCall:
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "sent"
+
+@pytest.fixture
+def delays(monkeypatch):
+    slept = []
+    monkeypatch.setattr(retries, "sleep", slept.append)
+    return slept
+
+def test_rate_limit_waits_retry_after(delays):
+    call = FlakyCall(telegram_error(429, retry_after=7), telegram_error(502))
+    before = metrics.snapshot()["counters"].get("telegram_retries{method=send_message,reason=429}", 0)
+    assert retries.telegram("send_message", call, 1, "text") == "sent"
+    assert call.calls == 3
+    assert 7 <= delays[0] <= 7.5
+    assert 0 <= delays[1] <= 1.0
+    assert metrics.snapshot()["counters"]["telegram_retries{method=send_message,reason=429}"] == before + 1
+
+def test_send_not_retried_if_possibly_delivered(delays):
+    call = FlakyCall(requests.ReadTimeout())
+    with pytest.raises(requests.ReadTimeout):
+        retries.telegram("send_message", call)
+    assert call.calls == 1
+    # A connection never made is retried, as nothing was sent
+    call = FlakyCall(requests.ConnectTimeout())
+    assert retries.telegram("send_message", call) == "sent"
+
+def test_edit_retried_and_found_delivered(delays):
+    call = FlakyCall(requests.ConnectionError(), telegram_error(400, "Bad Request: message is not modified"))
+    assert retries.telegram("edit_message_text", call, idempotent=True) is None
+    assert call.calls == 2
+
+def test_client_errors_not_retried(delays):
+    call = FlakyCall(telegram_error(400, "Bad Request: can't parse entities"))
+    with pytest.raises(ApiTelegramException):
+        retries.telegram("edit_message_text", call, idempotent=True)
+    assert delays == []
+
+def test_gives_up(delays):
+    call = FlakyCall(*[telegram_error(500)] * 10)
+    with pytest.raises(ApiTelegramException):
+        retries.telegram("send_message", call)
+    assert call.calls == 6
+    assert all(delay <= 30.0 for delay in delays)
@@ -0,0 +1,26 @@
+from .. import sharding
+
+def test_updates_of_a_chat_go_to_the_same_shard():
+    message = {"update_id": 1, "message": {"chat": {"id": -100123}}}
+    edit = {"update_id": 2, "edited_message": {"chat": {"id": -100123}}}
+    callback = {"update_id": 3, "callback_query": {"message": {"chat": {"id": -100123}}}}
+    shards = {sharding.shard_of(update, 4) for update in (message, edit, callback)}
+    assert len(shards) == 1 and 0 <= shards.pop() < 4
+    assert sharding.shard_of({"update_id": 4, "inline_query": {}}, 4) == 0
+
+def test_aggregate():
+    snapshot = lambda counters, observations, collected: \
+        {"time": 0, "counters": counters, "observations": observations, "collected": collected}
+    aggregated = sharding.aggregate({
+        0: snapshot({"replies": 2}, {"generation_seconds": {"count": 2, "sum": 3.0, "max": 2.0}}, {"queue:gpt": {"active": 1}}),
+        1: snapshot({"replies": 1, "cancellations": 1}, {"generation_seconds": {"count": 1, "sum": 5.0, "max": 5.0}},
+                    {"queue:gpt": {"active": 0}}),
+    })
+    assert aggregated["counters"] == {"replies": 3, "cancellations": 1}
+    assert aggregated["observations"] == {"generation_seconds": {"count": 3, "sum": 8.0, "max": 5.0}}
+    assert aggregated["collected"] == {"shard0:queue:gpt": {"active": 1}, "shard1:queue:gpt": {"active": 0}}
+
+def test_per_shard(monkeypatch):
+    assert sharding.per_shard("logs/replies.jsonl") == "logs/replies.jsonl"
+    monkeypatch.setenv(sharding._SHARD_VARIABLE, "3")
+    assert sharding.per_shard("logs/replies.jsonl") == "logs/replies.shard3.jsonl"
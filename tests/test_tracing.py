@@ -0,0 +1,51 @@
+import pytest
+
+from .. import tracing
+
+def test_disabled_tracing_is_a_no_op():
+    assert not tracing._enabled
+    with tracing.trace(1, "gpt") as trace:
+        with tracing.span("format"):
+            pass
+    assert trace is None
+
+def test_spans_are_aggregated_per_stage(monkeypatch):
+    monkeypatch.setattr(tracing, "_enabled", True)
+    monkeypatch.setattr(tracing, "_trace_writer", None)
+
+    with tracing.trace(1, "gpt") as trace:
+        with tracing.span("format"):
+            pass
+        with tracing.span("edit_message_text"):
+            pass
+        with tracing.span("format"):
+            pass
+
+    assert tracing.span("format") is tracing._disabled  # Trace is no longer current
+
+    spans = trace.to_dict()["spans"]
+    assert list(spans) == ["format", "edit_message_text"]
+    assert spans["format"]["count"] == 2
+    assert spans["edit_message_text"]["count"] == 1
+    assert spans["format"]["total"] >= spans["format"]["max"]
+    assert trace.to_dict()["chat_id"] == 1
+    assert trace.to_dict()["command"] == "gpt"
+
+def test_overlapping_profiles(monkeypatch, tmp_path):
+    monkeypatch.setattr(tracing, "_enabled", True)
+    monkeypatch.setattr(tracing, "_trace_writer", None)
+    monkeypatch.setattr(tracing, "_profile_dir", str(tmp_path))
+    monkeypatch.setattr(tracing, "_profile_sample_rate", 1.0)
+
+    outer = tracing.trace(1, "gpt")
+    inner = tracing.trace(2, "gpt")
+    with outer:
+        with inner:
+            pass
+    assert outer.profiler is not None
+    assert inner.profiler is None  # Skipped instead of failing the reply
+    assert len(list(tmp_path.iterdir())) == 1
+
+    with tracing.trace(3, "gpt") as trace:
+        pass
+    assert trace.profiler is not None
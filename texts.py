@@ -1,8 +1,21 @@
 from . import config
 
-please_wait     = config.get_or_default("TextOverrides", "PleaseWait",     "... Please Wait ...")
-thats_enough    = config.get_or_default("TextOverrides", "ThatsEnough",    "Alright that's enough")
-to_be_continued = config.get_or_default("TextOverrides", "ToBeContinued",  ".... To Be Continued ...")
-thinking        = config.get_or_default("TextOverrides", "Thinking",       "Thinking:")
-empty_reply     = config.get_or_default("TextOverrides", "EmptyReply",     "[Empty Reply]")
-service_refused = config.get_or_default("TextOverrides", "ServiceRefused", "Service refused")
\ No newline at end of file
+def _load(snapshot: config.Snapshot):
+    global please_wait, thats_enough, to_be_continued, thinking, empty_reply, service_refused, queued, too_busy, cancelled, \
+        timed_out, rate_limited, writing_document, sent_as_document
+    please_wait     = snapshot.get_or_default("TextOverrides", "PleaseWait",     "... Please Wait ...")
+    thats_enough    = snapshot.get_or_default("TextOverrides", "ThatsEnough",    "Alright that's enough")
+    to_be_continued = snapshot.get_or_default("TextOverrides", "ToBeContinued",  ".... To Be Continued ...")
+    thinking        = snapshot.get_or_default("TextOverrides", "Thinking",       "Thinking:")
+    empty_reply     = snapshot.get_or_default("TextOverrides", "EmptyReply",     "[Empty Reply]")
+    service_refused = snapshot.get_or_default("TextOverrides", "ServiceRefused", "Service refused")
+    queued          = snapshot.get_or_default("TextOverrides", "Queued",         "... Queued ({position}) ...")
+    too_busy        = snapshot.get_or_default("TextOverrides", "TooBusy",        "Too busy at the moment, try again later")
+    cancelled       = snapshot.get_or_default("TextOverrides", "Cancelled",      "[Cancelled]")
+    timed_out       = snapshot.get_or_default("TextOverrides", "TimedOut",       "[Timed Out]")
+    writing_document = snapshot.get_or_default("TextOverrides", "WritingDocument", "... Writing the rest to a document ...")
+    sent_as_document = snapshot.get_or_default("TextOverrides", "SentAsDocument",  "[The full reply is in the document]")
+    rate_limited    = snapshot.get_or_default("TextOverrides", "RateLimited",    "Too many requests, try again in a while")
+
+_load(config.current())
+config.on_reload(lambda snapshot: lambda: _load(snapshot))
@@ -0,0 +1,125 @@
+import cProfile
+import logging
+import os
+import random
+import threading
+from contextlib import nullcontext
+from time import perf_counter, time
+
+from . import config
+from .log_writer import BufferedLogWriter
+from .sharding import per_shard
+
+
+_trace_log = config.get("TelegramBot", "TraceLog")
+_trace_writer = BufferedLogWriter(per_shard(_trace_log)) if _trace_log else None
+_profile_dir = config.get("TelegramBot", "ProfileDir")
+_profile_sample_rate = config.get_float("TelegramBot", "ProfileSampleRate") or 0.0
+_profile_latency_threshold = config.get_float("TelegramBot", "ProfileLatencyThreshold")
+
+_enabled = bool(_trace_log or (_profile_dir and (_profile_sample_rate > 0 or _profile_latency_threshold is not None)))
+
+_local = threading.local()
+# Only one profiler can be enabled at a time, so replies overlapping a profiled one go unprofiled
+_profiler_lock = threading.Lock()
+
+# Returned whenever tracing is off, so that the instrumented code pays for a lookup and nothing else.
+_disabled = nullcontext()
+
+
+class Span:
+    def __init__(self, trace: 'Trace', name: str):
+        self.trace = trace
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, self.start, perf_counter() - self.start)
+        return False
+
+
+class Trace:
+    def __init__(self, chat_id: int, command: str):
+        self.chat_id = chat_id
+        self.command = command
+        self.started = time()
+        self.origin = 0.0
+        self.duration = 0.0
+        self.spans: dict[str, list[float]] = {}
+        self.profiler = None
+        self.sampled = False
+
+    def add(self, name: str, start: float, duration: float):
+        span = self.spans.get(name)
+        if span is None:
+            self.spans[name] = [1, duration, duration, start - self.origin]
+        else:
+            span[0] += 1
+            span[1] += duration
+            span[2] = max(span[2], duration)
+
+    def __enter__(self):
+        _local.trace = self
+        if _profile_dir:
+            self.sampled = random.random() < _profile_sample_rate
+            if (self.sampled or _profile_latency_threshold is not None) and _profiler_lock.acquire(blocking=False):
+                try:
+                    self.profiler = cProfile.Profile()
+                    self.profiler.enable()
+                except Exception as e:
+                    self.profiler = None
+                    _profiler_lock.release()
+                    logging.exception(str(e), exc_info=True)
+        self.origin = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.duration = perf_counter() - self.origin
+        _local.trace = None
+        try:
+            if self.profiler is not None:
+                self.profiler.disable()
+                _profiler_lock.release()
+                if self.sampled or self.duration >= _profile_latency_threshold:
+                    self._dump_profile()
+            if _trace_writer is not None:
+                self._export()
+        except Exception as e:
+            # Instrumentation must never fail the reply
+            logging.exception(str(e), exc_info=True)
+        return False
+
+    def to_dict(self) -> dict[str, any]:
+        return {"time": self.started,
+                "chat_id": self.chat_id,
+                "command": self.command,
+                "duration": self.duration,
+                "spans": {name: {"count": count, "total": total, "max": longest, "offset": offset}
+                          for name, (count, total, longest, offset) in self.spans.items()}}
+
+    def _export(self):
+        _trace_writer.write(self.to_dict())
+
+    def _dump_profile(self):
+        os.makedirs(_profile_dir, exist_ok=True)
+        filename = f"{int(self.started * 1000)}_{self.chat_id}_{self.command}.prof"
+        self.profiler.dump_stats(os.path.join(_profile_dir, filename))
+
+
+def trace(chat_id: int, command: str):
+    if not _enabled:
+        return _disabled
+    return Trace(chat_id, command)
+
+
+def span(name: str):
+    if not _enabled:
+        return _disabled
+    current = getattr(_local, "trace", None)
+    if current is None:
+        return _disabled
+    return Span(current, name)
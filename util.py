@@ -1,7 +1,10 @@
 import importlib
 import logging
+from time import time
 from telebot.types import Message
 from . import config
+from .log_writer import BufferedLogWriter
+from .sharding import per_shard
 
 
 class ServiceRefuser:
@@ -27,12 +30,28 @@ def setup_logging():
         file_handler.setFormatter(formatter)
         logger.addHandler(file_handler)
 
-reply_logger = config.get("TelegramBot", "ReplyLog")
+def _reply_log_writer() -> BufferedLogWriter | None:
+    filename = config.get("TelegramBot", "ReplyLog")
+    if not filename:
+        return None
+    return BufferedLogWriter(per_shard(filename),
+                             flush_interval=config.get_float("TelegramBot", "ReplyLogFlushInterval") or 1.0,
+                             max_bytes=config.get_int("TelegramBot", "ReplyLogMaxBytes"),
+                             rotate_seconds=config.get_float("TelegramBot", "ReplyLogRotateInterval"),
+                             compress=config.get_boolean_or_false("TelegramBot", "ReplyLogCompress"))
 
-def log_reply(vendor: str, model: str, reply: str, chat_id: int):
+reply_logger = _reply_log_writer()
+
+def log_reply(command: str, model: str, reply: str, chat_id: int, latency: float, queue_wait: float = 0.0):
     if reply_logger:
-        loggable_chat_ids = config.get_int_list("TelegramBot", "ChatIDFilterForReplyLog")
+        loggable_chat_ids = config.current().reply_log_chat_ids
         if loggable_chat_ids is not None and chat_id not in loggable_chat_ids:
             return
-        with open(reply_logger, "a", encoding="utf-8") as f:
-            f.write(vendor + " " + model + ":\n" + reply + "\n\n\n")
\ No newline at end of file
+        reply_logger.write({"time": time(),
+                            "chat_id": chat_id,
+                            "command": command,
+                            "model": model,
+                            "latency": round(latency, 3),
+                            "queue_wait": round(queue_wait, 3),
+                            "length": len(reply),
+                            "reply": reply})